@@ -3,7 +3,8 @@ from flask import Blueprint, render_template, redirect, url_for, request, flash,
 from flask_login import login_required, current_user
 from werkzeug.security import generate_password_hash
 from extensions import db
-from models import User, Aviso
+from models import User, MensajeTelegram
+from estadisticas import estadisticas_por_tecnico, fecha_arg, STATS_TECNICO_VACIAS
 
 admin_bp = Blueprint('admin', __name__, url_prefix='/admin')
 
@@ -22,16 +23,12 @@ def admin_required(f):
 @admin_required
 def index():
     tecnicos = User.query.order_by(User.rol, User.username).all()
-    # Estadísticas rápidas por técnico
-    stats = {}
-    for t in tecnicos:
-        stats[t.id] = {
-            'total':      Aviso.query.filter_by(asignado_a=t.id).count(),
-            'activos':    Aviso.query.filter(Aviso.asignado_a==t.id, Aviso.estado!='finalizado').count(),
-            'finalizados':Aviso.query.filter_by(asignado_a=t.id, estado='finalizado').count(),
-            'morosos':    Aviso.query.filter_by(asignado_a=t.id, cobro_estado='moroso').count(),
-        }
-    return render_template('admin/index.html', tecnicos=tecnicos, stats=stats)
+    # Estadísticas rápidas por técnico (una sola consulta agrupada)
+    desde, hasta = fecha_arg('desde'), fecha_arg('hasta')
+    por_tecnico = estadisticas_por_tecnico(desde, hasta)
+    stats = {t.id: por_tecnico.get(t.id, STATS_TECNICO_VACIAS) for t in tecnicos}
+    return render_template('admin/index.html', tecnicos=tecnicos, stats=stats,
+                           desde=desde, hasta=hasta)
 
 
 @admin_bp.route('/tecnico/nuevo', methods=['GET', 'POST'])
@@ -107,3 +104,35 @@ def toggle_tecnico(id):
     estado = 'activado' if tecnico.is_active else 'desactivado'
     flash(f'Técnico "{tecnico.username}" {estado}.', 'info')
     return redirect(url_for('admin.index'))
+
+
+# ── Cola de Telegram ───────────────────────────────────────────────────────
+
+@admin_bp.route('/telegram/cola')
+@login_required
+@admin_required
+def cola_telegram():
+    estado = request.args.get('estado', '')
+    q = MensajeTelegram.query
+    if estado:
+        q = q.filter_by(estado=estado)
+    else:
+        q = q.filter(MensajeTelegram.estado != 'enviado')
+    mensajes = q.order_by(MensajeTelegram.id.desc()).limit(200).all()
+
+    conteo = dict(db.session.query(MensajeTelegram.estado, db.func.count(MensajeTelegram.id))
+                  .group_by(MensajeTelegram.estado).all())
+    return render_template('admin/cola_telegram.html',
+                           mensajes=mensajes, conteo=conteo, estado=estado)
+
+
+@admin_bp.route('/telegram/cola/<int:id>/reintentar', methods=['POST'])
+@login_required
+@admin_required
+def reintentar_mensaje(id):
+    from telegram_cola import reintentar
+    if reintentar(id):
+        flash(f'Mensaje #{id} puesto de nuevo en cola.', 'info')
+    else:
+        flash('Mensaje no encontrado.', 'danger')
+    return redirect(url_for('admin.cola_telegram', estado=request.args.get('estado', '')))
@@ -45,68 +45,88 @@ def create_app(config_class=Config):
 
     with app.app_context():
         from models import User, Aviso, Photo  # noqa: F401
-        db.create_all()
-        _migrar_columnas()
-        _seed_default_users()
+        import rollups  # noqa: F401  (registra los eventos de stats_diario)
+        import telegram_commands  # noqa: F401  (invalida la caché del bot al cambiar avisos)
+        import limpieza  # noqa: F401  (borra los archivos de las fotos tras el commit)
+        from migraciones import comprobar_esquema
+        comprobar_esquema(app)
+
+    _vigilar_cargas_perezosas()
+
+    _arrancar_hilos(app)
+
+    # Comandos CLI
+    from migraciones import db_upgrade_command
+    from rollups import rebuild_rollups_command
+    from telegram_cola import telegram_worker_command
+    from telegram_entrada import telegram_poll_command
+    from fotos import fotos_procesar_command, fotos_migrar_command
+    from limpieza import uploads_gc_command
+    app.cli.add_command(db_upgrade_command)
+    app.cli.add_command(rebuild_rollups_command)
+    app.cli.add_command(telegram_worker_command)
+    app.cli.add_command(telegram_poll_command)
+    app.cli.add_command(fotos_procesar_command)
+    app.cli.add_command(fotos_migrar_command)
+    app.cli.add_command(uploads_gc_command)
 
     return app
 
 
-def _migrar_columnas():
-    """Añade columnas nuevas a tablas existentes sin borrar datos."""
-    from sqlalchemy import text, inspect
-    with db.engine.connect() as conn:
-        inspector = inspect(db.engine)
-
-        # ── User ──
-        user_cols = [c['name'] for c in inspector.get_columns('user')]
-        if 'rol' not in user_cols:
-            conn.execute(text("ALTER TABLE user ADD COLUMN rol VARCHAR(20) DEFAULT 'tecnico'"))
-            conn.execute(text("UPDATE user SET rol='admin' WHERE username='admin'"))
-        for col, tipo in [
-            ('nombre_completo', 'VARCHAR(150)'),
-            ('telefono_perfil', 'VARCHAR(20)'),
-            ('telegram_chat_id', 'VARCHAR(50)'),
-        ]:
-            if col not in user_cols:
-                conn.execute(text(f"ALTER TABLE user ADD COLUMN {col} {tipo}"))
-
-        # ── Aviso ──
-        aviso_cols = [c['name'] for c in inspector.get_columns('aviso')]
-        nuevas_aviso = [
-            ('precio_mano_obra',  'FLOAT',        None),
-            ('coste_materiales',  'FLOAT',        None),
-            ('materiales_desc',   'TEXT',         None),
-            ('descuento',         'FLOAT',        None),
-            ('gastos_extra',      'FLOAT',        None),
-            ('gastos_extra_desc', 'VARCHAR(200)', None),
-            ('cobro_estado',      'VARCHAR(20)',  "'pendiente'"),
-            ('asignado_a',        'INTEGER',      None),
-        ]
-        for col, tipo, default in nuevas_aviso:
-            if col not in aviso_cols:
-                sql = f"ALTER TABLE aviso ADD COLUMN {col} {tipo}"
-                if default:
-                    sql += f" DEFAULT {default}"
-                conn.execute(text(sql))
-
-        conn.commit()
-
-
-def _seed_default_users():
-    from models import User
-    from werkzeug.security import generate_password_hash
-    if User.query.count() == 0:
-        usuarios = [
-            User(username='admin',    password=generate_password_hash('admin123'),    rol='admin'),
-            User(username='tecnico1', password=generate_password_hash('tecnico123'), rol='tecnico'),
-            User(username='tecnico2', password=generate_password_hash('tecnico123'), rol='tecnico'),
-        ]
-        db.session.add_all(usuarios)
-        db.session.commit()
-        print("Usuarios creados: admin/admin123, tecnico1/tecnico123, tecnico2/tecnico123")
+def _arrancar_hilos(app):
+    """
+    Hilos en segundo plano, solo si la configuración los pide
+    (TELEGRAM_COLA_HILO, TELEGRAM_HILOS): lo que quedó pendiente en la base
+    de datos (mensajes por enviar, updates del bot) sale sin esperar a la
+    próxima petición.
+    """
+    if app.testing:
+        return
+    if app.config.get('TELEGRAM_COLA_HILO'):
+        from telegram_cola import iniciar
+        iniciar(app)
+    if app.config.get('TELEGRAM_HILOS'):
+        from telegram_entrada import despachar
+        despachar(app)
+
+
+CARGAS_PEREZOSAS_UMBRAL = 5
+
+
+def _vigilar_cargas_perezosas():
+    """
+    Con la app en debug, avisa en el log cuando una misma relación se carga
+    de forma perezosa varias veces en una petición (típico N+1 dentro de un
+    bucle). El listener se instala siempre y mira `debug` al dispararse:
+    `app.run(debug=True)` lo activa después de create_app.
+    """
+    from sqlalchemy import event
+    from sqlalchemy.orm import Session
+
+    if not event.contains(Session, 'do_orm_execute', _contar_carga_perezosa):
+        event.listen(Session, 'do_orm_execute', _contar_carga_perezosa)
+
+
+def _contar_carga_perezosa(orm_execute_state):
+    from collections import Counter
+    from flask import current_app, g, has_request_context, request
+
+    if not has_request_context() or not current_app.debug:
+        return
+    if not orm_execute_state.is_select or orm_execute_state.lazy_loaded_from is None:
+        return
+    # Aviso.tecnico, User.avisos…: la relación concreta, no solo las clases
+    relacion = str(orm_execute_state.loader_strategy_path[-1])
+    cargas = g.setdefault('_cargas_perezosas', Counter())
+    cargas[relacion] += 1
+    if cargas[relacion] == CARGAS_PEREZOSAS_UMBRAL:
+        current_app.logger.warning(
+            f'Posible N+1 en {request.method} {request.path}: {relacion} '
+            f'cargado de forma perezosa {CARGAS_PEREZOSAS_UMBRAL}+ veces'
+        )
 
 
 if __name__ == '__main__':
-    app = create_app()
+    from config import ConfigDesarrollo
+    app = create_app(ConfigDesarrollo)
     app.run(debug=True, host='0.0.0.0', port=8080)
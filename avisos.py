@@ -1,15 +1,22 @@
 import os
-import uuid
+import re
 from datetime import date
+from urllib.parse import unquote
 
 from flask import (Blueprint, render_template, redirect, url_for,
                    request, flash, current_app, send_from_directory,
-                   jsonify)
+                   jsonify, abort)
 from flask_login import login_required, current_user
-from PIL import Image
+from sqlalchemy.orm import joinedload, selectinload
 
+from busqueda import buscar, buscar_con_relevancia
 from extensions import db
-from models import Aviso, Photo, ESTADOS, ELECTRODOMESTICOS, COBRO_ESTADOS, User
+from fotos import (guardar_original, procesar, obtener_version,
+                   ruta_original, ruta_subida, subida_recibido, subida_anadir,
+                   subida_completar, DesfaseSubida, SubidaOcupada)
+from imagenes import TAMANOS
+from models import Aviso, Photo, ESTADOS, ELECTRODOMESTICOS, COBRO_ESTADOS, User, opciones_listado
+from paginacion import paginar_keyset
 from telegram_bot import notificar_aviso_nuevo, notificar_cambio_estado
 
 avisos_bp = Blueprint('avisos', __name__, url_prefix='/avisos')
@@ -21,51 +28,82 @@ def allowed_file(filename):
             current_app.config['ALLOWED_EXTENSIONS'])
 
 
+def _pide_json():
+    """El formulario con fotos se envía por fetch y luego sube cada foto aparte."""
+    return request.accept_mimetypes.best == 'application/json'
+
+
+def _aviso_guardado(aviso):
+    return jsonify({'ok': True, 'id': aviso.id,
+                    'subida': url_for('avisos.subir_foto', id=aviso.id),
+                    'url': url_for('avisos.detail', id=aviso.id)})
+
+
 def save_photo(file_obj):
-    """Guarda la foto redimensionada con nombre UUID. Devuelve el nombre guardado."""
-    ext = file_obj.filename.rsplit('.', 1)[1].lower()
-    stored_name = f"{uuid.uuid4().hex}.{ext}"
-    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], stored_name)
+    """
+    Guarda el original por su hash SHA-256 (sin decodificarlo). Devuelve el
+    nombre guardado; las versiones reducidas se generan con fotos.procesar().
+    """
+    return guardar_original(file_obj)
 
-    try:
-        img = Image.open(file_obj)
-        img.thumbnail((1920, 1920), Image.LANCZOS)
-        if img.mode in ('RGBA', 'P'):
-            img = img.convert('RGB')
-        img.save(filepath, optimize=True, quality=85)
-    except Exception:
-        # Si Pillow falla (ej. HEIC sin soporte), guardar tal cual
-        file_obj.seek(0)
-        file_obj.save(filepath)
 
-    return stored_name
+def _enviar_original(filename):
+    ruta = ruta_original(filename)
+    if ruta is None:
+        abort(404)
+    return send_from_directory(os.path.dirname(ruta), os.path.basename(ruta))
 
 
-def delete_photo_file(filename):
-    """Elimina el archivo de foto del disco."""
-    filepath = os.path.join(current_app.config['UPLOAD_FOLDER'], filename)
-    if os.path.exists(filepath):
-        os.remove(filepath)
+# ── Rutas para servir las fotos ────────────────────────────────────────────
 
+CACHE_FOTOS = 365 * 24 * 3600
+
+
+def _cache_inmutable(respuesta):
+    """
+    Los nombres son el hash del contenido: lo que sirve una URL nunca cambia. Privada
+    porque las fotos requieren sesión; send_file ya añade ETag y responde 304.
+    """
+    respuesta.cache_control.no_cache = None
+    respuesta.cache_control.private = True
+    respuesta.cache_control.max_age = CACHE_FOTOS
+    respuesta.cache_control.immutable = True
+    return respuesta
 
-# ── Ruta para servir las fotos ─────────────────────────────────────────────
 
 @avisos_bp.route('/uploads/<filename>')
 @login_required
 def uploaded_file(filename):
-    return send_from_directory(current_app.config['UPLOAD_FOLDER'], filename)
+    return _cache_inmutable(_enviar_original(filename))
 
 
-# ── Lista y búsqueda ───────────────────────────────────────────────────────
-
-@avisos_bp.route('/')
+@avisos_bp.route('/uploads/<int:tamano>/<filename>')
 @login_required
-def list_all():
-    q = request.args.get('q', '').strip()
-    estado_filter = request.args.get('estado', '')
-    page = request.args.get('page', 1, type=int)
+def foto_version(tamano, filename):
+    """Versión reducida, generada bajo demanda si aún no está en disco."""
+    if tamano not in TAMANOS:
+        abort(404)
+    ruta = obtener_version(filename, tamano)
+    if ruta is None:
+        # Formato que Pillow no abre (p. ej. HEIC): el original, sin caché
+        # larga por si más adelante se genera la versión
+        return _enviar_original(filename)
+    return _cache_inmutable(send_from_directory(os.path.dirname(ruta), os.path.basename(ruta)))
+
+
+@avisos_bp.route('/<int:id>/fotos/estado')
+@login_required
+def fotos_estado(id):
+    """Cuántas fotos del aviso siguen procesándose (lo consulta detail.html)."""
+    pendientes = Photo.query.filter_by(aviso_id=id, status='procesando').count()
+    return jsonify({'pendientes': pendientes})
 
-    query = Aviso.query
+
+# ── Lista y búsqueda ───────────────────────────────────────────────────────
+
+def _query_lista(q, estado_filter):
+    """Query de la lista de avisos con filtros de rol, búsqueda y estado."""
+    query = Aviso.query.options(*opciones_listado())
     # Técnicos solo ven sus avisos
     if not current_user.es_admin:
         query = query.filter(
@@ -74,60 +112,98 @@ def list_all():
         )
 
     if q:
-        like = f'%{q}%'
-        query = query.filter(
-            db.or_(
-                Aviso.nombre_cliente.ilike(like),
-                Aviso.telefono.ilike(like),
-                Aviso.calle.ilike(like),
-            )
-        )
+        query = buscar(query, q)
 
     if estado_filter:
         query = query.filter_by(estado=estado_filter)
 
-    avisos = query.order_by(Aviso.fecha_aviso.desc()).paginate(
-        page=page, per_page=current_app.config['ITEMS_PER_PAGE'], error_out=False
+    return query
+
+
+def _aviso_json(a):
+    return {
+        'id': a.id,
+        'nombre_cliente': a.nombre_cliente,
+        'telefono': a.telefono,
+        'calle': a.calle or '',
+        'electrodomestico': a.electrodomestico or '',
+        'estado': a.estado_label(),
+        'estado_class': a.estado_badge_class(),
+        'url': url_for('avisos.detail', id=a.id),
+    }
+
+
+@avisos_bp.route('/')
+@login_required
+def list_all():
+    q = request.args.get('q', '').strip()
+    estado_filter = request.args.get('estado', '')
+    after = request.args.get('after', '')
+
+    query = _query_lista(q, estado_filter)
+    avisos, siguiente = paginar_keyset(
+        query, [Aviso.fecha_aviso, Aviso.id], after,
+        current_app.config['ITEMS_PER_PAGE']
     )
 
+    # El total solo se cuenta en la primera página; las siguientes lo heredan
+    total = request.args.get('total', type=int)
+    if total is None:
+        total = query.order_by(None).count() if not after else None
+
     return render_template('avisos/list.html',
                            avisos=avisos,
+                           siguiente=siguiente,
+                           after=after,
+                           total=total,
                            q=q,
                            estado_filter=estado_filter,
                            estados=ESTADOS,
                            cobro_estados=COBRO_ESTADOS)
 
 
+@avisos_bp.route('/api/lista')
+@login_required
+def api_lista():
+    """Variante JSON de la lista, paginada por cursor. ?total=1 para incluir el total."""
+    q = request.args.get('q', '').strip()
+    estado_filter = request.args.get('estado', '')
+    query = _query_lista(q, estado_filter)
+
+    avisos, siguiente = paginar_keyset(
+        query, [Aviso.fecha_aviso, Aviso.id], request.args.get('after', ''),
+        current_app.config['ITEMS_PER_PAGE']
+    )
+    datos = {'avisos': [_aviso_json(a) for a in avisos], 'siguiente': siguiente}
+    if request.args.get('total'):
+        datos['total'] = query.order_by(None).count()
+    return jsonify(datos)
+
+
 # ── API búsqueda JSON ──────────────────────────────────────────────────────
 
 @avisos_bp.route('/api/search')
 @login_required
 def api_search():
+    """Autocompletado. El cursor de la página siguiente va en la cabecera X-Siguiente."""
     q = request.args.get('q', '').strip()
     if len(q) < 2:
         return jsonify([])
 
-    like = f'%{q}%'
-    resultados = Aviso.query.filter(
-        db.or_(
-            Aviso.nombre_cliente.ilike(like),
-            Aviso.telefono.ilike(like),
-            Aviso.calle.ilike(like),
+    query, rango = buscar_con_relevancia(Aviso.query, q)
+    if rango is not None:
+        resultados, siguiente = paginar_keyset(
+            query, [rango, Aviso.id], request.args.get('after', ''), 10, descendente=False
+        )
+    else:
+        resultados, siguiente = paginar_keyset(
+            query, [Aviso.fecha_aviso, Aviso.id], request.args.get('after', ''), 10
         )
-    ).order_by(Aviso.fecha_aviso.desc()).limit(10).all()
-
-    datos = [{
-        'id': a.id,
-        'nombre_cliente': a.nombre_cliente,
-        'telefono': a.telefono,
-        'calle': a.calle or '',
-        'electrodomestico': a.electrodomestico or '',
-        'estado': a.estado_label(),
-        'estado_class': a.estado_badge_class(),
-        'url': url_for('avisos.detail', id=a.id),
-    } for a in resultados]
 
-    return jsonify(datos)
+    resp = jsonify([_aviso_json(a) for a in resultados])
+    if siguiente:
+        resp.headers['X-Siguiente'] = siguiente
+    return resp
 
 
 # ── Detalle ────────────────────────────────────────────────────────────────
@@ -135,7 +211,9 @@ def api_search():
 @avisos_bp.route('/<int:id>')
 @login_required
 def detail(id):
-    aviso = Aviso.query.get_or_404(id)
+    aviso = Aviso.query.options(
+        selectinload(Aviso.photos), joinedload(Aviso.tecnico)
+    ).get_or_404(id)
     return render_template('avisos/detail.html',
                            aviso=aviso,
                            estados=ESTADOS)
@@ -162,7 +240,6 @@ def create():
             marca=request.form.get('marca', '').strip(),
             descripcion=request.form.get('descripcion', '').strip(),
             notas=request.form.get('notas', '').strip(),
-            estado=request.form.get('estado', 'pendiente'),
             created_by=current_user.id,
             precio_mano_obra=_float_or_none(request.form.get('precio_mano_obra', '')),
             coste_materiales=_float_or_none(request.form.get('coste_materiales', '')),
@@ -174,6 +251,8 @@ def create():
             asignado_a=request.form.get('asignado_a', type=int) or None,
         )
 
+        aviso.cambiar_estado(request.form.get('estado', 'pendiente'), current_user.id)
+
         fecha_aviso_str = request.form.get('fecha_aviso', '')
         fecha_cita_str = request.form.get('fecha_cita', '')
         if fecha_aviso_str:
@@ -184,6 +263,8 @@ def create():
             aviso.fecha_cita = datetime.strptime(fecha_cita_str, '%Y-%m-%d').date()
 
         if not aviso.nombre_cliente or not aviso.telefono:
+            if _pide_json():
+                return jsonify({'ok': False, 'error': 'El nombre del cliente y el teléfono son obligatorios.'}), 400
             flash('El nombre del cliente y el teléfono son obligatorios.', 'danger')
             tecnicos = User.query.filter_by(is_active=True).all()
             return render_template('avisos/form.html',
@@ -196,7 +277,8 @@ def create():
         db.session.add(aviso)
         db.session.flush()  # Para obtener el ID antes de guardar fotos
 
-        # Guardar fotos
+        # Fotos enviadas con el formulario (sin JavaScript; con él llegan por subir_foto)
+        nuevas = []
         files = request.files.getlist('photos')
         for f in files:
             if f and f.filename and allowed_file(f.filename):
@@ -208,10 +290,14 @@ def create():
                     uploaded_by=current_user.id,
                 )
                 db.session.add(photo)
+                nuevas.append(photo)
 
         db.session.commit()
+        procesar(nuevas)
         notificar_aviso_nuevo(aviso)
         flash(f'Aviso #{aviso.id} creado correctamente.', 'success')
+        if _pide_json():
+            return _aviso_guardado(aviso)
         return redirect(url_for('avisos.detail', id=aviso.id))
 
     tecnicos = User.query.filter_by(is_active=True).all()
@@ -239,7 +325,7 @@ def edit(id):
         aviso.marca = request.form.get('marca', '').strip()
         aviso.descripcion = request.form.get('descripcion', '').strip()
         aviso.notas = request.form.get('notas', '').strip()
-        aviso.estado = request.form.get('estado', aviso.estado)
+        aviso.cambiar_estado(request.form.get('estado', aviso.estado), current_user.id)
 
         def _float_or_none(val):
             try:
@@ -269,6 +355,8 @@ def edit(id):
             aviso.fecha_cita = None
 
         if not aviso.nombre_cliente or not aviso.telefono:
+            if _pide_json():
+                return jsonify({'ok': False, 'error': 'El nombre del cliente y el teléfono son obligatorios.'}), 400
             flash('El nombre del cliente y el teléfono son obligatorios.', 'danger')
             tecnicos = User.query.filter_by(is_active=True).all()
             return render_template('avisos/form.html',
@@ -278,7 +366,8 @@ def edit(id):
                                    electrodomesticos=ELECTRODOMESTICOS,
                                    tecnicos=tecnicos)
 
-        # Nuevas fotos
+        # Nuevas fotos (sin JavaScript; con él llegan por subir_foto)
+        nuevas = []
         files = request.files.getlist('photos')
         for f in files:
             if f and f.filename and allowed_file(f.filename):
@@ -290,9 +379,13 @@ def edit(id):
                     uploaded_by=current_user.id,
                 )
                 db.session.add(photo)
+                nuevas.append(photo)
 
         db.session.commit()
+        procesar(nuevas)
         flash('Aviso actualizado correctamente.', 'success')
+        if _pide_json():
+            return _aviso_guardado(aviso)
         return redirect(url_for('avisos.detail', id=aviso.id))
 
     tecnicos = User.query.filter_by(is_active=True).all()
@@ -316,7 +409,7 @@ def change_estado(id):
     estados_validos = [e[0] for e in ESTADOS]
     if nuevo_estado in estados_validos:
         estado_anterior = aviso.estado
-        aviso.estado = nuevo_estado
+        aviso.cambiar_estado(nuevo_estado, current_user.id)
         db.session.commit()
         notificar_cambio_estado(aviso, estado_anterior)
         return jsonify({'ok': True, 'estado': aviso.estado,
@@ -340,12 +433,12 @@ def duplicar(id):
         electrodomestico=original.electrodomestico,
         marca=original.marca,
         descripcion=original.descripcion,
-        estado='segunda_visita',
         fecha_aviso=date.today(),
         fecha_cita=None,
         notas=f'Segunda visita. Aviso original: #{original.id}',
         created_by=current_user.id,
     )
+    nuevo.cambiar_estado('segunda_visita', current_user.id)
     db.session.add(nuevo)
     db.session.commit()
     flash(f'Aviso duplicado como segunda visita (#{nuevo.id}).', 'success')
@@ -358,9 +451,7 @@ def duplicar(id):
 @login_required
 def eliminar(id):
     aviso = Aviso.query.get_or_404(id)
-    # Eliminar fotos del disco
-    for photo in aviso.photos:
-        delete_photo_file(photo.filename)
+    # Los archivos de las fotos los borra limpieza.py tras el commit
     db.session.delete(aviso)
     db.session.commit()
     flash(f'Aviso #{id} eliminado.', 'warning')
@@ -376,19 +467,76 @@ def delete_photo(aviso_id, photo_id):
     if photo.aviso_id != aviso_id:
         flash('Foto no encontrada en este aviso.', 'danger')
         return redirect(url_for('avisos.detail', id=aviso_id))
-    delete_photo_file(photo.filename)
     db.session.delete(photo)
     db.session.commit()
     flash('Foto eliminada.', 'info')
     return redirect(url_for('avisos.edit', id=aviso_id))
 
 
+# ── Subida de fotos por trozos ─────────────────────────────────────────────
+
+_CONTENT_RANGE = re.compile(r'^bytes (\d+)-(\d+)/(\d+)$')
+
+
+@avisos_bp.route('/<int:id>/fotos/upload', methods=['GET', 'POST'])
+@login_required
+def subir_foto(id):
+    """
+    Sube una foto en trozos que van directos a disco. Cada POST lleva un trozo
+    en el cuerpo con las cabeceras X-Upload-Id (32 hex elegidos por el
+    cliente), X-Filename y Content-Range: bytes inicio-fin/total.
+    GET ?upload_id= devuelve lo ya recibido para retomar tras un corte.
+    """
+    Aviso.query.get_or_404(id)
+    usuario_id = current_user.id
+    # Sin transacción abierta mientras llegan los bytes (SQLite bloquearía escrituras)
+    db.session.close()
+
+    upload_id = request.headers.get('X-Upload-Id') or request.args.get('upload_id', '')
+    ruta = ruta_subida(id, upload_id)
+    if ruta is None:
+        return jsonify({'ok': False, 'error': 'X-Upload-Id no válido'}), 400
+    if request.method == 'GET':
+        return jsonify({'ok': True, 'recibido': subida_recibido(ruta)})
+
+    nombre = unquote(request.headers.get('X-Filename', ''))
+    rango = _CONTENT_RANGE.match(request.headers.get('Content-Range', ''))
+    if not rango or not allowed_file(nombre):
+        return jsonify({'ok': False, 'error': 'Falta Content-Range o formato no permitido'}), 400
+    inicio, fin, total = map(int, rango.groups())
+    if total > current_app.config['FOTOS_MAX_BYTES']:
+        return jsonify({'ok': False, 'error': 'Foto demasiado grande'}), 413
+    if not inicio <= fin < total or request.content_length != fin - inicio + 1:
+        return jsonify({'ok': False, 'error': 'Content-Range no coincide con el cuerpo'}), 400
+
+    try:
+        recibido = subida_anadir(ruta, inicio, request.stream)
+        if recibido < total:
+            return jsonify({'ok': True, 'recibido': recibido})
+        filename = subida_completar(ruta, nombre.rsplit('.', 1)[1].lower())
+    except DesfaseSubida as e:
+        return jsonify({'ok': False, 'recibido': e.recibido}), 409
+    except SubidaOcupada:
+        return jsonify({'ok': False, 'error': 'Esta subida ya se está recibiendo'}), 409
+
+    photo = Photo(
+        aviso_id=id,
+        filename=filename,
+        original_name=nombre,
+        uploaded_by=usuario_id,
+    )
+    db.session.add(photo)
+    db.session.commit()
+    procesar([photo])
+    return jsonify({'ok': True, 'recibido': recibido, 'photo_id': photo.id}), 201
+
+
 # ── Historial cliente ──────────────────────────────────────────────────────
 
 @avisos_bp.route('/cliente/<telefono>')
 @login_required
 def customer_history(telefono):
-    avisos = Aviso.query.filter_by(
+    avisos = Aviso.query.options(*opciones_listado()).filter_by(
         telefono=telefono
     ).order_by(Aviso.fecha_aviso.desc()).all()
 
@@ -0,0 +1,101 @@
+"""
+Benchmark de la generación de versiones de las fotos: decodificación completa
+con exif_transpose + thumbnail (implementación anterior) frente a
+imagenes.generar_versiones, que decodifica el JPEG a escala con draft().
+
+Cada implementación se mide en un proceso nuevo para que el pico de memoria
+(RSS) sea solo suyo. Sin carpeta se generan fotos sintéticas de 4000×3000.
+
+  python benchmarks/bench_fotos.py [carpeta_con_fotos] [repeticiones]
+"""
+import multiprocessing
+import os
+import resource
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from PIL import Image, ImageOps  # noqa: E402
+
+import imagenes  # noqa: E402
+
+EXTENSIONES = ('.jpg', '.jpeg', '.png', '.webp')
+
+
+def _versiones_anterior(ruta, carpeta, nombre, tamanos=imagenes.TAMANOS):
+    """Implementación previa: decodifica el original entero antes de reducir."""
+    with Image.open(ruta) as img:
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ('RGB', 'L'):
+            img = img.convert('RGB')
+        for tamano in sorted(tamanos, reverse=True):
+            img.thumbnail((tamano, tamano), Image.LANCZOS)
+            destino = os.path.join(carpeta, imagenes.nombre_version(nombre, tamano))
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            img.save(destino, imagenes.FORMATO, **imagenes.OPCIONES)
+
+
+def _pico_rss_mb():
+    pico = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux lo da en KiB y macOS en bytes
+    return pico / 1024 / (1024 if sys.platform == 'darwin' else 1)
+
+
+def _medir(nombre_funcion, fotos, repeticiones):
+    """Se ejecuta en un proceso aparte: (ms por foto, pico de RSS en MiB)."""
+    funcion = {'anterior': _versiones_anterior,
+               'nuevo': imagenes.generar_versiones}[nombre_funcion]
+    with tempfile.TemporaryDirectory() as salida:
+        tiempos = []
+        for _ in range(repeticiones):
+            for ruta in fotos:
+                t0 = time.perf_counter()
+                funcion(ruta, salida, os.path.basename(ruta))
+                tiempos.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(tiempos), _pico_rss_mb()
+
+
+def _fotos_sinteticas(carpeta, n=8):
+    """JPEG de 4000×3000 con manchas suaves y algo de grano, y EXIF girado."""
+    fotos = []
+    for i in range(n):
+        manchas = Image.merge('RGB', [Image.effect_noise((80, 60), 90) for _ in range(3)])
+        grano = Image.effect_noise((4000, 3000), 12).convert('RGB')
+        img = Image.blend(manchas.resize((4000, 3000), Image.BICUBIC), grano, 0.15)
+        exif = Image.Exif()
+        exif[0x0112] = 6 if i % 2 else 1          # Orientation: 90° en la mitad
+        ruta = os.path.join(carpeta, f'sintetica{i}.jpg')
+        img.save(ruta, 'JPEG', quality=90, exif=exif)
+        fotos.append(ruta)
+    return fotos
+
+
+def main():
+    carpeta = sys.argv[1] if len(sys.argv) > 1 else None
+    repeticiones = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    with tempfile.TemporaryDirectory() as tmp:
+        contexto = multiprocessing.get_context('spawn')
+        if carpeta:
+            fotos = sorted(os.path.join(carpeta, f) for f in os.listdir(carpeta)
+                           if f.lower().endswith(EXTENSIONES))
+        else:
+            # También aparte: el proceso hijo arranca con el RSS del padre
+            with contexto.Pool(1) as pool:
+                fotos = pool.apply(_fotos_sinteticas, (tmp,))
+        print(f'{len(fotos)} fotos × {repeticiones}, versiones {imagenes.TAMANOS} en {imagenes.FORMATO}')
+
+        resultados = {}
+        for nombre in ('anterior', 'nuevo'):
+            with contexto.Pool(1) as pool:
+                resultados[nombre] = pool.apply(_medir, (nombre, fotos, repeticiones))
+            ms, rss = resultados[nombre]
+            print(f'  {nombre:9} {ms:8.1f} ms/foto   pico RSS {rss:7.1f} MiB')
+        print(f'  x{resultados["anterior"][0] / resultados["nuevo"][0]:.1f} más rápido')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Benchmark de /stats/api/resumen: seis consultas con extract() frente a una
+sola pasada con SUM(CASE ...) y rango de fechas.
+
+  python benchmarks/bench_resumen.py [num_avisos]
+"""
+import sys
+from datetime import date
+
+from datos import crear_app_temporal, generar_avisos, medir
+
+
+def _resumen_anterior(usuario, hoy):
+    """Implementación previa (3 COUNT + 3 SUM con extract month/year)."""
+    from sqlalchemy import func, extract
+    from extensions import db
+    from models import Aviso
+
+    filtro = ([] if usuario.es_admin else
+              [db.or_(Aviso.asignado_a == usuario.id, Aviso.created_by == usuario.id)])
+    base = Aviso.query.filter(*filtro)
+    expr_total = (func.coalesce(Aviso.precio_mano_obra, 0) +
+                  func.coalesce(Aviso.gastos_extra, 0) -
+                  func.coalesce(Aviso.descuento, 0))
+    mes = [extract('month', Aviso.updated_at) == hoy.month,
+           extract('year', Aviso.updated_at) == hoy.year]
+    r = {
+        'total_activos': base.filter(Aviso.estado != 'finalizado').count(),
+        'total_morosos': base.filter(Aviso.cobro_estado == 'moroso').count(),
+        'finalizados':   base.filter(Aviso.estado == 'finalizado').count(),
+    }
+    r['facturado_mes'] = db.session.query(func.sum(expr_total)).filter(
+        Aviso.estado == 'finalizado', *mes, *filtro).scalar() or 0.0
+    r['beneficio_mes'] = db.session.query(
+        func.sum(expr_total - func.coalesce(Aviso.coste_materiales, 0))
+    ).filter(Aviso.estado == 'finalizado', *mes, *filtro).scalar() or 0.0
+    r['pendiente_cobro'] = db.session.query(func.sum(expr_total)).filter(
+        Aviso.estado == 'finalizado', Aviso.cobro_estado == 'pendiente', *filtro).scalar() or 0.0
+    return {k: round(v, 2) for k, v in r.items()}
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 100_000
+    app = crear_app_temporal()
+    with app.app_context():
+        from models import User
+        from estadisticas import _resumen
+
+        generar_avisos(n)
+        hoy = date.today()
+        print(f'{n} avisos')
+        for usuario in (User.query.filter_by(username='admin').one(),
+                        User.query.filter_by(username='tecnico1').one()):
+            assert _resumen_anterior(usuario, hoy) == _resumen(usuario, hoy)
+            antes = medir(lambda: _resumen_anterior(usuario, hoy))
+            despues = medir(lambda: _resumen(usuario, hoy))
+            print(f'  {usuario.username:<10} antes {antes:8.1f} ms   '
+                  f'después {despues:8.1f} ms   x{antes / despues:.1f}')
+
+
+if __name__ == '__main__':
+    main()
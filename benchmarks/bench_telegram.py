@@ -0,0 +1,72 @@
+"""
+Benchmark del envío a Telegram contra un servidor HTTPS local (stub_telegram):
+urlopen con contexto SSL nuevo en cada mensaje (implementación anterior)
+frente a ClienteTelegram con contexto único y conexión keep-alive.
+
+  python benchmarks/bench_telegram.py [mensajes] [hilos]
+"""
+import json
+import os
+import ssl
+import sys
+import time
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stub_telegram import StubTelegram  # noqa: E402
+from telegram_bot import ClienteTelegram  # noqa: E402
+
+
+def _enviar_anterior(stub, texto):
+    """Implementación previa: contexto SSL y conexión TCP + TLS nuevos por mensaje."""
+    ctx = ssl.create_default_context()
+    ctx.load_verify_locations(stub.cert)
+    datos = urllib.parse.urlencode({'chat_id': '1', 'text': texto, 'parse_mode': 'HTML'}).encode()
+    req = urllib.request.Request(f'https://127.0.0.1:{stub.puerto}/botTOKEN/sendMessage',
+                                 data=datos, method='POST')
+    with urllib.request.urlopen(req, timeout=5, context=ctx) as resp:
+        return json.loads(resp.read()).get('ok', False)
+
+
+def _medir(funcion, n, hilos):
+    """Milisegundos por mensaje (mediana en serie, media de pared con hilos)."""
+    if hilos == 1:
+        import statistics
+        tiempos = []
+        for i in range(n):
+            t0 = time.perf_counter()
+            assert funcion(i)
+            tiempos.append((time.perf_counter() - t0) * 1000)
+        return statistics.median(tiempos)
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(hilos) as pool:
+        assert all(pool.map(funcion, range(n)))
+    return (time.perf_counter() - t0) * 1000 / n
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    hilos = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    with StubTelegram() as stub:
+        cliente = ClienteTelegram(host='127.0.0.1', port=stub.puerto,
+                                  contexto=stub.contexto_cliente(), max_libres=hilos)
+
+        def nuevo(i):
+            status, r = cliente.peticion('TOKEN', 'sendMessage',
+                                         {'chat_id': '1', 'text': f'm{i}', 'parse_mode': 'HTML'})
+            return r.get('ok', False)
+
+        print(f'{n} mensajes contra https://127.0.0.1:{stub.puerto}')
+        for h in (1, hilos):
+            antes = _medir(lambda i: _enviar_anterior(stub, f'm{i}'), n, h)
+            despues = _medir(nuevo, n, h)
+            print(f'  {h} hilo(s)  antes {antes:7.2f} ms/msg   '
+                  f'después {despues:7.2f} ms/msg   x{antes / despues:.1f}')
+        cliente.cerrar()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""
+Utilidades comunes de los benchmarks: app con base de datos temporal y
+generación de avisos sintéticos.
+"""
+import os
+import random
+import sys
+import tempfile
+from datetime import date, datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config  # noqa: E402
+
+
+def crear_app_temporal():
+    """App sobre una base de datos SQLite temporal (no toca instance/cadiz.db)."""
+    tmp = tempfile.mkdtemp(prefix='bench_')
+
+    class BenchConfig(Config):
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(tmp, 'bench.db')
+        UPLOAD_FOLDER = os.path.join(tmp, 'uploads')
+        # Sin hilos de fondo compitiendo por el mismo SQLite durante la medida
+        TELEGRAM_COLA_HILO = False
+        TELEGRAM_HILOS = 0
+
+    from app import create_app
+    return create_app(BenchConfig)
+
+
+def generar_avisos(n, tecnicos=tuple(range(2, 12)), semilla=42):
+    """Inserta n avisos repartidos en los últimos dos años. Requiere app context."""
+    from extensions import db
+    from models import Aviso, ESTADOS, COBRO_ESTADOS, ELECTRODOMESTICOS
+
+    rnd = random.Random(semilla)
+    estados = [e[0] for e in ESTADOS]
+    cobros = [c[0] for c in COBRO_ESTADOS]
+    hoy = date.today()
+    filas = []
+    for i in range(n):
+        fecha = hoy - timedelta(days=rnd.randint(0, 730))
+        actualizado = datetime.combine(fecha, datetime.min.time()) + timedelta(
+            days=rnd.randint(0, 20), minutes=rnd.randint(0, 1440))
+        estado = rnd.choice(estados)
+        filas.append({
+            'nombre_cliente': f'Cliente {i}',
+            'telefono': f'6{rnd.randint(10000000, 99999999)}',
+            'calle': f'Calle {rnd.randint(1, 500)}',
+            'electrodomestico': rnd.choice(ELECTRODOMESTICOS),
+            'estado': estado,
+            # Misma regla que la migración 8 para los ya finalizados
+            'fecha_finalizado': actualizado if estado == 'finalizado' else None,
+            'cobro_estado': rnd.choice(cobros),
+            'fecha_aviso': fecha,
+            'fecha_cita': fecha + timedelta(days=rnd.randint(0, 10)),
+            'precio_mano_obra': round(rnd.uniform(20, 200), 2),
+            'coste_materiales': round(rnd.uniform(0, 120), 2),
+            'gastos_extra': rnd.choice([None, 15.0, 30.0]),
+            'descuento': rnd.choice([None, None, 5.0]),
+            'asignado_a': rnd.choice(tecnicos),
+            'created_by': rnd.choice(tecnicos),
+            'created_at': actualizado,
+            'updated_at': actualizado,
+        })
+    db.session.execute(Aviso.__table__.insert(), filas)
+    db.session.commit()
+
+    # El insert masivo no pasa por los eventos del ORM: recalcular agregados
+    from rollups import reconstruir
+    with db.engine.begin() as conn:
+        reconstruir(conn)
+
+
+def medir(funcion, repeticiones=20):
+    """Mediana en milisegundos de `repeticiones` llamadas."""
+    import statistics
+    import time
+    tiempos = []
+    for _ in range(repeticiones):
+        t0 = time.perf_counter()
+        funcion()
+        tiempos.append((time.perf_counter() - t0) * 1000)
+    return statistics.median(tiempos)
@@ -0,0 +1,96 @@
+"""
+Servidor HTTPS local que imita la Bot API de Telegram, para benchmarks y
+pruebas manuales sin red. Usa un certificado autofirmado generado con el
+binario `openssl`.
+
+    with StubTelegram() as stub:
+        c = ClienteTelegram(host='127.0.0.1', port=stub.puerto, contexto=stub.contexto_cliente())
+        c.peticion('TOKEN', 'sendMessage', {'chat_id': 1, 'text': 'hola'})
+"""
+import json
+import os
+import shutil
+import ssl
+import subprocess
+import tempfile
+import threading
+import urllib.parse
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+def _certificado(directorio):
+    cert = os.path.join(directorio, 'cert.pem')
+    clave = os.path.join(directorio, 'clave.pem')
+    subprocess.run(
+        ['openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes', '-days', '1',
+         '-keyout', clave, '-out', cert, '-subj', '/CN=127.0.0.1',
+         '-addext', 'subjectAltName=IP:127.0.0.1'],
+        check=True, capture_output=True,
+    )
+    return cert, clave
+
+
+class _Manejador(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'   # keep-alive
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _responder(self):
+        longitud = int(self.headers.get('Content-Length') or 0)
+        datos = dict(urllib.parse.parse_qsl(self.rfile.read(longitud).decode()))
+        metodo = self.path.rsplit('/', 1)[-1].split('?')[0]
+        stub = self.server.stub
+        with stub.lock:
+            stub.peticiones.append((metodo, datos))
+        status, cuerpo = stub.responder(metodo, datos)
+        crudo = json.dumps(cuerpo).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(crudo)))
+        self.end_headers()
+        self.wfile.write(crudo)
+
+    do_GET = do_POST = _responder
+
+
+def respuesta_por_defecto(metodo, datos):
+    if metodo == 'getMe':
+        return 200, {'ok': True, 'result': {'id': 1, 'username': 'stub_bot'}}
+    if metodo == 'getUpdates':
+        return 200, {'ok': True, 'result': []}
+    return 200, {'ok': True, 'result': {'message_id': 1}}
+
+
+class StubTelegram:
+    """Servidor en un hilo; `responder(metodo, datos) -> (status, json)` es sustituible."""
+
+    def __init__(self, responder=respuesta_por_defecto):
+        self.responder = responder
+        self.peticiones = []
+        self.lock = threading.Lock()
+
+    def __enter__(self):
+        self._dir = tempfile.mkdtemp(prefix='stub_tg_')
+        self.cert, clave = _certificado(self._dir)
+        self._servidor = ThreadingHTTPServer(('127.0.0.1', 0), _Manejador)
+        self._servidor.daemon_threads = True
+        self._servidor.stub = self
+        ctx = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+        ctx.load_cert_chain(self.cert, clave)
+        self._servidor.socket = ctx.wrap_socket(self._servidor.socket, server_side=True)
+        self.puerto = self._servidor.server_address[1]
+        threading.Thread(target=self._servidor.serve_forever, daemon=True).start()
+        return self
+
+    def __exit__(self, *exc):
+        self._servidor.shutdown()
+        self._servidor.server_close()
+        shutil.rmtree(self._dir, ignore_errors=True)
+
+    def contexto_cliente(self):
+        """SSLContext de cliente que confía en el certificado del stub."""
+        ctx = ssl.create_default_context()
+        ctx.load_verify_locations(self.cert)
+        return ctx
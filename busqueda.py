@@ -0,0 +1,129 @@
+"""
+Búsqueda de avisos por texto libre.
+
+Con SQLite + FTS5 se mantiene una tabla virtual `aviso_fts` (contenido externo
+sobre `aviso`) sincronizada por triggers, con búsqueda por prefijo y ranking
+bm25. Si FTS5 no está disponible se recurre a ILIKE sobre las mismas columnas.
+
+Todos los buscadores (lista, autocompletado, exportación y bot) pasan por
+`buscar()`.
+"""
+import logging
+import re
+
+from flask import current_app
+from sqlalchemy import text, func, select, table, column, literal_column
+
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+FTS_TABLA = 'aviso_fts'
+FTS_COLUMNAS = ('nombre_cliente', 'telefono', 'calle', 'localidad',
+                'marca', 'descripcion', 'notas')
+# Peso bm25 por columna (mismo orden que FTS_COLUMNAS)
+FTS_PESOS = (10.0, 10.0, 5.0, 2.0, 2.0, 1.0, 1.0)
+
+_fts = table(FTS_TABLA, column('rowid'))
+
+
+def _sql_triggers():
+    cols = ', '.join(FTS_COLUMNAS)
+    new_vals = ', '.join(f'new.{c}' for c in FTS_COLUMNAS)
+    old_vals = ', '.join(f'old.{c}' for c in FTS_COLUMNAS)
+    borrar = (f"INSERT INTO {FTS_TABLA}({FTS_TABLA}, rowid, {cols}) "
+              f"VALUES ('delete', old.id, {old_vals});")
+    insertar = f"INSERT INTO {FTS_TABLA}(rowid, {cols}) VALUES (new.id, {new_vals});"
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLA}_ai AFTER INSERT ON aviso BEGIN {insertar} END",
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLA}_ad AFTER DELETE ON aviso BEGIN {borrar} END",
+        # Solo se reindexa si cambia alguna columna de texto (no en cambios de estado)
+        f"CREATE TRIGGER IF NOT EXISTS {FTS_TABLA}_au AFTER UPDATE OF {cols} ON aviso "
+        f"BEGIN {borrar} {insertar} END",
+    ]
+
+
+def crear_indice_fts(conn):
+    """
+    Crea la tabla FTS5 y sus triggers y la rellena con los avisos existentes.
+    Se ejecuta como paso de migración; si FTS5 no está disponible no hace nada.
+    """
+    if conn.dialect.name != 'sqlite':
+        return False
+    try:
+        with conn.begin_nested():
+            conn.execute(text(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {FTS_TABLA} USING fts5("
+                f"{', '.join(FTS_COLUMNAS)}, content='aviso', content_rowid='id', "
+                f"tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+            ))
+    except Exception as e:
+        logger.warning(f'FTS5 no disponible, se usará ILIKE: {e}')
+        return False
+    for sql in _sql_triggers():
+        conn.execute(text(sql))
+    conn.execute(text(f"INSERT INTO {FTS_TABLA}({FTS_TABLA}) VALUES ('rebuild')"))
+    return True
+
+
+def fts_disponible():
+    """Si existe la tabla FTS5 (se consulta una vez por proceso)."""
+    disponible = current_app.extensions.get('busqueda_fts')
+    if disponible is None:
+        disponible = db.engine.dialect.name == 'sqlite' and db.session.execute(text(
+            "SELECT 1 FROM sqlite_master WHERE type='table' AND name=:n"
+        ), {'n': FTS_TABLA}).first() is not None
+        current_app.extensions['busqueda_fts'] = disponible
+    return disponible
+
+
+def _terminos(texto):
+    """Palabras del texto con al menos un carácter alfanumérico."""
+    return [t for t in texto.split() if re.search(r'\w', t)]
+
+
+def _expresion_fts(terminos):
+    """Cada término entre comillas y con prefijo: 'garc 956' → '"garc"* "956"*'."""
+    return ' '.join('"{}"*'.format(t.replace('"', '""')) for t in terminos)
+
+
+def buscar_con_relevancia(query, texto):
+    """
+    Como buscar(), pero devuelve (query, rango) sin ordenar: `rango` es la
+    expresión bm25 (menor = más relevante) o None si no hay FTS5 o texto.
+    Permite ordenar o paginar por relevancia desde fuera.
+    """
+    from models import Aviso
+
+    terminos = _terminos(texto or '')
+    if not terminos:
+        return query, None
+
+    if fts_disponible():
+        match = text(f'{FTS_TABLA} MATCH :fts_q').bindparams(fts_q=_expresion_fts(terminos))
+        rango = func.bm25(literal_column(FTS_TABLA), *FTS_PESOS)
+        return query.join(_fts, _fts.c.rowid == Aviso.id).filter(match), rango
+
+    # Fallback: cada término debe aparecer en alguna de las columnas
+    for t in terminos:
+        like = f'%{t}%'
+        query = query.filter(db.or_(*[getattr(Aviso, c).ilike(like) for c in FTS_COLUMNAS]))
+    return query, None
+
+
+def buscar(query, texto, por_relevancia=False):
+    """
+    Filtra `query` (sobre Aviso) por el texto buscado.
+    Con por_relevancia=True ordena por bm25 (o deja el orden tal cual si no hay FTS5).
+    """
+    from models import Aviso
+
+    if por_relevancia:
+        query, rango = buscar_con_relevancia(query, texto)
+        return query.order_by(rango) if rango is not None else query
+
+    terminos = _terminos(texto or '')
+    if terminos and fts_disponible():
+        match = text(f'{FTS_TABLA} MATCH :fts_q').bindparams(fts_q=_expresion_fts(terminos))
+        return query.filter(Aviso.id.in_(select(_fts.c.rowid).where(match)))
+    return buscar_con_relevancia(query, texto)[0]
@@ -11,3 +11,21 @@ class Config:
     MAX_CONTENT_LENGTH = 16 * 1024 * 1024  # 16 MB max por peticion
     ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'webp', 'heic'}
     ITEMS_PER_PAGE = 25
+    # Hilos de Telegram dentro del proceso web: el que vacía la cola de
+    # mensajes y los que ejecutan los comandos recibidos por el webhook.
+    # Apagados por defecto: bajo uWSGI (PythonAnywhere) la app no corre hilos
+    # y de eso se encarga `flask telegram-worker` como tarea siempre activa.
+    TELEGRAM_COLA_HILO = os.environ.get('TELEGRAM_COLA_HILO', '0') == '1'
+    TELEGRAM_HILOS = int(os.environ.get('TELEGRAM_HILOS', '0'))
+    # Procesos que generan las versiones de las fotos (0 = en la propia petición)
+    FOTOS_PROCESOS = int(os.environ.get('FOTOS_PROCESOS', '2'))
+    # Subida de fotos por trozos (/avisos/<id>/fotos/upload): tamaño de cada
+    # trozo que envía el navegador y máximo por foto
+    SUBIDA_TROZO = 1024 * 1024
+    FOTOS_MAX_BYTES = 50 * 1024 * 1024
+
+
+class ConfigDesarrollo(Config):
+    """`python app.py`: un único proceso que atiende Telegram con sus propios hilos."""
+    TELEGRAM_COLA_HILO = os.environ.get('TELEGRAM_COLA_HILO', '1') == '1'
+    TELEGRAM_HILOS = int(os.environ.get('TELEGRAM_HILOS', '2'))
@@ -1,9 +1,10 @@
 import os
 from datetime import date, timedelta
-from flask import Blueprint, render_template, request, jsonify, current_app
+from flask import Blueprint, render_template, request, jsonify
 from flask_login import login_required, current_user
+from sqlalchemy import func, case
 from extensions import db
-from models import Aviso
+from models import Aviso, opciones_listado
 from telegram_bot import diagnosticar, enviar_mensaje, notificar_resumen_dia, notificar_material_pendiente
 
 dashboard_bp = Blueprint('dashboard', __name__)
@@ -11,35 +12,41 @@ dashboard_bp = Blueprint('dashboard', __name__)
 
 def _base_query():
     """Query base filtrada por rol del usuario actual."""
-    q = Aviso.query
+    q = Aviso.query.options(*opciones_listado())
     if not current_user.es_admin:
         q = q.filter(db.or_(Aviso.asignado_a == current_user.id,
                              Aviso.created_by == current_user.id))
     return q
 
 
+def _contadores(hoy):
+    """Todos los contadores del panel en una sola consulta (SUM(CASE ...))."""
+    proximos_dias = hoy + timedelta(days=7)
+    activo = Aviso.estado != 'finalizado'
+
+    def _contar(*condiciones):
+        return func.coalesce(func.sum(case((db.and_(*condiciones), 1), else_=0)), 0)
+
+    q = db.session.query(
+        _contar(Aviso.fecha_cita == hoy, activo).label('hoy'),
+        _contar(Aviso.estado == 'esperando_material').label('material'),
+        _contar(Aviso.estado == 'pendiente').label('pendientes'),
+        _contar(Aviso.fecha_cita > hoy, Aviso.fecha_cita <= proximos_dias, activo).label('proximas'),
+        _contar(Aviso.estado == 'segunda_visita').label('segunda_visita'),
+        _contar(activo).label('total'),
+    )
+    if not current_user.es_admin:
+        q = q.filter(db.or_(Aviso.asignado_a == current_user.id,
+                            Aviso.created_by == current_user.id))
+    return dict(q.one()._mapping)
+
+
 @dashboard_bp.route('/')
 @login_required
 def index():
     hoy = date.today()
-    proximos_dias = hoy + timedelta(days=7)
-    bq = _base_query()
-
-    contadores = {
-        'hoy': bq.filter(
-            Aviso.fecha_cita == hoy,
-            Aviso.estado != 'finalizado'
-        ).count(),
-        'material': bq.filter(Aviso.estado == 'esperando_material').count(),
-        'pendientes': bq.filter(Aviso.estado == 'pendiente').count(),
-        'proximas': bq.filter(
-            Aviso.fecha_cita > hoy,
-            Aviso.fecha_cita <= proximos_dias,
-            Aviso.estado != 'finalizado'
-        ).count(),
-        'segunda_visita': bq.filter(Aviso.estado == 'segunda_visita').count(),
-        'total': bq.filter(Aviso.estado != 'finalizado').count(),
-    }
+
+    contadores = _contadores(hoy)
 
     avisos_hoy = _base_query().filter(
         Aviso.fecha_cita == hoy,
@@ -57,6 +64,13 @@ def index():
                            hoy=hoy)
 
 
+@dashboard_bp.route('/dashboard/api/contadores')
+@login_required
+def api_contadores():
+    """Contadores del panel en JSON, para refrescarlos sin recargar la página."""
+    return jsonify(_contadores(date.today()))
+
+
 @dashboard_bp.route('/dashboard/hoy')
 @login_required
 def hoy():
@@ -131,8 +145,10 @@ def finalizados():
 @dashboard_bp.route('/dashboard/telegram')
 @login_required
 def telegram_ajustes():
+    from telegram_commands import metricas, LIMITES_MS
     estado = diagnosticar()
-    return render_template('dashboard/telegram.html', estado=estado)
+    return render_template('dashboard/telegram.html', estado=estado,
+                           metricas=metricas(), limites_ms=LIMITES_MS)
 
 
 @dashboard_bp.route('/dashboard/telegram/test', methods=['POST'])
@@ -180,9 +196,12 @@ def telegram_webhook():
     if secret_env and token_header != secret_env:
         return jsonify({'ok': False}), 403
 
+    # Se guarda y se responde al momento; los comandos van al pool de hilos.
+    # Un update reenviado por Telegram (mismo update_id) se ignora.
     update = request.get_json(silent=True) or {}
     if update:
-        from telegram_commands import procesar_update
-        procesar_update(update, current_app._get_current_object())
+        from telegram_entrada import registrar_update, despachar
+        if registrar_update(update):
+            despachar()
 
     return jsonify({'ok': True})
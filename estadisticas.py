@@ -1,9 +1,9 @@
-from datetime import date, timedelta
-from flask import Blueprint, render_template, jsonify
+from datetime import date, datetime, timedelta
+from flask import Blueprint, render_template, jsonify, request
 from flask_login import login_required, current_user
-from sqlalchemy import func, extract
+from sqlalchemy import func, extract, case
 from extensions import db
-from models import Aviso, User
+from models import Aviso, User, StatsDiario
 
 estadisticas_bp = Blueprint('estadisticas', __name__, url_prefix='/stats')
 
@@ -14,113 +14,92 @@ def index():
     return render_template('estadisticas/index.html')
 
 
+def _filtro_tecnico(usuario):
+    """Filtro por técnico (asignado o creador) salvo para administradores."""
+    if usuario.es_admin:
+        return []
+    return [db.or_(Aviso.asignado_a == usuario.id,
+                   Aviso.created_by == usuario.id)]
+
+
+def _rango_mes(hoy):
+    """[primer día del mes, primer día del mes siguiente) como datetimes."""
+    inicio = datetime(hoy.year, hoy.month, 1)
+    if hoy.month == 12:
+        return inicio, datetime(hoy.year + 1, 1, 1)
+    return inicio, datetime(hoy.year, hoy.month + 1, 1)
+
+
+def _resumen(usuario, hoy):
+    """Todo el resumen en un solo recorrido con SUM(CASE ...)."""
+    inicio_mes, inicio_sig = _rango_mes(hoy)
+
+    # total_cliente = mano_obra + gastos_extra - descuento
+    expr_total = (
+        func.coalesce(Aviso.precio_mano_obra, 0) +
+        func.coalesce(Aviso.gastos_extra, 0) -
+        func.coalesce(Aviso.descuento, 0)
+    )
+    expr_beneficio = expr_total - func.coalesce(Aviso.coste_materiales, 0)
+    finalizado = Aviso.estado == 'finalizado'
+    finalizado_mes = db.and_(finalizado,
+                             Aviso.fecha_finalizado >= inicio_mes,
+                             Aviso.fecha_finalizado < inicio_sig)
+
+    def _sumar_si(condicion, valor=1):
+        return func.coalesce(func.sum(case((condicion, valor), else_=0)), 0)
+
+    fila = db.session.query(
+        _sumar_si(Aviso.estado != 'finalizado').label('total_activos'),
+        _sumar_si(Aviso.cobro_estado == 'moroso').label('total_morosos'),
+        _sumar_si(finalizado).label('finalizados'),
+        _sumar_si(finalizado_mes, expr_total).label('facturado_mes'),
+        _sumar_si(finalizado_mes, expr_beneficio).label('beneficio_mes'),
+        _sumar_si(db.and_(finalizado, Aviso.cobro_estado == 'pendiente'),
+                  expr_total).label('pendiente_cobro'),
+    ).filter(*_filtro_tecnico(usuario)).one()
+
+    return {
+        'total_activos':    fila.total_activos,
+        'total_morosos':    fila.total_morosos,
+        'finalizados':      fila.finalizados,
+        'facturado_mes':    round(float(fila.facturado_mes), 2),
+        'beneficio_mes':    round(float(fila.beneficio_mes), 2),
+        'pendiente_cobro':  round(float(fila.pendiente_cobro), 2),
+    }
+
+
 @estadisticas_bp.route('/api/resumen')
 @login_required
 def api_resumen():
     """Resumen general: totales, morosos, facturación del mes."""
-    hoy = date.today()
-    mes = hoy.month
-    anio = hoy.year
-
-    # Filtrar por técnico si no es admin
-    base = Aviso.query
-    if not current_user.es_admin:
-        base = base.filter(
-            db.or_(Aviso.asignado_a == current_user.id,
-                   Aviso.created_by == current_user.id)
-        )
-
-    total_activos  = base.filter(Aviso.estado != 'finalizado').count()
-    total_morosos  = base.filter(Aviso.cobro_estado == 'moroso').count()
-    finalizados    = base.filter(Aviso.estado == 'finalizado').count()
-
-    # Facturación mes actual (total_cliente = mano_obra + gastos_extra - descuento)
-    facturado_mes = db.session.query(
-        func.sum(
-            (func.coalesce(Aviso.precio_mano_obra, 0) +
-             func.coalesce(Aviso.gastos_extra, 0) -
-             func.coalesce(Aviso.descuento, 0))
-        )
-    ).filter(
-        Aviso.estado == 'finalizado',
-        extract('month', Aviso.updated_at) == mes,
-        extract('year',  Aviso.updated_at) == anio,
-        *([db.or_(Aviso.asignado_a == current_user.id,
-                  Aviso.created_by == current_user.id)]
-          if not current_user.es_admin else [])
-    ).scalar() or 0.0
-
-    beneficio_mes = db.session.query(
-        func.sum(
-            (func.coalesce(Aviso.precio_mano_obra, 0) +
-             func.coalesce(Aviso.gastos_extra, 0) -
-             func.coalesce(Aviso.descuento, 0) -
-             func.coalesce(Aviso.coste_materiales, 0))
-        )
-    ).filter(
-        Aviso.estado == 'finalizado',
-        extract('month', Aviso.updated_at) == mes,
-        extract('year',  Aviso.updated_at) == anio,
-        *([db.or_(Aviso.asignado_a == current_user.id,
-                  Aviso.created_by == current_user.id)]
-          if not current_user.es_admin else [])
-    ).scalar() or 0.0
-
-    pendiente_cobro = db.session.query(
-        func.sum(
-            func.coalesce(Aviso.precio_mano_obra, 0) +
-            func.coalesce(Aviso.gastos_extra, 0) -
-            func.coalesce(Aviso.descuento, 0)
-        )
-    ).filter(
-        Aviso.estado == 'finalizado',
-        Aviso.cobro_estado == 'pendiente',
-        *([db.or_(Aviso.asignado_a == current_user.id,
-                  Aviso.created_by == current_user.id)]
-          if not current_user.es_admin else [])
-    ).scalar() or 0.0
-
-    return jsonify({
-        'total_activos':    total_activos,
-        'total_morosos':    total_morosos,
-        'finalizados':      finalizados,
-        'facturado_mes':    round(facturado_mes, 2),
-        'beneficio_mes':    round(beneficio_mes, 2),
-        'pendiente_cobro':  round(pendiente_cobro, 2),
-    })
+    return jsonify(_resumen(current_user, date.today()))
 
 
 @estadisticas_bp.route('/api/ingresos/<periodo>')
 @login_required
 def api_ingresos(periodo):
-    """Ingresos agrupados por día (30d), semana (8sem) o mes (12m)."""
+    """Ingresos agrupados por día (30d), semana (8sem) o mes (12m), desde stats_diario."""
     hoy = date.today()
 
     filtro_tecnico = (
         [] if current_user.es_admin
-        else [db.or_(Aviso.asignado_a == current_user.id,
-                     Aviso.created_by == current_user.id)]
+        else [StatsDiario.tecnico_id == current_user.id]
     )
-
-    expr_total = (
-        func.coalesce(Aviso.precio_mano_obra, 0) +
-        func.coalesce(Aviso.gastos_extra, 0) -
-        func.coalesce(Aviso.descuento, 0)
+    agregados = (
+        func.sum(StatsDiario.total_cliente).label('total'),
+        func.sum(StatsDiario.beneficio).label('beneficio'),
+        func.sum(StatsDiario.num).label('num'),
     )
-    expr_beneficio = expr_total - func.coalesce(Aviso.coste_materiales, 0)
 
     if periodo == 'dia':
         inicio = hoy - timedelta(days=29)
         rows = db.session.query(
-            func.date(Aviso.updated_at).label('periodo'),
-            func.sum(expr_total).label('total'),
-            func.sum(expr_beneficio).label('beneficio'),
-            func.count(Aviso.id).label('num'),
+            StatsDiario.dia.label('periodo'), *agregados
         ).filter(
-            Aviso.estado == 'finalizado',
-            Aviso.updated_at >= inicio,
+            StatsDiario.dia >= inicio,
             *filtro_tecnico
-        ).group_by(func.date(Aviso.updated_at)).order_by('periodo').all()
+        ).group_by(StatsDiario.dia).order_by('periodo').all()
 
         labels = [(inicio + timedelta(days=i)).strftime('%d/%m') for i in range(30)]
         data_map = {r.periodo: (r.total or 0, r.beneficio or 0, r.num) for r in rows}
@@ -128,8 +107,7 @@ def api_ingresos(periodo):
         beneficios = []
         nums      = []
         for i in range(30):
-            d = (inicio + timedelta(days=i)).strftime('%Y-%m-%d')
-            v = data_map.get(d, (0, 0, 0))
+            v = data_map.get(inicio + timedelta(days=i), (0, 0, 0))
             totales.append(round(v[0], 2))
             beneficios.append(round(v[1], 2))
             nums.append(v[2])
@@ -137,14 +115,11 @@ def api_ingresos(periodo):
     elif periodo == 'semana':
         inicio = hoy - timedelta(weeks=7)
         rows = db.session.query(
-            extract('year',  Aviso.updated_at).label('anio'),
-            extract('week',  Aviso.updated_at).label('semana'),
-            func.sum(expr_total).label('total'),
-            func.sum(expr_beneficio).label('beneficio'),
-            func.count(Aviso.id).label('num'),
+            extract('year',  StatsDiario.dia).label('anio'),
+            extract('week',  StatsDiario.dia).label('semana'),
+            *agregados
         ).filter(
-            Aviso.estado == 'finalizado',
-            Aviso.updated_at >= inicio,
+            StatsDiario.dia >= inicio,
             *filtro_tecnico
         ).group_by('anio', 'semana').order_by('anio', 'semana').all()
 
@@ -160,14 +135,11 @@ def api_ingresos(periodo):
 
     else:  # mes
         rows = db.session.query(
-            extract('year',  Aviso.updated_at).label('anio'),
-            extract('month', Aviso.updated_at).label('mes'),
-            func.sum(expr_total).label('total'),
-            func.sum(expr_beneficio).label('beneficio'),
-            func.count(Aviso.id).label('num'),
+            extract('year',  StatsDiario.dia).label('anio'),
+            extract('month', StatsDiario.dia).label('mes'),
+            *agregados
         ).filter(
-            Aviso.estado == 'finalizado',
-            Aviso.updated_at >= hoy - timedelta(days=365),
+            StatsDiario.dia >= hoy - timedelta(days=365),
             *filtro_tecnico
         ).group_by('anio', 'mes').order_by('anio', 'mes').all()
 
@@ -235,36 +207,78 @@ def api_morosos():
     return jsonify(resultado)
 
 
+def fecha_arg(nombre):
+    """Fecha YYYY-MM-DD de la query string, o None si falta o no es válida."""
+    valor = request.args.get(nombre, '')
+    try:
+        return datetime.strptime(valor, '%Y-%m-%d').date() if valor else None
+    except ValueError:
+        return None
+
+
+def estadisticas_por_tecnico(desde=None, hasta=None):
+    """
+    Métricas de todos los técnicos en una sola consulta GROUP BY asignado_a.
+    Devuelve {user_id: {total, activos, finalizados, morosos, facturado}}.
+    `desde`/`hasta` (incluidos) acotan por fecha_aviso.
+    """
+    expr_total = (
+        func.coalesce(Aviso.precio_mano_obra, 0) +
+        func.coalesce(Aviso.gastos_extra, 0) -
+        func.coalesce(Aviso.descuento, 0)
+    )
+    finalizado = Aviso.estado == 'finalizado'
+
+    def _sumar_si(condicion, valor=1):
+        return func.coalesce(func.sum(case((condicion, valor), else_=0)), 0)
+
+    q = db.session.query(
+        Aviso.asignado_a,
+        func.count(Aviso.id).label('total'),
+        _sumar_si(Aviso.estado != 'finalizado').label('activos'),
+        _sumar_si(finalizado).label('finalizados'),
+        _sumar_si(Aviso.cobro_estado == 'moroso').label('morosos'),
+        _sumar_si(finalizado, expr_total).label('facturado'),
+    ).filter(Aviso.asignado_a.isnot(None))
+    if desde:
+        q = q.filter(Aviso.fecha_aviso >= desde)
+    if hasta:
+        q = q.filter(Aviso.fecha_aviso <= hasta)
+
+    return {
+        r.asignado_a: {
+            'total':       r.total,
+            'activos':     r.activos,
+            'finalizados': r.finalizados,
+            'morosos':     r.morosos,
+            'facturado':   round(float(r.facturado), 2),
+        }
+        for r in q.group_by(Aviso.asignado_a).all()
+    }
+
+
+STATS_TECNICO_VACIAS = {'total': 0, 'activos': 0, 'finalizados': 0,
+                        'morosos': 0, 'facturado': 0.0}
+
+
 @estadisticas_bp.route('/api/tecnicos')
 @login_required
 def api_tecnicos():
-    """Rendimiento por técnico (solo admin)."""
+    """Rendimiento por técnico (solo admin). Acepta ?desde=&hasta= (YYYY-MM-DD)."""
     if not current_user.es_admin:
         return jsonify({'error': 'Solo administradores'}), 403
 
+    stats = estadisticas_por_tecnico(fecha_arg('desde'), fecha_arg('hasta'))
     tecnicos = User.query.filter_by(is_active=True).all()
     resultado = []
     for t in tecnicos:
-        activos     = Aviso.query.filter_by(asignado_a=t.id).filter(Aviso.estado != 'finalizado').count()
-        finalizados = Aviso.query.filter_by(asignado_a=t.id, estado='finalizado').count()
-        morosos     = Aviso.query.filter_by(asignado_a=t.id, cobro_estado='moroso').count()
-
-        expr_total = (
-            func.coalesce(Aviso.precio_mano_obra, 0) +
-            func.coalesce(Aviso.gastos_extra, 0) -
-            func.coalesce(Aviso.descuento, 0)
-        )
-        facturado = db.session.query(func.sum(expr_total)).filter(
-            Aviso.asignado_a == t.id,
-            Aviso.estado == 'finalizado'
-        ).scalar() or 0.0
-
+        s = stats.get(t.id, STATS_TECNICO_VACIAS)
         resultado.append({
             'nombre':       t.display_name,
-            'activos':      activos,
-            'finalizados':  finalizados,
-            'morosos':      morosos,
-            'facturado':    round(facturado, 2),
+            'activos':      s['activos'],
+            'finalizados':  s['finalizados'],
+            'morosos':      s['morosos'],
+            'facturado':    s['facturado'],
         })
 
     resultado.sort(key=lambda x: x['facturado'], reverse=True)
@@ -13,7 +13,7 @@ from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_RIGHT, TA_LEFT
 
 from models import Aviso, ESTADOS
-from extensions import db
+from busqueda import buscar
 
 exports_bp = Blueprint('exports', __name__, url_prefix='/export')
 
@@ -32,14 +32,7 @@ def export_excel():
         query = query.filter_by(estado=estado_filter)
 
     if q:
-        like = f'%{q}%'
-        query = query.filter(
-            db.or_(
-                Aviso.nombre_cliente.ilike(like),
-                Aviso.telefono.ilike(like),
-                Aviso.calle.ilike(like),
-            )
-        )
+        query = buscar(query, q)
 
     avisos = query.order_by(Aviso.fecha_aviso.desc()).all()
 
@@ -0,0 +1,397 @@
+"""
+Fotos de los avisos.
+
+Durante la petición solo se copia el original a disco; las versiones
+reducidas (imagenes.TAMANOS) se generan en un pool de procesos. Photo.status
+pasa de 'procesando' a 'lista', o a 'error' si Pillow no puede abrir el
+archivo (p. ej. HEIC); mientras tanto las plantillas muestran un marcador.
+
+Los archivos se guardan por contenido: el nombre es el SHA-256 y viven en
+subcarpetas por prefijo (`ab/cd/abcd….jpg`, y `320/ab/cd/abcd….webp` las
+versiones). Una foto repetida no ocupa disco otra vez; el archivo se borra
+cuando ya no lo referencia ninguna Photo.
+
+El formulario sube cada foto aparte y por trozos (subida_* más abajo), así
+que se pueden retomar tras un corte y nunca están enteras en memoria.
+
+Si el proceso web se reinicia con fotos a medias:
+  flask --app app fotos-procesar
+Para pasar las fotos antiguas (nombre uuid en la carpeta raíz) al nuevo esquema:
+  flask --app app fotos-migrar
+"""
+import hashlib
+import logging
+import multiprocessing
+import os
+import re
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from werkzeug.security import safe_join
+
+from extensions import db
+from imagenes import TAMANOS, EXTENSION, EXTENSIONES_WEB, generar_versiones, nombre_version
+from models import Photo
+
+logger = logging.getLogger(__name__)
+
+BLOQUE = 1024 * 1024
+CARPETA_SUBIDAS = '.subidas'      # dentro de UPLOAD_FOLDER (mismo disco: os.replace)
+CADUCIDAD_SUBIDAS = 24 * 3600     # las subidas a medias más antiguas se descartan
+_ID_SUBIDA = re.compile(r'^[0-9a-f]{32}$')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+# ── Almacenamiento por contenido ──────────────────────────────────────────
+
+def relativa(filename):
+    """'abcd12….jpg' → 'ab/cd/abcd12….jpg' (ruta dentro de UPLOAD_FOLDER)."""
+    return os.path.join(filename[:2], filename[2:4], filename)
+
+
+def _colocar(temporal, ruta):
+    """
+    Mueve `temporal` a `ruta`, o lo descarta si ese contenido ya estaba. Al
+    reutilizar el archivo se le pone la hora actual: el barrido de
+    limpieza.py respeta los recientes, así que no lo borra mientras se
+    confirma la Photo nueva que lo usa.
+    """
+    try:
+        os.utime(ruta)
+    except FileNotFoundError:
+        os.makedirs(os.path.dirname(ruta), exist_ok=True)
+        os.replace(temporal, ruta)
+    else:
+        os.remove(temporal)
+
+
+def _guardar_por_contenido(origen, carpeta, ext):
+    """
+    Copia el flujo `origen` a un temporal calculando el SHA-256 y lo mueve a
+    su ruta definitiva, o lo descarta si ese contenido ya estaba guardado.
+    """
+    sha = hashlib.sha256()
+    fd, temporal = tempfile.mkstemp(dir=carpeta, suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as destino:
+            for bloque in iter(lambda: origen.read(BLOQUE), b''):
+                sha.update(bloque)
+                destino.write(bloque)
+        nombre = f'{sha.hexdigest()}.{ext}'
+        _colocar(temporal, os.path.join(carpeta, relativa(nombre)))
+    except BaseException:
+        if os.path.exists(temporal):
+            os.remove(temporal)
+        raise
+    return nombre
+
+
+def guardar_original(file_obj):
+    """Guarda el archivo subido tal cual. Devuelve el nombre (hash + extensión)."""
+    ext = file_obj.filename.rsplit('.', 1)[1].lower()
+    return _guardar_por_contenido(file_obj.stream, current_app.config['UPLOAD_FOLDER'], ext)
+
+
+def ruta_original(filename):
+    """
+    Ruta absoluta del original, o None si el nombre no es válido. Las fotos
+    que aún no pasaron por `fotos-migrar` siguen en la raíz de la carpeta.
+    """
+    carpeta = current_app.config['UPLOAD_FOLDER']
+    ruta = safe_join(carpeta, relativa(filename))
+    if ruta is None or os.path.exists(ruta):
+        return ruta
+    plana = safe_join(carpeta, filename)
+    return plana if plana and os.path.exists(plana) else ruta
+
+
+def _rutas_version(nombre, tamano):
+    """Rutas posibles de una versión: recodificada o el original enlazado tal cual."""
+    carpeta = current_app.config['UPLOAD_FOLDER']
+    extensiones = [EXTENSION] + [e for e in EXTENSIONES_WEB.values() if e != EXTENSION]
+    return [os.path.join(carpeta, nombre_version(nombre, tamano, e)) for e in extensiones]
+
+
+def ruta_version(filename, tamano):
+    """La versión que exista en disco, o la ruta recodificada si aún no hay ninguna."""
+    rutas = _rutas_version(relativa(filename), tamano)
+    return next((r for r in rutas if os.path.exists(r)), rutas[0])
+
+
+def obtener_version(filename, tamano):
+    """
+    Ruta de la versión `tamano` de la foto, generándola en el momento (y
+    dejándola en disco) si aún no existe. None si no se puede generar.
+    """
+    original = ruta_original(filename)
+    if original is None:
+        return None
+    ruta = ruta_version(filename, tamano)
+    if os.path.exists(ruta):
+        return ruta
+    if not os.path.isfile(original):
+        return None
+    try:
+        generar_versiones(original, current_app.config['UPLOAD_FOLDER'],
+                          relativa(filename), tamanos=(tamano,))
+    except Exception as e:
+        logger.warning(f'No se pudo generar {tamano}px de {filename}: {e}')
+        return None
+    # Puede haber quedado enlazado con la extensión del original
+    return ruta_version(filename, tamano)
+
+
+def _versiones_completas(filename):
+    return all(os.path.exists(ruta_version(filename, t)) for t in TAMANOS)
+
+
+def borrar_versiones(filename):
+    for tamano in TAMANOS:
+        for ruta in _rutas_version(relativa(filename), tamano):
+            if os.path.exists(ruta):
+                os.remove(ruta)
+
+
+def borrar_si_huerfano(filename):
+    """
+    Borra el original y sus versiones si ya ninguna Photo los referencia.
+    Llamar después de confirmar el borrado de las filas. Devuelve si se borró.
+    """
+    if Photo.referencias(filename):
+        return False
+    ruta = ruta_original(filename)
+    if ruta and os.path.exists(ruta):
+        os.remove(ruta)
+    borrar_versiones(filename)
+    return True
+
+
+# ── Subidas por trozos ────────────────────────────────────────────────────
+
+class DesfaseSubida(Exception):
+    """El trozo no empieza donde acaba lo recibido; el cliente debe retomar desde `recibido`."""
+    def __init__(self, recibido):
+        super().__init__(recibido)
+        self.recibido = recibido
+
+
+class SubidaOcupada(Exception):
+    """Otra petición está escribiendo en la misma subida (un reintento que se solapa)."""
+
+
+def ruta_subida(aviso_id, upload_id):
+    """Archivo parcial de una subida, o None si el upload-id no es válido."""
+    if not _ID_SUBIDA.match(upload_id or ''):
+        return None
+    carpeta = os.path.join(current_app.config['UPLOAD_FOLDER'], CARPETA_SUBIDAS)
+    os.makedirs(carpeta, exist_ok=True)
+    return os.path.join(carpeta, f'{aviso_id}-{upload_id}.part')
+
+
+def subida_recibido(ruta):
+    return os.path.getsize(ruta) if os.path.exists(ruta) else 0
+
+
+@contextmanager
+def _bloquear_subida(ruta):
+    """
+    Bloqueo exclusivo sin espera de una subida, sobre un `.lock` junto al
+    parcial (fcntl en Linux, msvcrt en Windows). Si otra petición de la misma
+    subida lo tiene, SubidaOcupada. El parcial queda cerrado fuera del
+    bloqueo: Windows no deja moverlo mientras esté abierto.
+    """
+    with open(ruta + '.lock', 'a+') as f:
+        try:
+            if os.name == 'nt':
+                import msvcrt
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_NBLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            raise SubidaOcupada() from None
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def subida_anadir(ruta, inicio, flujo):
+    """Añade al parcial los bytes de `flujo` (sin cargarlos en memoria). Devuelve el total recibido."""
+    if inicio == 0:
+        _limpiar_subidas(os.path.dirname(ruta))
+    with _bloquear_subida(ruta):
+        recibido = subida_recibido(ruta)
+        if inicio != recibido:
+            raise DesfaseSubida(recibido)
+        with open(ruta, 'ab') as parcial:
+            for bloque in iter(lambda: flujo.read(BLOQUE), b''):
+                parcial.write(bloque)
+        return subida_recibido(ruta)
+
+
+def subida_completar(ruta, ext):
+    """
+    Mueve el parcial ya completo a su ruta por contenido (sin copiarlo: está
+    en el mismo disco). Devuelve el nombre guardado.
+    """
+    sha = hashlib.sha256()
+    with _bloquear_subida(ruta):
+        with open(ruta, 'rb') as f:
+            for bloque in iter(lambda: f.read(BLOQUE), b''):
+                sha.update(bloque)
+        nombre = f'{sha.hexdigest()}.{ext}'
+        _colocar(ruta, os.path.join(current_app.config['UPLOAD_FOLDER'], relativa(nombre)))
+    try:
+        os.remove(ruta + '.lock')
+    except OSError:
+        pass
+    return nombre
+
+
+def _limpiar_subidas(carpeta):
+    """Borra las subidas abandonadas y sus `.lock` (se llama al empezar una nueva)."""
+    limite = time.time() - CADUCIDAD_SUBIDAS
+    for entrada in os.scandir(carpeta):
+        try:
+            if entrada.name.endswith(('.part', '.lock')) and entrada.stat().st_mtime < limite:
+                os.remove(entrada.path)
+        except OSError:
+            pass
+
+
+# ── Generación de versiones ───────────────────────────────────────────────
+
+def _obtener_pool(procesos):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            # spawn: el proceso web tiene hilos (cola de Telegram, pool del
+            # bot) y hacer fork con hilos vivos puede dejar locks bloqueados
+            _pool = ProcessPoolExecutor(max_workers=procesos,
+                                        mp_context=multiprocessing.get_context('spawn'))
+        return _pool
+
+
+def _marcar(photo_id, status):
+    db.session.execute(db.update(Photo).where(Photo.id == photo_id).values(status=status))
+    db.session.commit()
+
+
+def _procesar_ahora(photo_id, filename):
+    try:
+        generar_versiones(ruta_original(filename), current_app.config['UPLOAD_FOLDER'],
+                          relativa(filename))
+        status = 'lista'
+    except Exception as e:
+        logger.warning(f'Foto {photo_id} ({filename}) sin versiones: {e}')
+        status = 'error'
+    _marcar(photo_id, status)
+    return status
+
+
+def procesar(fotos):
+    """
+    Encarga las versiones de las fotos recién guardadas (ya con id, tras el
+    commit). Con FOTOS_PROCESOS = 0 o en tests se generan aquí mismo.
+    """
+    app = current_app._get_current_object()
+    procesos = app.config.get('FOTOS_PROCESOS', 2)
+    carpeta = app.config['UPLOAD_FOLDER']
+
+    for foto in fotos:
+        photo_id, filename = foto.id, foto.filename
+        if _versiones_completas(filename):
+            # Contenido repetido: las versiones ya están en disco
+            _marcar(photo_id, 'lista')
+            continue
+        if app.testing or not procesos:
+            _procesar_ahora(photo_id, filename)
+            continue
+        try:
+            futuro = _obtener_pool(procesos).submit(
+                generar_versiones, ruta_original(filename), carpeta, relativa(filename))
+        except Exception as e:
+            logger.warning(f'Pool de fotos no disponible ({e}); se procesa en la petición')
+            _procesar_ahora(photo_id, filename)
+            continue
+        futuro.add_done_callback(lambda f, i=photo_id, n=filename: _terminado(app, i, n, f))
+
+
+def _terminado(app, photo_id, filename, futuro):
+    """Callback del pool (en un hilo del proceso web)."""
+    error = futuro.exception()
+    if error is not None:
+        logger.warning(f'Foto {photo_id} ({filename}) sin versiones: {error}')
+    with app.app_context():
+        _marcar(photo_id, 'error' if error else 'lista')
+
+
+@click.command('fotos-procesar')
+@click.option('--errores', is_flag=True, help='Reintentar también las que fallaron.')
+@with_appcontext
+def fotos_procesar_command(errores):
+    """Genera las versiones de las fotos que se quedaron sin procesar."""
+    estados = ['procesando', 'error'] if errores else ['procesando']
+    pendientes = Photo.query.filter(Photo.status.in_(estados)).all()
+    resultado = {'lista': 0, 'error': 0}
+    for foto in pendientes:
+        resultado[_procesar_ahora(foto.id, foto.filename)] += 1
+    click.echo(f"{resultado['lista']} fotos procesadas, {resultado['error']} con error.")
+
+
+# ── Migración de las fotos antiguas ───────────────────────────────────────
+
+def _migrar_archivo(carpeta, antiguo):
+    """
+    Mueve un original de la raíz a su ruta por contenido y actualiza las
+    Photo que lo usan. Devuelve el nombre nuevo, o None si no está en disco.
+    """
+    plano = os.path.join(carpeta, antiguo)
+    if not os.path.isfile(plano):
+        return None
+    with open(plano, 'rb') as f:
+        nuevo = _guardar_por_contenido(f, carpeta, antiguo.rsplit('.', 1)[-1].lower())
+
+    db.session.execute(db.update(Photo).where(Photo.filename == antiguo).values(filename=nuevo))
+    db.session.commit()
+    # Solo tras el commit: si se interrumpe antes, la foto sigue en su sitio
+    os.remove(plano)
+    # Versiones con el nombre antiguo (planas o fragmentadas): se regeneran bajo demanda
+    for tamano in TAMANOS:
+        for rel in (antiguo, relativa(antiguo)):
+            for ruta in _rutas_version(rel, tamano):
+                if os.path.exists(ruta):
+                    os.remove(ruta)
+    return nuevo
+
+
+@click.command('fotos-migrar')
+@with_appcontext
+def fotos_migrar_command():
+    """Pasa las fotos con nombre uuid al almacenamiento por contenido (SHA-256)."""
+    carpeta = current_app.config['UPLOAD_FOLDER']
+    nombres = db.session.scalars(db.select(Photo.filename).distinct()).all()
+    movidas = faltan = 0
+    for antiguo in nombres:
+        if os.path.exists(os.path.join(carpeta, relativa(antiguo))):
+            continue
+        if _migrar_archivo(carpeta, antiguo) is None:
+            faltan += 1
+            logger.warning(f'Foto {antiguo} no encontrada en {carpeta}')
+        else:
+            movidas += 1
+    click.echo(f'{movidas} archivos movidos, {faltan} no encontrados.')
@@ -0,0 +1,111 @@
+"""
+Procesado de imágenes con Pillow, sin dependencias de Flask: se ejecuta en
+los procesos del pool de fotos.py.
+"""
+import os
+import shutil
+import threading
+
+from PIL import Image, ImageOps, features
+
+TAMANOS = (320, 1024, 1920)       # miniatura, media y completa (lado mayor, px)
+FORMATO = 'WEBP' if features.check('webp') else 'JPEG'
+EXTENSION = 'webp' if FORMATO == 'WEBP' else 'jpg'
+OPCIONES = {
+    'WEBP': {'quality': 80, 'method': 4},
+    'JPEG': {'quality': 85, 'optimize': True, 'progressive': True},
+}[FORMATO]
+# Formatos que el navegador muestra tal cual: si el original ya cabe en una
+# versión (p. ej. reducido en el móvil antes de subirlo) se enlaza sin recodificar
+EXTENSIONES_WEB = {'JPEG': 'jpg', 'WEBP': 'webp'}
+
+
+def nombre_version(nombre, tamano, extension=EXTENSION):
+    """'ab12.jpg', 320 → '320/ab12.webp' (relativo a la carpeta de subidas)."""
+    base = nombre.rsplit('.', 1)[0]
+    return os.path.join(str(tamano), f'{base}.{extension}')
+
+
+def servible_tal_cual(ruta):
+    """
+    (extensión, lado mayor) si el original puede usarse como versión sin
+    recodificar: JPEG/WebP sin EXIF (ni orientación ni GPS que quitar) y ya
+    comprimido (≤ 8 bits por píxel). None en otro caso. Solo lee la cabecera.
+    """
+    with Image.open(ruta) as img:
+        if img.format not in EXTENSIONES_WEB or img.info.get('exif') or img.mode not in ('RGB', 'L'):
+            return None
+        if os.path.getsize(ruta) > img.width * img.height:
+            return None
+        return EXTENSIONES_WEB[img.format], max(img.size)
+
+
+def _enlazar(origen, destino):
+    """Hard link (mismo disco, sin ocupar espacio); copia si no se puede."""
+    temporal = f'{destino}.{os.getpid()}.{threading.get_ident()}.tmp'
+    try:
+        os.link(origen, temporal)
+    except OSError:
+        shutil.copyfile(origen, temporal)
+    os.replace(temporal, destino)
+
+
+def abrir_reducida(ruta, tamano):
+    """
+    Abre la imagen decodificada a la escala más cercana a `tamano` sin bajar
+    de él: en JPEG, draft() hace que libjpeg decodifique a 1/2, 1/4 u 1/8
+    (una foto de 4000×3000 para 1920 px se lee a 2000×1500). Aplica la
+    orientación EXIF y deja la imagen en RGB/L, sin metadatos EXIF.
+    """
+    img = Image.open(ruta)
+    try:
+        # draft() exige ambos lados: se pide el tamaño final en la orientación
+        # almacenada (el giro EXIF no cambia cuál es el lado mayor)
+        escala = tamano / max(img.size)
+        if escala < 1:
+            img.draft('RGB', (round(img.width * escala), round(img.height * escala)))
+        girada = ImageOps.exif_transpose(img)
+        if girada.mode not in ('RGB', 'L'):
+            girada = girada.convert('RGB')
+        else:
+            girada.load()
+    finally:
+        img.close()
+    girada.info.pop('exif', None)
+    return girada
+
+
+def generar_versiones(ruta_original, carpeta, nombre, tamanos=TAMANOS):
+    """
+    Crea en `carpeta` las versiones reducidas de la foto, de la mayor a la
+    menor (cada una parte de la anterior). Las que el original ya cumple se
+    enlazan con su propia extensión sin decodificarlo (ver servible_tal_cual).
+    Devuelve (ancho, alto) de la imagen decodificada, o None si no hizo falta.
+    Solo se conserva el perfil ICC.
+    """
+    tamanos = sorted(tamanos, reverse=True)
+    tal_cual = servible_tal_cual(ruta_original)
+    if tal_cual:
+        extension, lado = tal_cual
+        for tamano in [t for t in tamanos if lado <= t]:
+            destino = os.path.join(carpeta, nombre_version(nombre, tamano, extension))
+            os.makedirs(os.path.dirname(destino), exist_ok=True)
+            _enlazar(ruta_original, destino)
+            tamanos.remove(tamano)
+        if not tamanos:
+            return None
+
+    img = abrir_reducida(ruta_original, tamanos[0])
+    icc = img.info.get('icc_profile')
+    ancho, alto = img.size
+
+    for tamano in tamanos:
+        # reducing_gap: reduce() entero hasta ~2× el destino y LANCZOS el resto
+        img.thumbnail((tamano, tamano), Image.LANCZOS, reducing_gap=2.0)
+        destino = os.path.join(carpeta, nombre_version(nombre, tamano))
+        os.makedirs(os.path.dirname(destino), exist_ok=True)
+        # Escritura atómica: nunca se sirve una versión a medio escribir
+        temporal = f'{destino}.{os.getpid()}.{threading.get_ident()}.tmp'
+        img.save(temporal, FORMATO, icc_profile=icc, **OPCIONES)
+        os.replace(temporal, destino)
+    return ancho, alto
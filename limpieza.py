@@ -0,0 +1,219 @@
+"""
+Borrado diferido de archivos de fotos y recolector de huérfanos.
+
+Al borrar una Photo (sola o con su aviso) no se toca el disco dentro de la
+petición: se anota el archivo en `borrado_pendiente` en la misma transacción
+y, tras el commit, un hilo en segundo plano lo borra si ya no lo usa ninguna
+otra Photo. Si el commit falla no se ha perdido nada; si el proceso muere
+antes de barrer, la fila sigue ahí para la próxima pasada. Los archivos
+tocados hace menos de MARGEN (una subida repetida los reutiliza y les pone la
+hora) se dejan para más tarde: la Photo que los usa puede estar sin confirmar.
+
+Para revisar la carpeta de subidas contra la base de datos:
+  flask --app app uploads-gc             # solo informa (también de los borrados pendientes)
+  flask --app app uploads-gc --borrar    # aplica los borrados pendientes y borra los huérfanos
+"""
+import logging
+import os
+import threading
+import time
+from collections import Counter
+
+import click
+from flask import current_app, has_app_context
+from flask.cli import with_appcontext
+from sqlalchemy import delete, event, select
+from sqlalchemy.orm import Session, object_session
+
+from extensions import db
+from fotos import CADUCIDAD_SUBIDAS, CARPETA_SUBIDAS, borrar_si_huerfano, ruta_original
+from imagenes import TAMANOS
+from models import BorradoPendiente, Photo
+
+logger = logging.getLogger(__name__)
+
+INTERVALO = 300        # segundos entre pasadas del hilo si nadie lo despierta
+LOTE      = 200
+MARGEN    = 600        # segundos: los archivos más recientes no se borran aún
+
+_despertar = threading.Event()
+_hilo = None
+_hilo_lock = threading.Lock()
+
+
+# ── Borrado diferido ──────────────────────────────────────────────────────
+
+@event.listens_for(Photo, 'after_delete')
+def _anotar_borrado(mapper, connection, target):
+    connection.execute(BorradoPendiente.__table__.insert().values(filename=target.filename))
+    sesion = object_session(target)
+    if sesion is not None:
+        sesion.info['fotos_por_borrar'] = True
+
+
+@event.listens_for(Session, 'after_commit')
+def _tras_commit(session):
+    if session.info.pop('fotos_por_borrar', False) and has_app_context():
+        _asegurar_hilo(current_app._get_current_object())
+        _despertar.set()
+
+
+def _reciente(filename, limite):
+    ruta = ruta_original(filename)
+    try:
+        return ruta is not None and os.path.getmtime(ruta) > limite
+    except FileNotFoundError:
+        return False
+
+
+def barrer(limite=LOTE):
+    """
+    Borra del disco los archivos pendientes que ya no usa ninguna Photo, de
+    `limite` en `limite` filas. Devuelve cuántas filas atendió; las de
+    archivos recientes o que fallan se quedan para la próxima pasada.
+    """
+    t = BorradoPendiente.__table__
+    antes_de = time.time() - MARGEN
+    atendidas, ultima = 0, 0
+    while True:
+        filas = db.session.execute(select(t.c.id, t.c.filename).where(t.c.id > ultima)
+                                   .order_by(t.c.id).limit(limite)).all()
+        hechas = []
+        for fila_id, filename in filas:
+            if _reciente(filename, antes_de):
+                continue
+            try:
+                borrar_si_huerfano(filename)
+            except OSError as e:
+                logger.warning(f'No se pudo borrar la foto {filename}: {e}')
+                continue
+            hechas.append(fila_id)
+        if hechas:
+            db.session.execute(delete(t).where(t.c.id.in_(hechas)))
+        db.session.commit()
+        atendidas += len(hechas)
+        if len(filas) < limite:
+            return atendidas
+        ultima = filas[-1].id
+
+
+def _bucle(app):
+    while True:
+        _despertar.clear()
+        try:
+            with app.app_context():
+                barrer()
+        except Exception:
+            logger.exception('Error borrando fotos pendientes')
+        _despertar.wait(INTERVALO)
+
+
+def _asegurar_hilo(app):
+    global _hilo
+    if app.testing:
+        return
+    with _hilo_lock:
+        if _hilo is None or not _hilo.is_alive():
+            _hilo = threading.Thread(target=_bucle, args=(app,),
+                                     name='borrado-fotos', daemon=True)
+            _hilo.start()
+
+
+# ── Recolector de huérfanos ───────────────────────────────────────────────
+
+def _recorrer(carpeta, relativa=''):
+    """Archivos bajo `carpeta` como (ruta relativa, DirEntry), sin listar todo en memoria."""
+    with os.scandir(os.path.join(carpeta, relativa)) as entradas:
+        for entrada in entradas:
+            rel = os.path.join(relativa, entrada.name)
+            if entrada.is_dir(follow_symlinks=False):
+                yield from _recorrer(carpeta, rel)
+            elif entrada.is_file(follow_symlinks=False):
+                yield rel, entrada
+
+
+def _clasificar(rel, referenciados, bases):
+    """
+    Tipo de archivo ('original', 'version', 'temporal', 'subida') y si
+    alguna Photo lo usa. Los temporales y las subidas nunca están referenciados.
+    """
+    partes = rel.split(os.sep)
+    nombre = partes[-1]
+    if nombre.endswith('.tmp'):
+        return 'temporal', False
+    if partes[0] == CARPETA_SUBIDAS:
+        return 'subida', False
+    if len(partes) > 1 and partes[0] in {str(t) for t in TAMANOS}:
+        return 'version', nombre.rsplit('.', 1)[0] in bases
+    return 'original', nombre in referenciados
+
+
+def _podar_directorios(carpeta):
+    """Quita las subcarpetas que hayan quedado vacías."""
+    for raiz, _dirs, _archivos in os.walk(carpeta, topdown=False):
+        # Se mira de nuevo: las subcarpetas pueden haberse quitado en esta pasada
+        if raiz != carpeta and not os.listdir(raiz):
+            try:
+                os.rmdir(raiz)
+            except OSError:
+                pass
+
+
+@click.command('uploads-gc')
+@click.option('--borrar', is_flag=True, help='Borrar los huérfanos (por defecto solo informa).')
+@click.option('--margen', default=60, show_default=True,
+              help='Minutos: los archivos más recientes se respetan (subidas en curso).')
+@click.option('--detalle', is_flag=True, help='Listar cada archivo huérfano o que falta.')
+@with_appcontext
+def uploads_gc_command(borrar, margen, detalle):
+    """Compara UPLOAD_FOLDER con Photo.filename: huérfanos y archivos que faltan."""
+    carpeta = current_app.config['UPLOAD_FOLDER']
+    if borrar:
+        atendidos = barrer()
+        if atendidos:
+            click.echo(f'{atendidos} borrados pendientes aplicados.')
+    elif (pendientes := db.session.scalar(select(db.func.count()).select_from(BorradoPendiente))):
+        click.echo(f'{pendientes} borrados pendientes (se aplican con --borrar).')
+
+    referenciados = set(db.session.scalars(select(Photo.filename).distinct()))
+    bases = {f.rsplit('.', 1)[0] for f in referenciados}
+    db.session.close()
+
+    ahora = time.time()
+    limites = {'subida': ahora - CADUCIDAD_SUBIDAS}
+    vistos = set()
+    huerfanos, bytes_huerfanos, recientes = Counter(), Counter(), 0
+    for rel, entrada in _recorrer(carpeta):
+        tipo, en_uso = _clasificar(rel, referenciados, bases)
+        if en_uso:
+            if tipo == 'original':
+                vistos.add(entrada.name)
+            continue
+        info = entrada.stat(follow_symlinks=False)
+        if info.st_mtime > limites.get(tipo, ahora - margen * 60):
+            recientes += 1
+            continue
+        huerfanos[tipo] += 1
+        bytes_huerfanos[tipo] += info.st_size
+        if detalle:
+            click.echo(f'  huérfano  {tipo:9} {rel}')
+        if borrar:
+            try:
+                os.remove(entrada.path)
+            except OSError as e:
+                click.echo(f'  no se pudo borrar {rel}: {e}')
+
+    faltan = sorted(referenciados - vistos)
+    if detalle:
+        for nombre in faltan:
+            click.echo(f'  falta     {nombre}')
+    if borrar:
+        _podar_directorios(carpeta)
+
+    for tipo in ('original', 'version', 'temporal', 'subida'):
+        if huerfanos[tipo]:
+            click.echo(f'{tipo:9} {huerfanos[tipo]:6} huérfanos  {bytes_huerfanos[tipo] / 1024 / 1024:9.1f} MiB')
+    total = sum(bytes_huerfanos.values()) / 1024 / 1024
+    accion = 'liberados' if borrar else 'recuperables con --borrar'
+    click.echo(f'{sum(huerfanos.values())} huérfanos ({total:.1f} MiB {accion}), '
+               f'{recientes} recientes respetados, {len(faltan)} fotos sin archivo.')
@@ -0,0 +1,257 @@
+"""
+Migraciones de esquema versionadas.
+
+La tabla `schema_version` guarda un único entero. Al arrancar solo se compara
+ese número con la última migración de MIGRACIONES; si la base de datos está
+atrasada se aplican los pasos pendientes en orden, cada uno en su transacción
+y bajo un bloqueo de archivo para que varios workers no migren a la vez.
+
+Para aplicarlas manualmente (p. ej. tras un despliegue):
+  flask --app app db-upgrade
+"""
+import os
+import logging
+from contextlib import contextmanager
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import text
+
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+
+# ── Utilidades para los pasos ─────────────────────────────────────────────
+
+def _columnas(conn, tabla):
+    return {r[1] for r in conn.execute(text(f'PRAGMA table_info("{tabla}")'))}
+
+
+def _add_columna(conn, tabla, columna, tipo, default=None):
+    """ALTER TABLE ADD COLUMN solo si la columna no existe todavía."""
+    if columna in _columnas(conn, tabla):
+        return False
+    sql = f'ALTER TABLE "{tabla}" ADD COLUMN {columna} {tipo}'
+    if default is not None:
+        sql += f' DEFAULT {default}'
+    conn.execute(text(sql))
+    return True
+
+
+# ── Pasos de migración (nunca reordenar ni editar uno ya publicado) ──────
+
+def _m001_esquema_base(conn):
+    """Tablas base y columnas añadidas antes del versionado."""
+    from models import User, Aviso, Photo
+    for modelo in (User, Aviso, Photo):
+        modelo.__table__.create(bind=conn, checkfirst=True)
+
+    if _add_columna(conn, 'user', 'rol', 'VARCHAR(20)', "'tecnico'"):
+        conn.execute(text("UPDATE user SET rol='admin' WHERE username='admin'"))
+    for col, tipo in [
+        ('nombre_completo', 'VARCHAR(150)'),
+        ('telefono_perfil', 'VARCHAR(20)'),
+        ('telegram_chat_id', 'VARCHAR(50)'),
+    ]:
+        _add_columna(conn, 'user', col, tipo)
+
+    for col, tipo, default in [
+        ('precio_mano_obra',  'FLOAT',        None),
+        ('coste_materiales',  'FLOAT',        None),
+        ('materiales_desc',   'TEXT',         None),
+        ('descuento',         'FLOAT',        None),
+        ('gastos_extra',      'FLOAT',        None),
+        ('gastos_extra_desc', 'VARCHAR(200)', None),
+        ('cobro_estado',      'VARCHAR(20)',  "'pendiente'"),
+        ('asignado_a',        'INTEGER',      None),
+    ]:
+        _add_columna(conn, 'aviso', col, tipo, default)
+
+
+def _crear_indices_modelos(conn):
+    """Índices declarados en los modelos que falten en tablas ya existentes."""
+    from models import User, Aviso, Photo
+    for modelo in (User, Aviso, Photo):
+        for indice in modelo.__table__.indexes:
+            indice.create(bind=conn, checkfirst=True)
+
+
+def _m002_indices_compuestos(conn):
+    _crear_indices_modelos(conn)
+
+
+def _m003_busqueda_fts(conn):
+    from busqueda import crear_indice_fts
+    crear_indice_fts(conn)
+
+
+def _m004_usuarios_por_defecto(conn):
+    from models import User
+    from werkzeug.security import generate_password_hash
+    if conn.execute(text('SELECT COUNT(*) FROM user')).scalar():
+        return
+    conn.execute(User.__table__.insert(), [
+        {'username': 'admin',    'password': generate_password_hash('admin123'),   'rol': 'admin'},
+        {'username': 'tecnico1', 'password': generate_password_hash('tecnico123'), 'rol': 'tecnico'},
+        {'username': 'tecnico2', 'password': generate_password_hash('tecnico123'), 'rol': 'tecnico'},
+    ])
+    print("Usuarios creados: admin/admin123, tecnico1/tecnico123, tecnico2/tecnico123")
+
+
+def _m005_indice_paginacion(conn):
+    _crear_indices_modelos(conn)
+
+
+def _m006_contador_fotos(conn):
+    _add_columna(conn, 'aviso', 'photo_count', 'INTEGER NOT NULL', 0)
+    conn.execute(text(
+        'UPDATE aviso SET photo_count = '
+        '(SELECT COUNT(*) FROM photo WHERE photo.aviso_id = aviso.id)'
+    ))
+
+
+def _m007_stats_diario(conn):
+    from models import StatsDiario
+    from rollups import reconstruir
+    StatsDiario.__table__.create(bind=conn, checkfirst=True)
+    reconstruir(conn)
+
+
+def _m008_historial_estados(conn):
+    """
+    fecha_finalizado + tabla aviso_evento. Los ya finalizados toman updated_at
+    y stats_diario se rehace por fecha_finalizado. El índice va en SQL (no en
+    el modelo) para que los pasos 2 y 5 no lo intenten antes de la columna.
+    """
+    from models import AvisoEvento
+    from rollups import reconstruir
+    _add_columna(conn, 'aviso', 'fecha_finalizado', 'DATETIME')
+    conn.execute(text(
+        "UPDATE aviso SET fecha_finalizado = updated_at "
+        "WHERE estado = 'finalizado' AND fecha_finalizado IS NULL"
+    ))
+    conn.execute(text(
+        'CREATE INDEX IF NOT EXISTS ix_aviso_fecha_finalizado ON aviso (fecha_finalizado)'
+    ))
+    AvisoEvento.__table__.create(bind=conn, checkfirst=True)
+    reconstruir(conn)
+
+
+def _m009_cola_telegram(conn):
+    from models import MensajeTelegram
+    MensajeTelegram.__table__.create(bind=conn, checkfirst=True)
+
+
+def _m010_entrada_telegram(conn):
+    from models import UpdateTelegram
+    UpdateTelegram.__table__.create(bind=conn, checkfirst=True)
+
+
+def _m011_estado_fotos(conn):
+    """Las fotos anteriores ya están reducidas a 1920 px: se dan por listas."""
+    _add_columna(conn, 'photo', 'status', 'VARCHAR(20) NOT NULL', "'lista'")
+
+
+def _m012_indice_archivo_fotos(conn):
+    """Los archivos se mueven aparte con `flask fotos-migrar` (no en el arranque)."""
+    _crear_indices_modelos(conn)
+
+
+def _m013_borrados_pendientes(conn):
+    from models import BorradoPendiente
+    BorradoPendiente.__table__.create(bind=conn, checkfirst=True)
+
+
+def _m014_version_datos(conn):
+    from models import VersionDatos
+    VersionDatos.__table__.create(bind=conn, checkfirst=True)
+
+
+MIGRACIONES = [
+    (1, 'Esquema base',              _m001_esquema_base),
+    (2, 'Índices compuestos',        _m002_indices_compuestos),
+    (3, 'Búsqueda full-text (FTS5)', _m003_busqueda_fts),
+    (4, 'Usuarios por defecto',      _m004_usuarios_por_defecto),
+    (5, 'Índice de paginación',      _m005_indice_paginacion),
+    (6, 'Contador de fotos',         _m006_contador_fotos),
+    (7, 'Agregados diarios',         _m007_stats_diario),
+    (8, 'Historial de estados',      _m008_historial_estados),
+    (9, 'Cola de Telegram',          _m009_cola_telegram),
+    (10, 'Entrada de Telegram',      _m010_entrada_telegram),
+    (11, 'Estado de las fotos',      _m011_estado_fotos),
+    (12, 'Índice de archivo de fotos', _m012_indice_archivo_fotos),
+    (13, 'Borrados de fotos pendientes', _m013_borrados_pendientes),
+    (14, 'Versión de los datos',     _m014_version_datos),
+]
+
+VERSION_ESQUEMA = MIGRACIONES[-1][0]
+
+
+# ── Motor ──────────────────────────────────────────────────────────────────
+
+def version_actual(conn):
+    """Versión aplicada en la base de datos (0 si nunca se ha migrado)."""
+    conn.execute(text('CREATE TABLE IF NOT EXISTS schema_version (version INTEGER NOT NULL)'))
+    return conn.execute(text('SELECT MAX(version) FROM schema_version')).scalar() or 0
+
+
+@contextmanager
+def _bloqueo_archivo(ruta):
+    """Bloqueo exclusivo entre procesos (fcntl en Linux, msvcrt en Windows)."""
+    with open(ruta, 'a+') as f:
+        if os.name == 'nt':
+            import msvcrt
+            f.seek(0)
+            msvcrt.locking(f.fileno(), msvcrt.LK_LOCK, 1)
+        else:
+            import fcntl
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == 'nt':
+                f.seek(0)
+                msvcrt.locking(f.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+
+def aplicar_pendientes(app):
+    """Aplica en orden las migraciones pendientes. Devuelve la lista aplicada."""
+    os.makedirs(app.instance_path, exist_ok=True)
+    aplicadas = []
+    with _bloqueo_archivo(os.path.join(app.instance_path, 'migraciones.lock')):
+        # Releer dentro del bloqueo: otro worker puede haber migrado ya
+        with db.engine.begin() as conn:
+            actual = version_actual(conn)
+        for numero, descripcion, paso in MIGRACIONES:
+            if numero <= actual:
+                continue
+            with db.engine.begin() as conn:
+                paso(conn)
+                conn.execute(text('DELETE FROM schema_version'))
+                conn.execute(text('INSERT INTO schema_version (version) VALUES (:v)'), {'v': numero})
+            logger.info(f'Migración {numero} aplicada: {descripcion}')
+            aplicadas.append((numero, descripcion))
+    return aplicadas
+
+
+def comprobar_esquema(app):
+    """Comprobación de arranque: un único SELECT salvo que haya migraciones pendientes."""
+    with db.engine.begin() as conn:
+        actual = version_actual(conn)
+    if actual < VERSION_ESQUEMA:
+        aplicar_pendientes(app)
+
+
+@click.command('db-upgrade')
+@with_appcontext
+def db_upgrade_command():
+    """Aplica las migraciones de esquema pendientes."""
+    aplicadas = aplicar_pendientes(current_app._get_current_object())
+    for numero, descripcion in aplicadas:
+        click.echo(f'  ✔ {numero:03d} {descripcion}')
+    with db.engine.begin() as conn:
+        click.echo(f'Esquema en versión {version_actual(conn)}.')
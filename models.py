@@ -1,6 +1,7 @@
 from datetime import datetime, date
 from flask_login import UserMixin
 from sqlalchemy import event
+from sqlalchemy.orm import joinedload, object_session
 from extensions import db
 
 
@@ -55,6 +56,17 @@ ELECTRODOMESTICOS = [
 
 class Aviso(db.Model):
     __tablename__ = 'aviso'
+    __table_args__ = (
+        # Índices compuestos para los filtros por rol (asignado_a / created_by)
+        # combinados con estado, fecha de cita o fecha de actualización.
+        db.Index('ix_aviso_asignado_estado_cita', 'asignado_a', 'estado', 'fecha_cita'),
+        db.Index('ix_aviso_creador_estado', 'created_by', 'estado'),
+        db.Index('ix_aviso_cita_estado', 'fecha_cita', 'estado'),
+        db.Index('ix_aviso_estado_updated', 'estado', 'updated_at'),
+        db.Index('ix_aviso_cobro_updated', 'cobro_estado', 'updated_at'),
+        # Orden estable para la paginación por cursor (fecha_aviso, id)
+        db.Index('ix_aviso_fecha_aviso_id', 'fecha_aviso', 'id'),
+    )
 
     id = db.Column(db.Integer, primary_key=True)
 
@@ -92,14 +104,46 @@ class Aviso(db.Model):
     created_by  = db.Column(db.Integer,  db.ForeignKey('user.id'), nullable=True)
     asignado_a  = db.Column(db.Integer,  db.ForeignKey('user.id'), nullable=True)
 
+    # Momento en que pasó a 'finalizado' (None si no está finalizado)
+    # Indexada (ix_aviso_fecha_finalizado); el índice lo crea la migración 8
+    fecha_finalizado = db.Column(db.DateTime, nullable=True)
+
+    # Nº de fotos (desnormalizado, lo mantienen los eventos de Photo)
+    photo_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
     # Relaciones
     photos   = db.relationship('Photo', backref='aviso', lazy=True,
                                cascade='all, delete-orphan')
     tecnico  = db.relationship('User', foreign_keys=[asignado_a],
                                backref=db.backref('avisos_asignados', lazy=True))
+    eventos  = db.relationship('AvisoEvento', backref='aviso', lazy=True,
+                               cascade='all, delete-orphan',
+                               order_by='AvisoEvento.at')
 
     # ── Métodos de estado ──────────────────────────────────────────
 
+    def cambiar_estado(self, nuevo, usuario_id=None):
+        """
+        Cambia el estado registrando la transición en AvisoEvento y manteniendo
+        fecha_finalizado. Devuelve False si el estado no cambia.
+        """
+        anterior = self.estado
+        if nuevo == anterior:
+            return False
+        ahora = datetime.utcnow()
+        self.estado = nuevo
+        if nuevo == 'finalizado':
+            self.fecha_finalizado = ahora
+        elif anterior == 'finalizado':
+            self.fecha_finalizado = None
+        evento = AvisoEvento(aviso=self, from_estado=anterior, to_estado=nuevo,
+                             at=ahora, user_id=usuario_id)
+        # Un aviso nuevo lo arrastra al añadirse; uno ya persistido no (sin cascade_backrefs)
+        sesion = object_session(self)
+        if sesion is not None:
+            sesion.add(evento)
+        return True
+
     def estado_label(self):
         for key, label in ESTADOS:
             if key == self.estado:
@@ -156,8 +200,34 @@ def update_timestamp(mapper, connection, target):
     target.updated_at = datetime.utcnow()
 
 
+def opciones_listado():
+    """Opciones de carga para las consultas que pintan partials/aviso_card.html."""
+    return (joinedload(Aviso.tecnico),)
+
+
+class AvisoEvento(db.Model):
+    """Transición de estado de un aviso (from_estado es None al crearlo)."""
+    __tablename__ = 'aviso_evento'
+    __table_args__ = (
+        db.Index('ix_aviso_evento_aviso_at', 'aviso_id', 'at'),
+    )
+
+    id          = db.Column(db.Integer, primary_key=True)
+    aviso_id    = db.Column(db.Integer, db.ForeignKey('aviso.id'), nullable=False)
+    from_estado = db.Column(db.String(30), nullable=True)
+    to_estado   = db.Column(db.String(30), nullable=False)
+    at          = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    user_id     = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=True)
+
+    usuario = db.relationship('User')
+
+
 class Photo(db.Model):
     __tablename__ = 'photo'
+    __table_args__ = (
+        # Recuento de referencias al archivo (varias fotos pueden compartirlo)
+        db.Index('ix_photo_filename', 'filename'),
+    )
 
     id            = db.Column(db.Integer, primary_key=True)
     aviso_id      = db.Column(db.Integer, db.ForeignKey('aviso.id'), nullable=False)
@@ -165,3 +235,111 @@ class Photo(db.Model):
     original_name = db.Column(db.String(256))
     uploaded_at   = db.Column(db.DateTime, default=datetime.utcnow)
     uploaded_by   = db.Column(db.Integer,  db.ForeignKey('user.id'), nullable=True)
+    # procesando → lista | error (versiones reducidas generadas por fotos.py)
+    status        = db.Column(db.String(20), nullable=False, default='procesando')
+
+    @property
+    def lista(self):
+        return self.status == 'lista'
+
+    @classmethod
+    def referencias(cls, filename):
+        """Cuántas fotos apuntan a este archivo (el nombre es el hash del contenido)."""
+        return db.session.query(db.func.count(cls.id)).filter(cls.filename == filename).scalar()
+
+
+def _sumar_fotos(connection, aviso_id, delta):
+    aviso_tbl = Aviso.__table__
+    connection.execute(
+        aviso_tbl.update()
+        .where(aviso_tbl.c.id == aviso_id)
+        .values(photo_count=aviso_tbl.c.photo_count + delta)
+    )
+
+
+@event.listens_for(Photo, 'after_insert')
+def photo_insertada(mapper, connection, target):
+    _sumar_fotos(connection, target.aviso_id, 1)
+
+
+@event.listens_for(Photo, 'after_delete')
+def photo_eliminada(mapper, connection, target):
+    _sumar_fotos(connection, target.aviso_id, -1)
+
+
+class StatsDiario(db.Model):
+    """
+    Agregado diario de avisos finalizados por técnico y electrodoméstico.
+    Lo mantiene rollups.py desde los eventos de Aviso; se reconstruye con
+    `flask rebuild-rollups`.
+    """
+    __tablename__ = 'stats_diario'
+
+    dia              = db.Column(db.Date,        primary_key=True)
+    tecnico_id       = db.Column(db.Integer,     primary_key=True)   # 0 = sin técnico
+    electrodomestico = db.Column(db.String(100), primary_key=True)   # '' = sin indicar
+    num              = db.Column(db.Integer, nullable=False, default=0)
+    total_cliente    = db.Column(db.Float,   nullable=False, default=0.0)
+    beneficio        = db.Column(db.Float,   nullable=False, default=0.0)
+    coste            = db.Column(db.Float,   nullable=False, default=0.0)
+
+
+class MensajeTelegram(db.Model):
+    """Mensaje saliente de Telegram en cola (lo envía telegram_cola.py)."""
+    __tablename__ = 'telegram_outbox'
+    __table_args__ = (
+        db.Index('ix_telegram_outbox_estado_proximo', 'estado', 'proximo_intento'),
+    )
+
+    id              = db.Column(db.Integer, primary_key=True)
+    chat_id         = db.Column(db.String(50), nullable=False)
+    texto           = db.Column(db.Text, nullable=False)
+    estado          = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente|enviando|enviado|fallido
+    intentos        = db.Column(db.Integer, nullable=False, default=0)
+    proximo_intento = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    ultimo_error    = db.Column(db.Text)
+    created_at      = db.Column(db.DateTime, default=datetime.utcnow)
+    enviado_at      = db.Column(db.DateTime)
+
+
+class UpdateTelegram(db.Model):
+    """
+    Update recibido del bot (webhook o getUpdates), pendiente o ya procesado.
+    update_id es la clave: un update reenviado por Telegram no se repite.
+    """
+    __tablename__ = 'telegram_inbox'
+    __table_args__ = (
+        db.Index('ix_telegram_inbox_estado_recibido', 'estado', 'recibido_at'),
+    )
+
+    update_id    = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    payload      = db.Column(db.Text, nullable=False)
+    estado       = db.Column(db.String(20), nullable=False, default='pendiente')  # pendiente|procesando|procesado|error
+    recibido_at  = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    procesado_at = db.Column(db.DateTime)
+    error        = db.Column(db.Text)
+
+
+class BorradoPendiente(db.Model):
+    """
+    Archivo de foto por borrar del disco. Se anota en la misma transacción que
+    borra la Photo y lo borra limpieza.py después del commit: si el commit
+    falla, el archivo sigue en su sitio.
+    """
+    __tablename__ = 'borrado_pendiente'
+
+    id         = db.Column(db.Integer, primary_key=True)
+    filename   = db.Column(db.String(256), nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+class VersionDatos(db.Model):
+    """
+    Contador que sube con cada alta, cambio o borrado de un Aviso, en la misma
+    transacción. Las cachés lo llevan en la clave: un cambio hecho en
+    cualquier proceso (otro worker, un comando) las deja sin efecto en todos.
+    """
+    __tablename__ = 'version_datos'
+
+    nombre  = db.Column(db.String(30), primary_key=True)   # 'aviso'
+    version = db.Column(db.Integer, nullable=False, default=0)
@@ -0,0 +1,68 @@
+"""
+Paginación por cursor (keyset).
+
+En lugar de OFFSET/LIMIT + COUNT(*), cada página continúa a partir de los
+valores de ordenación de la última fila de la anterior, que viajan en un
+token opaco (`after=`). Las páginas profundas cuestan lo mismo que la primera
+y no se repiten ni saltan filas cuando entran avisos nuevos.
+"""
+import base64
+import json
+from datetime import date, datetime
+
+from sqlalchemy import Date, DateTime, tuple_
+
+
+def _a_json(valor):
+    if isinstance(valor, (date, datetime)):
+        return valor.isoformat()
+    return valor
+
+
+def _desde_json(valor, clave):
+    if valor is None:
+        return None
+    if isinstance(clave.type, DateTime):
+        return datetime.fromisoformat(valor)
+    if isinstance(clave.type, Date):
+        return date.fromisoformat(valor)
+    return valor
+
+
+def codificar_cursor(valores):
+    crudo = json.dumps([_a_json(v) for v in valores], separators=(',', ':'))
+    return base64.urlsafe_b64encode(crudo.encode()).decode().rstrip('=')
+
+
+def decodificar_cursor(token, claves):
+    """Valores del cursor convertidos a los tipos de `claves`, o None si no es válido."""
+    if not token:
+        return None
+    try:
+        crudo = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4))
+        valores = json.loads(crudo)
+        if not isinstance(valores, list) or len(valores) != len(claves):
+            return None
+        return [_desde_json(v, c) for v, c in zip(valores, claves)]
+    except (ValueError, TypeError):
+        return None
+
+
+def paginar_keyset(query, claves, after=None, limite=25, descendente=True):
+    """
+    Devuelve (items, siguiente_cursor) ordenando por `claves` (la última debe ser
+    única, p. ej. Aviso.id). siguiente_cursor es None en la última página.
+    """
+    valores = decodificar_cursor(after, claves)
+    if valores is not None:
+        fila = tuple_(*claves)
+        query = query.filter(fila < tuple(valores) if descendente else fila > tuple(valores))
+
+    orden = [c.desc() if descendente else c.asc() for c in claves]
+    filas = query.add_columns(*claves).order_by(None).order_by(*orden).limit(limite + 1).all()
+
+    siguiente = None
+    if len(filas) > limite:
+        filas = filas[:limite]
+        siguiente = codificar_cursor(filas[-1][1:])
+    return [f[0] for f in filas], siguiente
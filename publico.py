@@ -35,9 +35,9 @@ def aviso_publico():
             descripcion=descripcion,
             calle=calle,
             localidad=localidad,
-            estado='pendiente',
             fecha_aviso=date.today(),
         )
+        aviso.cambiar_estado('pendiente')
         db.session.add(aviso)
         db.session.commit()
 
@@ -0,0 +1,135 @@
+"""
+Agregados diarios de facturación (tabla stats_diario).
+
+Cada aviso finalizado aporta a la fila (día, técnico, electrodoméstico):
+1 aviso, su total al cliente, su beneficio y el coste de materiales. El día
+es la fecha de fecha_finalizado.
+
+Los eventos de Aviso restan la aportación anterior y suman la nueva dentro
+de la misma transacción del flush, así que la tabla nunca queda a medias.
+Para rellenarla o repararla:
+  flask --app app rebuild-rollups
+"""
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import event, select, func, text
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from extensions import db
+from models import Aviso, StatsDiario
+
+_COLUMNAS = ('estado', 'fecha_finalizado', 'asignado_a', 'created_by', 'electrodomestico',
+             'precio_mano_obra', 'gastos_extra', 'descuento', 'coste_materiales')
+
+
+def _aportacion(v):
+    """
+    Clave y valores con los que un aviso cuenta en stats_diario, o None si
+    no está finalizado. `v` es cualquier objeto con las columnas de _COLUMNAS.
+    """
+    if v.estado != 'finalizado' or v.fecha_finalizado is None:
+        return None
+    total = (v.precio_mano_obra or 0) + (v.gastos_extra or 0) - (v.descuento or 0)
+    coste = v.coste_materiales or 0
+    clave = (v.fecha_finalizado.date(), v.asignado_a or v.created_by or 0, v.electrodomestico or '')
+    return clave, (1, total, total - coste, coste)
+
+
+def _aplicar(connection, aportacion, signo):
+    if aportacion is None:
+        return
+    (dia, tecnico_id, electro), (num, total, beneficio, coste) = aportacion
+    tabla = StatsDiario.__table__
+    ins = sqlite_insert(tabla).values(
+        dia=dia, tecnico_id=tecnico_id, electrodomestico=electro,
+        num=signo * num, total_cliente=signo * total,
+        beneficio=signo * beneficio, coste=signo * coste,
+    )
+    connection.execute(ins.on_conflict_do_update(
+        index_elements=['dia', 'tecnico_id', 'electrodomestico'],
+        set_={
+            'num':           tabla.c.num + ins.excluded.num,
+            'total_cliente': tabla.c.total_cliente + ins.excluded.total_cliente,
+            'beneficio':     tabla.c.beneficio + ins.excluded.beneficio,
+            'coste':         tabla.c.coste + ins.excluded.coste,
+        },
+    ))
+    if signo < 0:
+        connection.execute(tabla.delete().where(
+            tabla.c.dia == dia, tabla.c.tecnico_id == tecnico_id,
+            tabla.c.electrodomestico == electro, tabla.c.num <= 0,
+        ))
+
+
+def _aportacion_en_bd(connection, aviso_id):
+    tabla = Aviso.__table__
+    fila = connection.execute(
+        select(*[tabla.c[c] for c in _COLUMNAS]).where(tabla.c.id == aviso_id)
+    ).first()
+    return _aportacion(fila) if fila else None
+
+
+@event.listens_for(Aviso, 'after_insert')
+def _rollup_insert(mapper, connection, target):
+    _aplicar(connection, _aportacion(target), 1)
+
+
+@event.listens_for(Aviso, 'before_update')
+def _rollup_antes_update(mapper, connection, target):
+    # La fila aún no se ha actualizado: su aportación es la anterior
+    target._rollup_previo = _aportacion_en_bd(connection, target.id)
+
+
+@event.listens_for(Aviso, 'after_update')
+def _rollup_update(mapper, connection, target):
+    previo = target.__dict__.pop('_rollup_previo', None)
+    nuevo = _aportacion(target)
+    if previo != nuevo:
+        _aplicar(connection, previo, -1)
+        _aplicar(connection, nuevo, 1)
+
+
+@event.listens_for(Aviso, 'before_delete')
+def _rollup_delete(mapper, connection, target):
+    _aplicar(connection, _aportacion_en_bd(connection, target.id), -1)
+
+
+def reconstruir(connection):
+    """
+    Recalcula stats_diario entera desde la tabla aviso. En una base anterior
+    a fecha_finalizado (la migración 7 corre antes que la 8) el día es
+    updated_at, como era entonces; la 8 la vuelve a reconstruir.
+    """
+    a = Aviso.__table__
+    total = (func.coalesce(a.c.precio_mano_obra, 0) +
+             func.coalesce(a.c.gastos_extra, 0) -
+             func.coalesce(a.c.descuento, 0))
+    coste = func.coalesce(a.c.coste_materiales, 0)
+    columnas = {r[1] for r in connection.execute(text('PRAGMA table_info(aviso)'))}
+    momento = a.c.fecha_finalizado if 'fecha_finalizado' in columnas else a.c.updated_at
+    dia = func.date(momento)
+    tecnico = func.coalesce(a.c.asignado_a, a.c.created_by, 0)
+    electro = func.coalesce(a.c.electrodomestico, '')
+    agregado = select(
+        dia, tecnico, electro,
+        func.count(a.c.id), func.sum(total), func.sum(total - coste), func.sum(coste),
+    ).where(
+        a.c.estado == 'finalizado', momento.isnot(None)
+    ).group_by(dia, tecnico, electro)
+
+    tabla = StatsDiario.__table__
+    connection.execute(tabla.delete())
+    connection.execute(tabla.insert().from_select(
+        ['dia', 'tecnico_id', 'electrodomestico', 'num', 'total_cliente', 'beneficio', 'coste'],
+        agregado,
+    ))
+    return connection.execute(text('SELECT COUNT(*) FROM stats_diario')).scalar()
+
+
+@click.command('rebuild-rollups')
+@with_appcontext
+def rebuild_rollups_command():
+    """Reconstruye la tabla stats_diario desde los avisos."""
+    with db.engine.begin() as conn:
+        filas = reconstruir(conn)
+    click.echo(f'stats_diario reconstruida: {filas} filas.')
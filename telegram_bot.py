@@ -1,17 +1,18 @@
 import os
 import ssl
-import urllib.request
-import urllib.parse
-import urllib.error
+import time
 import json
 import logging
+import threading
+import http.client
+import urllib.parse
 from dotenv import load_dotenv
 load_dotenv(override=True)
 
 logger = logging.getLogger(__name__)
 
 
-def _ssl_context():
+def _crear_contexto_ssl():
     """
     Contexto SSL adaptativo por plataforma:
     - Linux/PythonAnywhere: SSL estándar del sistema funciona directamente
@@ -37,6 +38,191 @@ def _ssl_context():
         return ssl.create_default_context()
 
 
+# Se crea una sola vez por proceso (cargar los certificados de la CA cuesta)
+_CONTEXTO_SSL = _crear_contexto_ssl()
+
+
+def _ssl_context():
+    return _CONTEXTO_SSL
+
+
+# ─────────────────────────────────────────────
+# Cliente HTTP con conexiones keep-alive
+# ─────────────────────────────────────────────
+
+# Errores típicos al usar una conexión keep-alive que el servidor ya cerró
+_ERRORES_CONEXION_CERRADA = (ConnectionError, ssl.SSLEOFError, ssl.SSLZeroReturnError,
+                             http.client.HTTPException)
+
+
+class ClienteTelegram:
+    """
+    Cliente de la Bot API que reutiliza conexiones HTTPS (keep-alive) en lugar
+    de abrir TCP + TLS en cada mensaje.
+
+    Seguro entre hilos: cada petición toma una conexión libre del pool (o abre
+    una nueva) y la devuelve al terminar, así que dos hilos nunca comparten
+    la misma conexión a la vez. Si una conexión reutilizada resulta estar
+    cerrada por el servidor, se reintenta una vez con una conexión nueva.
+    """
+
+    def __init__(self, host='api.telegram.org', port=443, contexto=None,
+                 max_libres=4, timeout=5):
+        self.host = host
+        self.port = port
+        self.contexto = contexto or _ssl_context()
+        self.max_libres = max_libres
+        self.timeout = timeout
+        self._libres = []
+        self._lock = threading.Lock()
+
+    def _tomar(self):
+        with self._lock:
+            if self._libres:
+                return self._libres.pop(), True
+        return http.client.HTTPSConnection(self.host, self.port, context=self.contexto), False
+
+    def _devolver(self, conn):
+        with self._lock:
+            if len(self._libres) < self.max_libres:
+                self._libres.append(conn)
+                return
+        conn.close()
+
+    def cerrar(self):
+        """Cierra las conexiones libres del pool."""
+        with self._lock:
+            libres, self._libres = self._libres, []
+        for conn in libres:
+            conn.close()
+
+    def peticion(self, token, metodo, datos=None, timeout=None):
+        """
+        POST a /bot<token>/<metodo>. Devuelve (status_http, json_respuesta).
+        Los errores de red (sin respuesta HTTP) se propagan como OSError o
+        http.client.HTTPException.
+        """
+        cuerpo = urllib.parse.urlencode(datos or {}).encode()
+        cabeceras = {'Content-Type': 'application/x-www-form-urlencoded'}
+        timeout = timeout or self.timeout
+        conn, reutilizada = self._tomar()
+        while True:
+            try:
+                conn.timeout = timeout
+                if conn.sock is not None:
+                    conn.sock.settimeout(timeout)
+                conn.request('POST', f'/bot{token}/{metodo}', body=cuerpo, headers=cabeceras)
+                resp = conn.getresponse()
+                crudo = resp.read()
+                break
+            except _ERRORES_CONEXION_CERRADA:
+                conn.close()
+                if not reutilizada:
+                    raise
+                # El servidor cerró la conexión inactiva: una sola vez con una nueva
+                reutilizada = False
+            except Exception:
+                conn.close()
+                raise
+
+        if resp.will_close:
+            conn.close()
+        else:
+            self._devolver(conn)
+        try:
+            return resp.status, json.loads(crudo)
+        except ValueError:
+            return resp.status, {}
+
+
+_cliente = None
+_cliente_lock = threading.Lock()
+
+
+def cliente() -> ClienteTelegram:
+    """Cliente compartido por todo el proceso."""
+    global _cliente
+    if _cliente is None:
+        with _cliente_lock:
+            if _cliente is None:
+                _cliente = ClienteTelegram()
+    return _cliente
+
+
+# ─────────────────────────────────────────────
+# Límites de envío de Telegram
+# ─────────────────────────────────────────────
+
+class Limitador:
+    """
+    Cubetas de fichas: `por_chat` mensajes/s en cada chat y `total` mensajes/s
+    en todo el bot (límites de Telegram: ~1/s por chat y 30/s en global).
+    Un 429 con retry_after bloquea el chat hasta que pase ese tiempo.
+    Es por proceso y seguro entre hilos.
+    """
+
+    def __init__(self, por_chat=1.0, total=30.0, max_chats=1000):
+        self.por_chat = por_chat
+        self.total = total
+        self.max_chats = max_chats
+        self._chats = {}            # chat_id -> (fichas, instante)
+        self._global = (total, time.monotonic())
+        self._bloqueos = {}         # chat_id -> instante hasta el que no se envía
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _recargar(cubeta, tasa, capacidad, ahora):
+        fichas, instante = cubeta
+        return min(capacidad, fichas + (ahora - instante) * tasa)
+
+    def reservar(self, chat_id) -> float:
+        """
+        Consume una ficha del chat y otra global si hay ambas y devuelve 0.
+        Si no, no consume nada y devuelve los segundos que faltan.
+        """
+        chat_id = str(chat_id)
+        with self._lock:
+            ahora = time.monotonic()
+            bloqueo = self._bloqueos.get(chat_id, 0) - ahora
+            if bloqueo > 0:
+                return bloqueo
+            self._bloqueos.pop(chat_id, None)
+
+            f_chat = self._recargar(self._chats.get(chat_id, (1.0, ahora)), self.por_chat, 1.0, ahora)
+            f_global = self._recargar(self._global, self.total, self.total, ahora)
+            espera = max((1 - f_chat) / self.por_chat, (1 - f_global) / self.total, 0)
+            if espera > 0:
+                return espera
+
+            if len(self._chats) >= self.max_chats:
+                # Los chats con la cubeta llena no aportan nada: se olvidan
+                self._chats = {c: v for c, v in self._chats.items() if ahora - v[1] < 1 / self.por_chat}
+            self._chats[chat_id] = (f_chat - 1, ahora)
+            self._global = (f_global - 1, ahora)
+            return 0
+
+    def bloquear(self, chat_id, segundos):
+        """Tras un 429: no enviar a ese chat hasta dentro de `segundos`."""
+        with self._lock:
+            self._bloqueos[str(chat_id)] = time.monotonic() + segundos
+
+    def esperar_turno(self, chat_id, maximo) -> bool:
+        """Bloquea hasta poder enviar; False si habría que esperar más de `maximo` s."""
+        while True:
+            espera = self.reservar(chat_id)
+            if not espera:
+                return True
+            if espera > maximo:
+                return False
+            time.sleep(espera)
+
+
+limitador = Limitador()
+
+# Los envíos síncronos (respuestas del bot, botón de prueba) esperan como mucho esto
+ESPERA_SINCRONA = 5
+
+
 # ─────────────────────────────────────────────
 # Núcleo: envío básico
 # ─────────────────────────────────────────────
@@ -60,42 +246,79 @@ def diagnosticar() -> dict:
         return {'ok': False, 'error': 'TELEGRAM_CHAT_ID no configurado en .env'}
 
     # Verificar token con getMe
-    url = f'https://api.telegram.org/bot{token}/getMe'
     try:
-        with urllib.request.urlopen(url, timeout=5, context=_ssl_context()) as resp:
-            data = json.loads(resp.read())
-            if data.get('ok'):
-                bot_name = data['result'].get('username', '?')
-                return {'ok': True, 'bot': bot_name, 'chat_id': chat_id}
-            return {'ok': False, 'error': 'Respuesta inesperada de Telegram'}
-    except urllib.error.HTTPError as e:
-        if e.code == 401:
-            return {'ok': False, 'error': 'Token inválido (401) — regenera el token en @BotFather'}
-        return {'ok': False, 'error': f'HTTP {e.code}: {e.reason}'}
+        status, data = cliente().peticion(token, 'getMe')
     except Exception as e:
         return {'ok': False, 'error': str(e)}
+    if data.get('ok'):
+        bot_name = data['result'].get('username', '?')
+        return {'ok': True, 'bot': bot_name, 'chat_id': chat_id}
+    if status == 401:
+        return {'ok': False, 'error': 'Token inválido (401) — regenera el token en @BotFather'}
+    if status != 200:
+        return {'ok': False, 'error': f'HTTP {status}: {data.get("description", "")}'}
+    return {'ok': False, 'error': 'Respuesta inesperada de Telegram'}
 
 
-def _enviar_a_chat(token: str, chat_id: str, texto: str) -> bool:
-    """Envío interno a un chat_id específico."""
-    url = f'https://api.telegram.org/bot{token}/sendMessage'
-    datos = urllib.parse.urlencode({
-        'chat_id': chat_id,
-        'text': texto,
-        'parse_mode': 'HTML',
-    }).encode('utf-8')
+def _llamar(token: str, chat_id: str, metodo: str, datos: dict):
+    """
+    Llamada a la Bot API sin esperar turno en el limitador.
+    Devuelve (ok, error, retry_after); retry_after solo viene con un 429.
+    """
     try:
-        req = urllib.request.Request(url, data=datos, method='POST')
-        with urllib.request.urlopen(req, timeout=5, context=_ssl_context()) as resp:
-            resultado = json.loads(resp.read())
-            return resultado.get('ok', False)
-    except urllib.error.HTTPError as e:
-        body = e.read().decode('utf-8', errors='ignore')
-        logger.error(f'Telegram HTTPError {e.code}: {body}')
-        return False
+        status, resultado = cliente().peticion(token, metodo, datos)
     except Exception as e:
         logger.error(f'Telegram error: {e}')
-        return False
+        return False, str(e), None
+    if resultado.get('ok', False):
+        return True, None, None
+    descripcion = resultado.get('description', 'Respuesta inesperada de Telegram')
+    if status == 429:
+        retry_after = (resultado.get('parameters') or {}).get('retry_after') or 1
+        limitador.bloquear(chat_id, retry_after)
+        logger.warning(f'Telegram 429 en chat {chat_id}: reintentar en {retry_after}s')
+        return False, f'HTTP 429: {descripcion[:300]}', retry_after
+    if status != 200:
+        logger.error(f'Telegram HTTPError {status}: {descripcion}')
+        return False, f'HTTP {status}: {descripcion[:300]}', None
+    return False, descripcion, None
+
+
+def _datos_mensaje(chat_id, texto, teclado=None):
+    datos = {'chat_id': chat_id, 'text': texto, 'parse_mode': 'HTML'}
+    if teclado:
+        datos['reply_markup'] = json.dumps({'inline_keyboard': teclado})
+    return datos
+
+
+def _enviar_detalle(token: str, chat_id: str, texto: str, teclado=None):
+    """Envío interno a un chat_id específico. Devuelve (ok, error, retry_after)."""
+    return _llamar(token, chat_id, 'sendMessage', _datos_mensaje(chat_id, texto, teclado))
+
+
+def _con_turno(chat_id, llamada) -> bool:
+    """Ejecuta `llamada()` respetando el limitador (reintenta una vez tras un 429 corto)."""
+    for _ in range(2):
+        if not limitador.esperar_turno(chat_id, ESPERA_SINCRONA):
+            logger.warning(f'Telegram: chat {chat_id} limitado, mensaje descartado')
+            return False
+        ok, _, retry_after = llamada()
+        if ok or not retry_after:
+            return ok
+    return False
+
+
+def _enviar_a_chat(token: str, chat_id: str, texto: str, teclado=None) -> bool:
+    """Envío síncrono a un chat_id específico."""
+    return _con_turno(chat_id, lambda: _enviar_detalle(token, chat_id, texto, teclado))
+
+
+def enviar_a_chat_detalle(chat_id: str, texto: str):
+    """Envío usado por la cola (que ya ha pedido turno): devuelve (ok, error, retry_after)."""
+    token, _ = _get_credenciales()
+    if not token or 'PON_AQUI' in token:
+        return False, 'TELEGRAM_BOT_TOKEN no configurado', None
+    return _enviar_detalle(token, chat_id, texto)
 
 
 def enviar_mensaje(texto: str) -> bool:
@@ -109,18 +332,62 @@ def enviar_mensaje(texto: str) -> bool:
     return _enviar_a_chat(token, chat_id, texto)
 
 
-def enviar_mensaje_a(chat_id_destino: str, texto: str) -> bool:
+def enviar_mensaje_a(chat_id_destino: str, texto: str, teclado=None) -> bool:
     """
     Envía un mensaje HTML a un chat_id específico (ej: técnico asignado).
+    `teclado`: filas de botones inline, p. ej. [[{'text': '›', 'callback_data': 'x'}]].
+    """
+    token, _ = _get_credenciales()
+    if not token or not chat_id_destino or 'PON_AQUI' in token:
+        return False
+    return _enviar_a_chat(token, chat_id_destino, texto, teclado)
+
+
+def editar_mensaje(chat_id: str, message_id: int, texto: str, teclado=None) -> bool:
+    """Sustituye el texto (y los botones) de un mensaje ya enviado por el bot."""
+    token, _ = _get_credenciales()
+    if not token or 'PON_AQUI' in token:
+        return False
+    datos = _datos_mensaje(chat_id, texto, teclado)
+    datos['message_id'] = message_id
+    return _con_turno(chat_id, lambda: _llamar(token, chat_id, 'editMessageText', datos))
+
+
+def responder_callback(callback_id: str, texto: str = '') -> bool:
+    """Confirma la pulsación de un botón inline (quita el reloj del cliente)."""
+    token, _ = _get_credenciales()
+    if not token or 'PON_AQUI' in token:
+        return False
+    datos = {'callback_query_id': callback_id}
+    if texto:
+        datos['text'] = texto
+    return _llamar(token, None, 'answerCallbackQuery', datos)[0]
+
+
+def encolar_mensaje(texto: str) -> bool:
     """
+    Como enviar_mensaje(), pero deja el mensaje en la cola persistente y vuelve
+    enseguida; el envío (con reintentos) lo hace telegram_cola en segundo plano.
+    """
+    token, chat_id = _get_credenciales()
+    if not token or not chat_id or 'PON_AQUI' in token or 'PON_AQUI' in chat_id:
+        logger.warning('Telegram no configurado — revisa .env')
+        return False
+    from telegram_cola import encolar
+    return encolar(chat_id, texto)
+
+
+def encolar_mensaje_a(chat_id_destino: str, texto: str) -> bool:
+    """Como enviar_mensaje_a(), pero a través de la cola."""
     token, _ = _get_credenciales()
     if not token or not chat_id_destino or 'PON_AQUI' in token:
         return False
-    return _enviar_a_chat(token, chat_id_destino, texto)
+    from telegram_cola import encolar
+    return encolar(chat_id_destino, texto)
 
 
 # ─────────────────────────────────────────────
-# Notificaciones de avisos
+# Notificaciones de avisos (van por la cola)
 # ─────────────────────────────────────────────
 
 def notificar_aviso_nuevo(aviso) -> bool:
@@ -142,7 +409,7 @@ def notificar_aviso_nuevo(aviso) -> bool:
         lineas.append(f'📝 {aviso.descripcion[:300]}')
 
     texto = '\n'.join(lineas)
-    ok = enviar_mensaje(texto)
+    ok = encolar_mensaje(texto)
 
     # Notificar también al técnico asignado (si tiene chat_id distinto al admin)
     if aviso.tecnico and aviso.tecnico.telegram_chat_id:
@@ -150,7 +417,7 @@ def notificar_aviso_nuevo(aviso) -> bool:
         _, admin_chat = _get_credenciales()
         if tg_id and tg_id != admin_chat:
             asignado_txt = texto + f'\n\n📌 <i>Asignado a ti: {aviso.tecnico.display_name}</i>'
-            enviar_mensaje_a(tg_id, asignado_txt)
+            encolar_mensaje_a(tg_id, asignado_txt)
 
     return ok
 
@@ -185,7 +452,7 @@ def notificar_cambio_estado(aviso, estado_anterior: str) -> bool:
     if aviso.notas:
         lineas.append(f'📝 {aviso.notas[:150]}')
 
-    return enviar_mensaje('\n'.join(lineas))
+    return encolar_mensaje('\n'.join(lineas))
 
 
 def notificar_resumen_dia(avisos_hoy) -> bool:
@@ -194,7 +461,7 @@ def notificar_resumen_dia(avisos_hoy) -> bool:
     hoy_str = date.today().strftime('%d/%m/%Y')
 
     if not avisos_hoy:
-        return enviar_mensaje(
+        return encolar_mensaje(
             f'📅 <b>Resumen del día — {hoy_str}</b>\n\n'
             '✅ No tienes citas programadas para hoy.'
         )
@@ -212,7 +479,7 @@ def notificar_resumen_dia(avisos_hoy) -> bool:
             lineas.append(f'   📝 {av.notas[:100]}')
         lineas.append('')
 
-    return enviar_mensaje('\n'.join(lineas))
+    return encolar_mensaje('\n'.join(lineas))
 
 
 def notificar_material_pendiente(avisos_material) -> bool:
@@ -232,4 +499,4 @@ def notificar_material_pendiente(avisos_material) -> bool:
             lineas.append(f'  📝 {av.notas[:80]}')
         lineas.append('')
 
-    return enviar_mensaje('\n'.join(lineas))
+    return encolar_mensaje('\n'.join(lineas))
@@ -0,0 +1,240 @@
+"""
+Cola persistente de mensajes salientes de Telegram (tabla telegram_outbox).
+
+Las peticiones web solo encolan; un hilo en segundo plano (uno por proceso,
+arrancado con la aplicación) o el comando `flask telegram-worker` vacían
+la cola con reintentos y espera exponencial. El comando también ejecuta los
+updates del bot que guarda el webhook (telegram_entrada). Cada mensaje se reclama con un
+UPDATE atómico, así que varios procesos pueden drenar a la vez sin duplicar.
+
+Los mensajes nuevos esperan VENTANA segundos antes de salir: si en ese tiempo
+llegan más para el mismo chat (varios cambios de estado seguidos), se mandan
+juntos en un único resumen. Los envíos respetan el limitador de telegram_bot
+(~1 msg/s por chat, 30 msg/s en total) y el retry_after de los 429.
+"""
+import logging
+import threading
+import time
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, update
+
+from extensions import db
+from models import MensajeTelegram
+
+logger = logging.getLogger(__name__)
+
+MAX_INTENTOS  = 6
+ESPERA_BASE   = 5      # segundos; se duplica en cada reintento
+ESPERA_MAXIMA = 3600
+RESERVA       = 120    # un 'enviando' más antiguo que esto se da por huérfano
+INTERVALO     = 30     # sondeo del hilo cuando no hay avisos de mensajes nuevos
+VENTANA       = 3      # segundos que espera un mensaje nuevo por si llegan más
+MAX_AGRUPADOS = 10
+MAX_TEXTO     = 4096   # límite de Telegram por mensaje
+SEPARADOR     = '\n\n┈┈┈┈┈┈┈┈┈┈\n\n'
+
+_despertar = threading.Event()
+_hilo = None
+_hilo_lock = threading.Lock()
+
+
+def encolar(chat_id, texto):
+    """Guarda el mensaje en la cola y despierta al hilo de envío."""
+    db.session.add(MensajeTelegram(
+        chat_id=str(chat_id), texto=texto,
+        proximo_intento=datetime.utcnow() + timedelta(seconds=VENTANA),
+    ))
+    db.session.commit()
+    _asegurar_hilo(current_app._get_current_object())
+    _despertar.set()
+    return True
+
+
+def _reclamar_fila(conn, fila_id, listo, ahora):
+    """UPDATE condicionado: si otro proceso la reclamó antes, rowcount = 0."""
+    t = MensajeTelegram.__table__
+    res = conn.execute(
+        update(t)
+        .where(t.c.id == fila_id, listo)
+        .values(estado='enviando', proximo_intento=ahora + timedelta(seconds=RESERVA))
+    )
+    return res.rowcount == 1
+
+
+def _reclamar(conn, ahora):
+    """
+    Marca como 'enviando' el siguiente mensaje listo y los demás del mismo
+    chat que quepan en un resumen: los listos y también los nuevos cuya
+    VENTANA aún no ha vencido (llegaron durante la del primero). Devuelve sus
+    filas (lista vacía si no hay).
+    """
+    t = MensajeTelegram.__table__
+    listo = db.and_(t.c.estado.in_(('pendiente', 'enviando')), t.c.proximo_intento <= ahora)
+    agrupable = db.or_(listo, db.and_(t.c.estado == 'pendiente', t.c.intentos == 0))
+    columnas = (t.c.id, t.c.chat_id, t.c.texto, t.c.intentos)
+    while True:
+        fila = conn.execute(
+            select(*columnas).where(listo)
+            .order_by(t.c.proximo_intento, t.c.id).limit(1)
+        ).first()
+        if fila is None:
+            return []
+        if _reclamar_fila(conn, fila.id, listo, ahora):
+            break
+
+    filas = [fila]
+    largo = len(fila.texto)
+    for otra in conn.execute(
+        select(*columnas)
+        .where(agrupable, t.c.chat_id == fila.chat_id, t.c.id != fila.id)
+        .order_by(t.c.id).limit(MAX_AGRUPADOS - 1)
+    ).all():
+        largo += len(SEPARADOR) + len(otra.texto)
+        if largo > MAX_TEXTO - 100:     # margen para la cabecera
+            break
+        if _reclamar_fila(conn, otra.id, agrupable, ahora):
+            filas.append(otra)
+    return filas
+
+
+def _componer(filas):
+    if len(filas) == 1:
+        return filas[0].texto
+    cabecera = f'🗂 <b>{len(filas)} notificaciones</b>'
+    return cabecera + SEPARADOR + SEPARADOR.join(f.texto for f in filas)
+
+
+def _aplazar(conn, filas, segundos, error=None):
+    """Devuelve las filas a 'pendiente' sin gastar intento (límite de envío)."""
+    t = MensajeTelegram.__table__
+    valores = {'estado': 'pendiente',
+               'proximo_intento': datetime.utcnow() + timedelta(seconds=segundos)}
+    if error:
+        valores['ultimo_error'] = error
+    conn.execute(update(t).where(t.c.id.in_([f.id for f in filas])).values(**valores))
+
+
+def _resultado(conn, fila, ok, error):
+    t = MensajeTelegram.__table__
+    ahora = datetime.utcnow()
+    if ok:
+        valores = {'estado': 'enviado', 'enviado_at': ahora, 'ultimo_error': None}
+    else:
+        intentos = fila.intentos + 1
+        espera = min(ESPERA_BASE * 2 ** (intentos - 1), ESPERA_MAXIMA)
+        valores = {
+            'estado': 'fallido' if intentos >= MAX_INTENTOS else 'pendiente',
+            'intentos': intentos,
+            'proximo_intento': ahora + timedelta(seconds=espera),
+            'ultimo_error': (error or 'Error desconocido')[:1000],
+        }
+    conn.execute(update(t).where(t.c.id == fila.id).values(**valores))
+
+
+def procesar_cola(limite=50):
+    """Envía hasta `limite` mensajes listos. Devuelve cuántos se intentaron."""
+    from telegram_bot import enviar_a_chat_detalle, limitador
+
+    procesados = 0
+    while procesados < limite:
+        with db.engine.begin() as conn:
+            filas = _reclamar(conn, datetime.utcnow())
+        if not filas:
+            break
+        chat_id = filas[0].chat_id
+
+        espera = limitador.reservar(chat_id)
+        if espera:
+            with db.engine.begin() as conn:
+                _aplazar(conn, filas, espera)
+            continue
+
+        ok, error, retry_after = enviar_a_chat_detalle(chat_id, _componer(filas))
+        with db.engine.begin() as conn:
+            if retry_after:
+                _aplazar(conn, filas, retry_after, error)
+            else:
+                for fila in filas:
+                    _resultado(conn, fila, ok, error)
+        if not ok:
+            logger.warning(f'Telegram: mensajes {[f.id for f in filas]} no enviados ({error})')
+        procesados += len(filas)
+    return procesados
+
+
+def _siguiente_espera():
+    """Segundos hasta el próximo mensaje pendiente (como mucho INTERVALO)."""
+    t = MensajeTelegram.__table__
+    with db.engine.connect() as conn:
+        proximo = conn.execute(
+            select(db.func.min(t.c.proximo_intento))
+            .where(t.c.estado.in_(('pendiente', 'enviando')))
+        ).scalar()
+    if proximo is None:
+        return INTERVALO
+    return min(max((proximo - datetime.utcnow()).total_seconds(), 0.05), INTERVALO)
+
+
+def _bucle(app, parar=None):
+    while not (parar and parar.is_set()):
+        _despertar.clear()
+        espera = INTERVALO
+        try:
+            with app.app_context():
+                procesar_cola()
+                espera = _siguiente_espera()
+        except Exception:
+            logger.exception('Error procesando la cola de Telegram')
+        _despertar.wait(espera)
+
+
+def _asegurar_hilo(app):
+    global _hilo
+    if app.testing or not app.config.get('TELEGRAM_COLA_HILO'):
+        return
+    with _hilo_lock:
+        if _hilo is None or not _hilo.is_alive():
+            _hilo = threading.Thread(target=_bucle, args=(app,),
+                                     name='telegram-cola', daemon=True)
+            _hilo.start()
+
+
+def iniciar(app):
+    """Arranca el hilo de envío con el proceso: la cola puede traer mensajes de antes del reinicio."""
+    _asegurar_hilo(app)
+
+
+def reintentar(mensaje_id):
+    """Vuelve a poner en cola un mensaje fallido."""
+    msg = db.session.get(MensajeTelegram, mensaje_id)
+    if msg is None:
+        return False
+    msg.estado = 'pendiente'
+    msg.intentos = 0
+    msg.proximo_intento = datetime.utcnow()
+    db.session.commit()
+    _asegurar_hilo(current_app._get_current_object())
+    _despertar.set()
+    return True
+
+
+@click.command('telegram-worker')
+@with_appcontext
+def telegram_worker_command():
+    """Vacía la cola de Telegram y ejecuta los comandos recibidos, en primer plano (alternativa a los hilos)."""
+    from telegram_entrada import procesar_pendientes
+
+    app = current_app._get_current_object()
+    click.echo('Procesando la cola de Telegram (Ctrl+C para salir)…')
+    try:
+        while True:
+            enviados = procesar_cola()
+            recibidos = procesar_pendientes(app)
+            if not (enviados or recibidos):
+                time.sleep(min(_siguiente_espera(), 2))
+    except KeyboardInterrupt:
+        click.echo('Detenido.')
@@ -5,13 +5,289 @@ Comandos disponibles:
   /pendientes   — avisos pendientes
   /material     — esperando material
   /morosos      — clientes morosos
-  /buscar TEXTO — busca por nombre, teléfono o calle
+  /buscar TEXTO — busca por cliente, teléfono, dirección, marca o notas
   /aviso NUM    — detalle de un aviso por ID
   /stats        — estadísticas del día
   /ayuda        — lista de comandos
+
+Cada comando responde en el chat que lo envió. El chat de TELEGRAM_CHAT_ID y
+los administradores ven todos los avisos; un técnico (User.telegram_chat_id)
+solo los suyos; cualquier otro chat recibe su Chat ID para darlo de alta.
+Las listas se piden por páginas (LIMIT/OFFSET) y se recorren con los botones
+inline «‹ Anterior» / «Siguiente ›», que editan el mismo mensaje.
+
+Las respuestas de los comandos de consulta se guardan CACHE_TTL segundos por
+(comando, argumentos, página, alcance, versión de los avisos). La versión es
+una fila de version_datos que sube en la misma transacción que cualquier
+alta, cambio o borrado de un Aviso, así que un cambio hecho en otro proceso
+también deja de servir lo guardado: leerla es una consulta por clave primaria.
+
+Para añadir un comando basta con decorar `funcion(ctx, args)` con
+@comando('/nombre', ayuda='…'): el dispatcher, la ayuda y las métricas
+(latencia, consultas SQL y errores, en /dashboard/telegram) lo recogen solos.
+Cada update se procesa en un único app context y sesión.
 """
+import threading
+import time
 from datetime import date
-from telegram_bot import enviar_mensaje, enviar_mensaje_a
+
+from sqlalchemy import event, func, select
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from extensions import db
+from models import Aviso, VersionDatos
+from telegram_bot import (enviar_mensaje_a, editar_mensaje, responder_callback,
+                          _get_credenciales)
+
+POR_PAGINA = 8
+MAX_TEXTO  = 4096   # límite de Telegram por mensaje
+CACHE_TTL  = 30
+CACHE_MAX  = 256
+
+
+class Contexto:
+    """Quién pide el comando y dónde se contesta."""
+
+    def __init__(self, chat_id, usuario_id=None, es_admin=False, pagina=0, message_id=None):
+        self.chat_id = str(chat_id)
+        self.usuario_id = usuario_id
+        self.es_admin = es_admin
+        self.pagina = pagina
+        self.message_id = message_id     # si viene de un botón, se edita ese mensaje
+
+    def responder(self, texto, teclado=None):
+        texto = _recortar(texto)
+        if self.message_id:
+            return editar_mensaje(self.chat_id, self.message_id, texto, teclado)
+        return enviar_mensaje_a(self.chat_id, texto, teclado)
+
+
+# ── Caché de respuestas ────────────────────────────────────────────────────
+
+class CacheRespuestas:
+    """Respuestas ya formateadas con caducidad."""
+
+    def __init__(self, ttl=CACHE_TTL, maximo=CACHE_MAX):
+        self.ttl = ttl
+        self.maximo = maximo
+        self._datos = {}        # clave -> (expira, respuesta)
+        self._lock = threading.Lock()
+
+    def obtener(self, clave, calcular):
+        ahora = time.monotonic()
+        with self._lock:
+            entrada = self._datos.get(clave)
+            if entrada and entrada[0] > ahora:
+                return entrada[1]
+
+        respuesta = calcular()
+
+        with self._lock:
+            if len(self._datos) >= self.maximo:
+                self._datos = {k: v for k, v in self._datos.items() if v[0] > ahora}
+                if len(self._datos) >= self.maximo:
+                    self._datos.clear()
+            self._datos[clave] = (ahora + self.ttl, respuesta)
+        return respuesta
+
+
+cache = CacheRespuestas()
+
+
+def _avisos_cambiados(mapper, connection, target):
+    # En la conexión del flush: la versión sube o no junto con el cambio
+    tabla = VersionDatos.__table__
+    ins = sqlite_insert(tabla).values(nombre='aviso', version=1)
+    connection.execute(ins.on_conflict_do_update(
+        index_elements=['nombre'], set_={'version': tabla.c.version + 1}))
+
+
+for _evento in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Aviso, _evento, _avisos_cambiados)
+
+
+def _version_avisos():
+    version = db.session.scalar(select(VersionDatos.version).where(VersionDatos.nombre == 'aviso'))
+    return version or 0
+
+
+def _cacheado(nombre, args, ctx, calcular):
+    # La versión se lee antes de calcular: lo guardado nunca es más antiguo que su clave
+    alcance = 'admin' if ctx.es_admin else ctx.usuario_id
+    clave = (nombre, args, ctx.pagina, alcance, date.today(), _version_avisos())
+    return cache.obtener(clave, calcular)
+
+
+def _recortar(texto):
+    """Corta en el último salto de línea antes del límite (las etiquetas HTML no cruzan líneas)."""
+    if len(texto) <= MAX_TEXTO:
+        return texto
+    corte = texto.rfind('\n', 0, MAX_TEXTO - 2)
+    return texto[:corte if corte > 0 else MAX_TEXTO - 2] + '\n…'
+
+
+def _filtro(ctx):
+    """Un técnico solo ve los avisos que tiene asignados o que creó."""
+    if ctx.es_admin:
+        return []
+    return [db.or_(Aviso.asignado_a == ctx.usuario_id,
+                   Aviso.created_by == ctx.usuario_id)]
+
+
+def _pagina(query, ctx):
+    """(avisos de la página, total, hay_más) sin cargar más filas que las de la página."""
+    total = query.order_by(None).count()
+    avisos = query.offset(ctx.pagina * POR_PAGINA).limit(POR_PAGINA).all()
+    return avisos, total, (ctx.pagina + 1) * POR_PAGINA < total
+
+
+def _callback(nombre, pagina, args=''):
+    """callback_data de Telegram, o None si no cabe en sus 64 bytes."""
+    datos = f'pag|{nombre}|{pagina}|{args}'
+    return datos if len(datos.encode()) <= 64 else None
+
+
+def _teclado(nombre, ctx, hay_mas, args=''):
+    """
+    Botones de página, o None si los argumentos no caben en callback_data:
+    recortarlos haría que «Siguiente ›» mostrara otra búsqueda.
+    """
+    if _callback(nombre, ctx.pagina + 1, args) is None:
+        return None
+    botones = []
+    if ctx.pagina > 0:
+        botones.append({'text': '‹ Anterior', 'callback_data': _callback(nombre, ctx.pagina - 1, args)})
+    if hay_mas:
+        botones.append({'text': 'Siguiente ›', 'callback_data': _callback(nombre, ctx.pagina + 1, args)})
+    return [botones] if botones else None
+
+
+def _titulo(texto, total, ctx):
+    paginas = -(-total // POR_PAGINA)
+    sufijo = f' · pág. {ctx.pagina + 1}/{paginas}' if paginas > 1 else ''
+    return f'{texto} ({total}){sufijo}</b>'
+
+
+# ── Registro de comandos y métricas ───────────────────────────────────────
+
+# Cubetas del histograma de latencia (ms); la última es "más de 2500"
+LIMITES_MS = (10, 25, 50, 100, 250, 500, 1000, 2500)
+
+
+class Comando:
+    def __init__(self, nombre, funcion, ayuda='', uso='', cacheable=False):
+        self.nombre = nombre
+        self.funcion = funcion
+        self.ayuda = ayuda
+        self.uso = uso
+        self.cacheable = cacheable
+
+
+class Metricas:
+    """Contadores de un comando desde que arrancó el proceso."""
+
+    def __init__(self):
+        self.llamadas = 0
+        self.desde_cache = 0
+        self.errores = 0
+        self.consultas = 0
+        self.total_ms = 0.0
+        self.max_ms = 0.0
+        self.histograma = [0] * (len(LIMITES_MS) + 1)
+        self.ultimo_error = None
+
+    def registrar(self, ms, consultas, desde_cache=False, error=None):
+        self.llamadas += 1
+        self.desde_cache += desde_cache
+        self.consultas += consultas
+        self.total_ms += ms
+        self.max_ms = max(self.max_ms, ms)
+        self.histograma[sum(ms > limite for limite in LIMITES_MS)] += 1
+        if error is not None:
+            self.errores += 1
+            self.ultimo_error = f'{type(error).__name__}: {error}'[:200]
+
+    @property
+    def media_ms(self):
+        return self.total_ms / self.llamadas if self.llamadas else 0.0
+
+    @property
+    def consultas_media(self):
+        return self.consultas / self.llamadas if self.llamadas else 0.0
+
+
+COMANDOS = {}        # '/nombre' (y alias) -> Comando
+_metricas = {}       # '/nombre' -> Metricas
+_metricas_lock = threading.Lock()
+_hilo = threading.local()
+
+
+def comando(nombre, *alias, ayuda='', uso='', cacheable=False):
+    """
+    Registra `funcion(ctx, args)` como /nombre. Devuelve el texto de la
+    respuesta o (texto, teclado). cacheable=True solo para comandos de consulta.
+    """
+    def registrar(funcion):
+        cmd = Comando(nombre, funcion, ayuda, uso, cacheable)
+        for n in (nombre, *alias):
+            COMANDOS[n] = cmd
+        return funcion
+    return registrar
+
+
+def metricas():
+    """Copia de las métricas por comando, para el panel."""
+    with _metricas_lock:
+        return [
+            {
+                'comando': nombre,
+                'llamadas': m.llamadas,
+                'desde_cache': m.desde_cache,
+                'errores': m.errores,
+                'media_ms': round(m.media_ms, 1),
+                'max_ms': round(m.max_ms, 1),
+                'consultas_media': round(m.consultas_media, 1),
+                'histograma': list(m.histograma),
+                'ultimo_error': m.ultimo_error,
+            }
+            for nombre, m in sorted(_metricas.items())
+        ]
+
+
+# Registrado una vez al importar (en la clase Engine: no hace falta app
+# context) y no desde los hilos que ejecutan comandos, que lo duplicarían
+@event.listens_for(Engine, 'before_cursor_execute')
+def _contar_sql(conn, cursor, statement, parameters, context, executemany):
+    if getattr(_hilo, 'consultas', None) is not None:
+        _hilo.consultas += 1
+
+
+def _medir(cmd, ctx, args):
+    """Ejecuta el comando (o lo toma de la caché) y anota latencia, consultas y errores."""
+    calculado = False
+
+    def calcular():
+        nonlocal calculado
+        calculado = True
+        return cmd.funcion(ctx, args)
+
+    _hilo.consultas = 0
+    error = None
+    t0 = time.perf_counter()
+    try:
+        if cmd.cacheable:
+            return _cacheado(cmd.nombre, args, ctx, calcular)
+        return calcular()
+    except Exception as e:
+        error = e
+        raise
+    finally:
+        ms = (time.perf_counter() - t0) * 1000
+        consultas, _hilo.consultas = _hilo.consultas, None
+        with _metricas_lock:
+            _metricas.setdefault(cmd.nombre, Metricas()).registrar(
+                ms, consultas, desde_cache=not calculado, error=error)
 
 
 def _fmt_aviso(av, idx=None):
@@ -29,251 +305,305 @@ def _fmt_aviso(av, idx=None):
     return '\n'.join(lineas)
 
 
-def _cmd_hoy(app):
-    with app.app_context():
-        from models import Aviso
-        hoy = date.today()
-        avisos = Aviso.query.filter(
-            Aviso.fecha_cita == hoy,
-            Aviso.estado != 'finalizado'
-        ).order_by(Aviso.calle).all()
-
-        hoy_str = hoy.strftime('%d/%m/%Y')
-        if not avisos:
-            return enviar_mensaje(f'📅 <b>Hoy {hoy_str}</b>\n\n✅ Sin citas para hoy.')
-
-        lineas = [f'📅 <b>Citas de hoy — {hoy_str} ({len(avisos)})</b>', '']
-        for i, av in enumerate(avisos, 1):
-            lineas.append(_fmt_aviso(av, i))
-            lineas.append('')
-        return enviar_mensaje('\n'.join(lineas))
-
-
-def _cmd_pendientes(app):
-    with app.app_context():
-        from models import Aviso
-        avisos = Aviso.query.filter(
-            Aviso.estado.in_(['pendiente', 'segunda_visita'])
-        ).order_by(Aviso.fecha_aviso.desc()).limit(10).all()
+@comando('/hoy', ayuda='Citas de hoy con dirección', cacheable=True)
+def _cmd_hoy(ctx, args):
+    hoy = date.today()
+    query = Aviso.query.filter(
+        Aviso.fecha_cita == hoy,
+        Aviso.estado != 'finalizado',
+        *_filtro(ctx)
+    ).order_by(Aviso.calle, Aviso.id)
+    avisos, total, hay_mas = _pagina(query, ctx)
+
+    hoy_str = hoy.strftime('%d/%m/%Y')
+    if not total:
+        return f'📅 <b>Hoy {hoy_str}</b>\n\n✅ Sin citas para hoy.'
+
+    lineas = [_titulo(f'📅 <b>Citas de hoy — {hoy_str}', total, ctx), '']
+    for i, av in enumerate(avisos, ctx.pagina * POR_PAGINA + 1):
+        lineas.append(_fmt_aviso(av, i))
+        lineas.append('')
+    return '\n'.join(lineas), _teclado('/hoy', ctx, hay_mas)
+
+
+@comando('/pendientes', ayuda='Avisos sin asignar', cacheable=True)
+def _cmd_pendientes(ctx, args):
+    query = Aviso.query.filter(
+        Aviso.estado.in_(['pendiente', 'segunda_visita']),
+        *_filtro(ctx)
+    ).order_by(Aviso.fecha_aviso.desc(), Aviso.id.desc())
+    avisos, total, hay_mas = _pagina(query, ctx)
+
+    if not total:
+        return '⏳ <b>Pendientes</b>\n\n✅ No hay avisos pendientes.'
+
+    lineas = [_titulo('⏳ <b>Pendientes', total, ctx), '']
+    for av in avisos:
+        lineas.append(_fmt_aviso(av))
+        lineas.append('')
+    return '\n'.join(lineas), _teclado('/pendientes', ctx, hay_mas)
+
+
+@comando('/material', ayuda='Esperando piezas', cacheable=True)
+def _cmd_material(ctx, args):
+    query = Aviso.query.filter(
+        Aviso.estado == 'esperando_material',
+        *_filtro(ctx)
+    ).order_by(Aviso.updated_at, Aviso.id)
+    avisos, total, hay_mas = _pagina(query, ctx)
+
+    if not total:
+        return '📦 <b>Material</b>\n\n✅ Ningún aviso esperando material.'
+
+    lineas = [_titulo('📦 <b>Esperando material', total, ctx), '']
+    for av in avisos:
+        dias = (date.today() - av.updated_at.date()).days if av.updated_at else '?'
+        lineas.append(_fmt_aviso(av))
+        lineas.append(f'   ⏱ {dias} día(s) esperando')
+        lineas.append('')
+    return '\n'.join(lineas), _teclado('/material', ctx, hay_mas)
+
+
+@comando('/morosos', ayuda='Clientes morosos', cacheable=True)
+def _cmd_morosos(ctx, args):
+    filtros = (Aviso.cobro_estado == 'moroso', *_filtro(ctx))
+
+    # Número y suma en SQL (max(…, 0) como Aviso.total_cliente)
+    importe = func.max(
+        func.coalesce(Aviso.precio_mano_obra, 0) +
+        func.coalesce(Aviso.gastos_extra, 0) -
+        func.coalesce(Aviso.descuento, 0), 0)
+    total, suma = db.session.query(
+        func.count(Aviso.id), func.coalesce(func.sum(importe), 0)
+    ).filter(*filtros).one()
+
+    if not total:
+        return '💰 <b>Morosos</b>\n\n✅ Sin clientes morosos.'
+
+    avisos = (Aviso.query.filter(*filtros)
+              .order_by(Aviso.updated_at.desc(), Aviso.id.desc())
+              .offset(ctx.pagina * POR_PAGINA).limit(POR_PAGINA).all())
+    hay_mas = (ctx.pagina + 1) * POR_PAGINA < total
+
+    lineas = [_titulo(f'⚠️ <b>Morosos — {suma:.2f} € pendientes', total, ctx), '']
+    for av in avisos:
+        lineas.append(f'<b>{av.nombre_cliente}</b>  <code>#{av.id}</code>')
+        lineas.append(f'   📞 {av.telefono}')
+        lineas.append(f'   💶 {av.total_cliente:.2f} €')
+        if av.electrodomestico:
+            lineas.append(f'   🔧 {av.electrodomestico}')
+        lineas.append('')
+    return '\n'.join(lineas), _teclado('/morosos', ctx, hay_mas)
 
-        if not avisos:
-            return enviar_mensaje('⏳ <b>Pendientes</b>\n\n✅ No hay avisos pendientes.')
 
-        lineas = [f'⏳ <b>Pendientes ({len(avisos)})</b>', '']
-        for av in avisos:
-            lineas.append(_fmt_aviso(av))
-            lineas.append('')
-        return enviar_mensaje('\n'.join(lineas))
+@comando('/buscar', uso='<i>texto</i>', ayuda='Busca por nombre/tel/calle/marca/notas', cacheable=True)
+def _cmd_buscar(ctx, termino):
+    if not termino:
+        return '🔍 Uso: /buscar nombre o teléfono\nEjemplo: /buscar García'
+    from busqueda import buscar
+    query = buscar(
+        Aviso.query.filter(Aviso.estado != 'finalizado', *_filtro(ctx)),
+        termino, por_relevancia=True
+    ).order_by(Aviso.fecha_aviso.desc(), Aviso.id.desc())
+    avisos, total, hay_mas = _pagina(query, ctx)
+
+    if not total:
+        return f'🔍 Sin resultados para "<b>{termino}</b>"'
+
+    lineas = [_titulo(f'🔍 <b>Búsqueda: "{termino}"', total, ctx), '']
+    for av in avisos:
+        estado = av.estado_label()
+        lineas.append(_fmt_aviso(av))
+        lineas.append(f'   📌 {estado}')
+        lineas.append('')
+    teclado = _teclado('/buscar', ctx, hay_mas, termino)
+    if hay_mas and teclado is None:
+        lineas.append('ℹ️ Texto demasiado largo para pasar de página: afina la búsqueda.')
+    return '\n'.join(lineas), teclado
+
+
+@comando('/aviso', uso='<i>número</i>', ayuda='Detalle completo de un aviso', cacheable=True)
+def _cmd_aviso(ctx, num_str):
+    if not num_str.isdigit():
+        return '❌ Uso: /aviso número\nEjemplo: /aviso 42'
+    av = Aviso.query.filter(Aviso.id == int(num_str), *_filtro(ctx)).first()
+    if not av:
+        return f'❌ Aviso #{num_str} no encontrado.'
+
+    lineas = [
+        f'📋 <b>Aviso #{av.id}</b>  —  {av.estado_label()}',
+        '',
+        f'👤 <b>{av.nombre_cliente}</b>',
+        f'📞 {av.telefono}',
+    ]
+    if av.calle:
+        lineas.append(f'📍 {av.calle}' + (f', {av.localidad}' if av.localidad else ''))
+    if av.electrodomestico:
+        lineas.append(f'🔧 {av.electrodomestico}' + (f' · {av.marca}' if av.marca else ''))
+    if av.descripcion:
+        lineas.append(f'📝 {av.descripcion[:1500]}')
+    if av.notas:
+        lineas.append(f'🗒 Notas: {av.notas[:1500]}')
+    if av.fecha_cita:
+        lineas.append(f'🗓 Cita: {av.fecha_cita.strftime("%d/%m/%Y")}')
+    if av.tiene_datos_economicos:
+        lineas.append('')
+        if av.precio_mano_obra is not None:
+            lineas.append(f'💶 Mano de obra: {av.precio_mano_obra:.2f} €')
+        if av.coste_materiales is not None:
+            lineas.append(f'🔩 Materiales: {av.coste_materiales:.2f} €')
+        lineas.append(f'💰 Beneficio: {av.beneficio:.2f} €')
+    return '\n'.join(lineas)
 
 
-def _cmd_material(app):
-    with app.app_context():
-        from models import Aviso
-        avisos = Aviso.query.filter_by(
-            estado='esperando_material'
-        ).order_by(Aviso.updated_at).all()
+@comando('/stats', ayuda='Resumen y facturación del mes', cacheable=True)
+def _cmd_stats(ctx, args):
+    hoy = date.today()
+    filtro = _filtro(ctx)
+
+    total_activos   = Aviso.query.filter(Aviso.estado != 'finalizado', *filtro).count()
+    citas_hoy       = Aviso.query.filter(Aviso.fecha_cita == hoy, Aviso.estado != 'finalizado', *filtro).count()
+    pendientes      = Aviso.query.filter(Aviso.estado == 'pendiente', *filtro).count()
+    material        = Aviso.query.filter(Aviso.estado == 'esperando_material', *filtro).count()
+    segunda         = Aviso.query.filter(Aviso.estado == 'segunda_visita', *filtro).count()
+    finalizados_hoy = Aviso.query.filter(
+        Aviso.estado == 'finalizado',
+        Aviso.fecha_finalizado >= hoy,
+        *filtro
+    ).count()
+
+    # Facturación del mes actual (rango sobre fecha_finalizado)
+    inicio_mes = date(hoy.year, hoy.month, 1)
+    inicio_sig = date(hoy.year + hoy.month // 12, hoy.month % 12 + 1, 1)
+    del_mes = (
+        Aviso.estado == 'finalizado',
+        Aviso.fecha_finalizado >= inicio_mes,
+        Aviso.fecha_finalizado < inicio_sig,
+        *filtro,
+    )
+    factura = db.session.query(
+        func.sum(Aviso.precio_mano_obra + Aviso.coste_materiales)
+    ).filter(*del_mes).scalar() or 0.0
+
+    beneficio_mes = db.session.query(
+        func.sum(Aviso.precio_mano_obra - db.func.coalesce(Aviso.coste_materiales, 0))
+    ).filter(
+        *del_mes,
+        Aviso.precio_mano_obra.isnot(None)
+    ).scalar() or 0.0
+
+    titulo = 'Estadísticas' if ctx.es_admin else 'Tus estadísticas'
+    lineas = [
+        f'📊 <b>{titulo} — {hoy.strftime("%d/%m/%Y")}</b>',
+        '',
+        f'📅 Citas hoy:        <b>{citas_hoy}</b>',
+        f'⏳ Pendientes:       <b>{pendientes}</b>',
+        f'📦 Esperando mat.:   <b>{material}</b>',
+        f'🔁 Segunda visita:   <b>{segunda}</b>',
+        f'✅ Finalizados hoy:  <b>{finalizados_hoy}</b>',
+        f'📂 Total activos:    <b>{total_activos}</b>',
+        '',
+        f'💶 Facturado este mes: <b>{factura:.2f} €</b>',
+        f'💰 Beneficio este mes: <b>{beneficio_mes:.2f} €</b>',
+    ]
+    return '\n'.join(lineas)
 
-        if not avisos:
-            return enviar_mensaje('📦 <b>Material</b>\n\n✅ Ningún aviso esperando material.')
 
-        lineas = [f'📦 <b>Esperando material ({len(avisos)})</b>', '']
-        for av in avisos:
-            dias = (date.today() - av.updated_at.date()).days if av.updated_at else '?'
-            lineas.append(_fmt_aviso(av))
-            lineas.append(f'   ⏱ {dias} día(s) esperando')
-            lineas.append('')
-        return enviar_mensaje('\n'.join(lineas))
-
-
-def _cmd_morosos(app):
-    with app.app_context():
-        from models import Aviso
-        avisos = Aviso.query.filter_by(
-            cobro_estado='moroso'
-        ).order_by(Aviso.updated_at.desc()).all()
-
-        if not avisos:
-            return enviar_mensaje('💰 <b>Morosos</b>\n\n✅ Sin clientes morosos.')
-
-        total = sum(av.total_cliente for av in avisos)
-        lineas = [f'⚠️ <b>Morosos ({len(avisos)}) — {total:.2f} € pendientes</b>', '']
-        for av in avisos:
-            lineas.append(f'<b>{av.nombre_cliente}</b>  <code>#{av.id}</code>')
-            lineas.append(f'   📞 {av.telefono}')
-            lineas.append(f'   💶 {av.total_cliente:.2f} €')
-            if av.electrodomestico:
-                lineas.append(f'   🔧 {av.electrodomestico}')
-            lineas.append('')
-        return enviar_mensaje('\n'.join(lineas))
-
-
-def _cmd_buscar(app, termino):
-    if not termino:
-        return enviar_mensaje('🔍 Uso: /buscar nombre o teléfono\nEjemplo: /buscar García')
-    with app.app_context():
-        from models import Aviso
-        from extensions import db
-        like = f'%{termino}%'
-        avisos = Aviso.query.filter(
-            db.or_(
-                Aviso.nombre_cliente.ilike(like),
-                Aviso.telefono.ilike(like),
-                Aviso.calle.ilike(like),
-            ),
-            Aviso.estado != 'finalizado'
-        ).order_by(Aviso.fecha_aviso.desc()).limit(8).all()
-
-        if not avisos:
-            return enviar_mensaje(f'🔍 Sin resultados para "<b>{termino}</b>"')
-
-        lineas = [f'🔍 <b>Búsqueda: "{termino}" ({len(avisos)})</b>', '']
-        for av in avisos:
-            estado = av.estado_label()
-            lineas.append(_fmt_aviso(av))
-            lineas.append(f'   📌 {estado}')
-            lineas.append('')
-        return enviar_mensaje('\n'.join(lineas))
-
-
-def _cmd_aviso(app, num_str):
-    if not num_str.isdigit():
-        return enviar_mensaje('❌ Uso: /aviso número\nEjemplo: /aviso 42')
-    with app.app_context():
-        from models import Aviso
-        av = Aviso.query.get(int(num_str))
-        if not av:
-            return enviar_mensaje(f'❌ Aviso #{num_str} no encontrado.')
-
-        lineas = [
-            f'📋 <b>Aviso #{av.id}</b>  —  {av.estado_label()}',
-            '',
-            f'👤 <b>{av.nombre_cliente}</b>',
-            f'📞 {av.telefono}',
-        ]
-        if av.calle:
-            lineas.append(f'📍 {av.calle}' + (f', {av.localidad}' if av.localidad else ''))
-        if av.electrodomestico:
-            lineas.append(f'🔧 {av.electrodomestico}' + (f' · {av.marca}' if av.marca else ''))
-        if av.descripcion:
-            lineas.append(f'📝 {av.descripcion}')
-        if av.notas:
-            lineas.append(f'🗒 Notas: {av.notas}')
-        if av.fecha_cita:
-            lineas.append(f'🗓 Cita: {av.fecha_cita.strftime("%d/%m/%Y")}')
-        if av.tiene_datos_economicos:
-            lineas.append('')
-            if av.precio_mano_obra is not None:
-                lineas.append(f'💶 Mano de obra: {av.precio_mano_obra:.2f} €')
-            if av.coste_materiales is not None:
-                lineas.append(f'🔩 Materiales: {av.coste_materiales:.2f} €')
-            lineas.append(f'💰 Beneficio: {av.beneficio:.2f} €')
-        return enviar_mensaje('\n'.join(lineas))
-
-
-def _cmd_stats(app):
-    with app.app_context():
-        from models import Aviso
-        from extensions import db
-        hoy = date.today()
-
-        total_activos   = Aviso.query.filter(Aviso.estado != 'finalizado').count()
-        citas_hoy       = Aviso.query.filter(Aviso.fecha_cita == hoy, Aviso.estado != 'finalizado').count()
-        pendientes      = Aviso.query.filter_by(estado='pendiente').count()
-        material        = Aviso.query.filter_by(estado='esperando_material').count()
-        segunda         = Aviso.query.filter_by(estado='segunda_visita').count()
-        finalizados_hoy = Aviso.query.filter(
-            Aviso.estado == 'finalizado',
-            Aviso.updated_at >= date.today()
-        ).count()
-
-        # Facturación del mes actual
-        from sqlalchemy import extract, func
-        mes = date.today().month
-        anio = date.today().year
-        factura = db.session.query(
-            func.sum(Aviso.precio_mano_obra + Aviso.coste_materiales)
-        ).filter(
-            Aviso.estado == 'finalizado',
-            extract('month', Aviso.updated_at) == mes,
-            extract('year', Aviso.updated_at) == anio,
-        ).scalar() or 0.0
-
-        beneficio_mes = db.session.query(
-            func.sum(Aviso.precio_mano_obra - db.func.coalesce(Aviso.coste_materiales, 0))
-        ).filter(
-            Aviso.estado == 'finalizado',
-            extract('month', Aviso.updated_at) == mes,
-            extract('year', Aviso.updated_at) == anio,
-            Aviso.precio_mano_obra.isnot(None)
-        ).scalar() or 0.0
-
-        lineas = [
-            f'📊 <b>Estadísticas — {hoy.strftime("%d/%m/%Y")}</b>',
-            '',
-            f'📅 Citas hoy:        <b>{citas_hoy}</b>',
-            f'⏳ Pendientes:       <b>{pendientes}</b>',
-            f'📦 Esperando mat.:   <b>{material}</b>',
-            f'🔁 Segunda visita:   <b>{segunda}</b>',
-            f'✅ Finalizados hoy:  <b>{finalizados_hoy}</b>',
-            f'📂 Total activos:    <b>{total_activos}</b>',
-            '',
-            f'💶 Facturado este mes: <b>{factura:.2f} €</b>',
-            f'💰 Beneficio este mes: <b>{beneficio_mes:.2f} €</b>',
-        ]
-        return enviar_mensaje('\n'.join(lineas))
-
-
-def _cmd_ayuda():
-    texto = (
-        '🤖 <b>Comandos disponibles</b>\n\n'
-        '/hoy — Citas de hoy con dirección\n'
-        '/pendientes — Avisos sin asignar\n'
-        '/material — Esperando piezas\n'
-        '/morosos — Clientes morosos\n'
-        '/buscar <i>texto</i> — Busca por nombre/tel/calle\n'
-        '/aviso <i>número</i> — Detalle completo de un aviso\n'
-        '/stats — Resumen y facturación del mes\n'
-        '/ayuda — Esta ayuda\n'
-    )
-    return enviar_mensaje(texto)
+@comando('/ayuda', '/help', '/start', ayuda='Esta ayuda')
+def _cmd_ayuda(ctx, args):
+    vistos = []
+    for cmd in COMANDOS.values():
+        if cmd not in vistos:
+            vistos.append(cmd)
+    lineas = ['🤖 <b>Comandos disponibles</b>', '']
+    for cmd in vistos:
+        uso = f' {cmd.uso}' if cmd.uso else ''
+        lineas.append(f'{cmd.nombre}{uso} — {cmd.ayuda}')
+    texto = '\n'.join(lineas) + '\n'
+    if not ctx.es_admin:
+        texto += '\n<i>Solo se muestran tus avisos (asignados o creados por ti).</i>'
+    return texto
 
 
 # ── Dispatcher principal ───────────────────────────────────────────────────
 
-def procesar_update(update: dict, app) -> bool:
-    """
-    Recibe un update de Telegram y ejecuta el comando correspondiente.
-    Devuelve True si se procesó algo.
-    """
-    message = update.get('message') or update.get('edited_message')
-    if not message:
+def _contexto(chat_id, **kwargs):
+    """Contexto del chat, o None si no es el chat admin ni el de un usuario activo."""
+    from models import User
+    _, admin_chat = _get_credenciales()
+    if admin_chat and str(chat_id) == admin_chat:
+        return Contexto(chat_id, es_admin=True, **kwargs)
+    usuario = User.query.filter_by(telegram_chat_id=str(chat_id), is_active=True).first()
+    if usuario is None:
+        return None
+    return Contexto(chat_id, usuario.id, usuario.es_admin, **kwargs)
+
+
+def _ejecutar(nombre, args, ctx):
+    cmd = COMANDOS.get(nombre)
+    if cmd is None:
+        respuesta = f'❓ Comando desconocido: <code>{nombre}</code>\nEscribe /ayuda para ver los disponibles.'
+    else:
+        try:
+            respuesta = _medir(cmd, ctx, args)
+        except Exception:
+            db.session.rollback()
+            ctx.responder(f'⚠️ Error ejecutando <code>{cmd.nombre}</code>. Inténtalo más tarde.')
+            raise
+
+    # Se suelta la conexión antes de hablar con Telegram
+    db.session.close()
+    if isinstance(respuesta, str):
+        respuesta = (respuesta, None)
+    ctx.responder(*respuesta)
+
+
+def _procesar_callback(callback) -> bool:
+    """Botones «‹ Anterior» / «Siguiente ›»: data = 'pag|/comando|página|args'."""
+    responder_callback(callback.get('id', ''))
+    mensaje = callback.get('message') or {}
+    chat_id = (mensaje.get('chat') or {}).get('id')
+    partes = (callback.get('data') or '').split('|', 3)
+    if chat_id is None or len(partes) != 4 or partes[0] != 'pag' or not partes[2].isdigit():
+        return False
+
+    ctx = _contexto(chat_id, pagina=int(partes[2]), message_id=mensaje.get('message_id'))
+    if ctx is None:
         return False
+    _ejecutar(partes[1], partes[3], ctx)
+    return True
+
 
+def _procesar_mensaje(message) -> bool:
     text = message.get('text', '').strip()
-    if not text.startswith('/'):
+    chat_id = (message.get('chat') or {}).get('id')
+    if not text.startswith('/') or chat_id is None:
         return False
 
     partes  = text.split(maxsplit=1)
     comando = partes[0].split('@')[0].lower()   # /comando@BotNombre → /comando
     args    = partes[1].strip() if len(partes) > 1 else ''
 
-    if comando == '/hoy':
-        _cmd_hoy(app)
-    elif comando == '/pendientes':
-        _cmd_pendientes(app)
-    elif comando == '/material':
-        _cmd_material(app)
-    elif comando == '/morosos':
-        _cmd_morosos(app)
-    elif comando == '/buscar':
-        _cmd_buscar(app, args)
-    elif comando == '/aviso':
-        _cmd_aviso(app, args)
-    elif comando == '/stats':
-        _cmd_stats(app)
-    elif comando in ('/ayuda', '/help', '/start'):
-        _cmd_ayuda()
-    else:
-        enviar_mensaje(f'❓ Comando desconocido: <code>{comando}</code>\nEscribe /ayuda para ver los disponibles.')
+    ctx = _contexto(chat_id)
+    if ctx is None:
+        enviar_mensaje_a(str(chat_id),
+                         '⛔ Este chat no está autorizado.\n'
+                         f'Pide al administrador que añada tu Chat ID: <code>{chat_id}</code>')
+        return True
 
+    _ejecutar(comando, args, ctx)
     return True
+
+
+def procesar_update(update: dict, app) -> bool:
+    """
+    Recibe un update de Telegram y ejecuta el comando correspondiente
+    dentro de un único app context. Devuelve True si se procesó algo.
+    """
+    with app.app_context():
+        if update.get('callback_query'):
+            return _procesar_callback(update['callback_query'])
+        message = update.get('message') or update.get('edited_message')
+        if not message:
+            return False
+        return _procesar_mensaje(message)
@@ -0,0 +1,241 @@
+"""
+Entrada de updates del bot de Telegram (tabla telegram_inbox).
+
+El webhook solo guarda el update y responde 200 enseguida; los comandos se
+ejecutan en un pool de hilos del proceso (TELEGRAM_HILOS) o, donde la app no
+puede tener hilos (uWSGI en PythonAnywhere), en `flask telegram-worker`. Si un comando lento hace que
+Telegram reenvíe el mismo update, el INSERT sobre update_id (clave primaria)
+no hace nada y el comando no se ejecuta dos veces. Los updates que quedaron
+pendientes en un reinicio se procesan al arrancar. Se conservan los últimos
+MAX_GUARDADOS updates, suficiente para cubrir los reintentos de Telegram.
+
+Donde no llegan webhooks (local, staging) `flask telegram-poll` pide los
+updates con getUpdates (long polling) y los mete en la misma tabla; el offset
+es el mayor update_id guardado, así que sobrevive a reinicios.
+"""
+import json
+import logging
+import os
+import signal
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import select, update, delete, func
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from extensions import db
+from models import UpdateTelegram
+
+logger = logging.getLogger(__name__)
+
+MAX_GUARDADOS = 1000
+RESERVA       = 300    # un 'procesando' más antiguo que esto se da por huérfano
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def registrar_update(update_json) -> bool:
+    """
+    Guarda el update si no se había recibido antes. Devuelve True si es nuevo.
+    Requiere app context.
+    """
+    update_id = update_json.get('update_id')
+    if not isinstance(update_id, int):
+        return False
+    t = UpdateTelegram.__table__
+    res = db.session.execute(
+        sqlite_insert(t)
+        .values(update_id=update_id, payload=json.dumps(update_json),
+                estado='pendiente', recibido_at=datetime.utcnow())
+        .on_conflict_do_nothing(index_elements=['update_id'])
+    )
+    db.session.commit()
+    return res.rowcount == 1
+
+
+def _reclamar(conn, ahora):
+    """Marca como 'procesando' el update pendiente más antiguo. Devuelve su fila o None."""
+    t = UpdateTelegram.__table__
+    listo = db.or_(
+        t.c.estado == 'pendiente',
+        db.and_(t.c.estado == 'procesando',
+                t.c.recibido_at < ahora - timedelta(seconds=RESERVA)),
+    )
+    while True:
+        fila = conn.execute(
+            select(t.c.update_id, t.c.payload).where(listo)
+            .order_by(t.c.update_id).limit(1)
+        ).first()
+        if fila is None:
+            return None
+        # Se reutiliza recibido_at como marca de la reserva
+        res = conn.execute(
+            update(t).where(t.c.update_id == fila.update_id, listo)
+            .values(estado='procesando', recibido_at=ahora)
+        )
+        if res.rowcount == 1:
+            return fila
+
+
+def _recortar(conn):
+    """Borra los updates ya procesados más allá de los MAX_GUARDADOS últimos."""
+    t = UpdateTelegram.__table__
+    corte = conn.execute(
+        select(t.c.update_id).order_by(t.c.update_id.desc())
+        .offset(MAX_GUARDADOS).limit(1)
+    ).scalar()
+    if corte is not None:
+        conn.execute(delete(t).where(t.c.update_id <= corte,
+                                     t.c.estado.in_(('procesado', 'error'))))
+
+
+def procesar_pendientes(app):
+    """Ejecuta los comandos de todos los updates pendientes. Devuelve cuántos."""
+    from telegram_commands import procesar_update
+
+    procesados = 0
+    while True:
+        with app.app_context():
+            with db.engine.begin() as conn:
+                fila = _reclamar(conn, datetime.utcnow())
+        if fila is None:
+            break
+        error = None
+        try:
+            procesar_update(json.loads(fila.payload), app)
+        except Exception as e:
+            logger.exception(f'Error procesando el update {fila.update_id}')
+            error = str(e)[:1000]
+        with app.app_context():
+            with db.engine.begin() as conn:
+                conn.execute(
+                    update(UpdateTelegram.__table__)
+                    .where(UpdateTelegram.__table__.c.update_id == fila.update_id)
+                    .values(estado='error' if error else 'procesado',
+                            procesado_at=datetime.utcnow(), error=error)
+                )
+                _recortar(conn)
+        procesados += 1
+    return procesados
+
+
+def _tarea(app):
+    try:
+        procesar_pendientes(app)
+    except Exception:
+        logger.exception('Error en el pool de comandos de Telegram')
+
+
+def despachar(app=None):
+    """
+    Encarga al pool de hilos que procese los updates pendientes. Sin pool
+    (TELEGRAM_HILOS = 0) se quedan en la tabla para `flask telegram-worker`.
+    """
+    global _pool, _pool_pid
+    app = app or current_app._get_current_object()
+    hilos = app.config.get('TELEGRAM_HILOS', 0)
+    if app.testing or not hilos:
+        return
+    with _pool_lock:
+        # Un pool creado antes de un fork (workers de uWSGI/gunicorn) no tiene hilos en el hijo
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix='telegram-cmd')
+            _pool_pid = os.getpid()
+    _pool.submit(_tarea, app)
+
+
+# ── Long polling (alternativa al webhook) ─────────────────────────────────
+
+def _offset():
+    ultimo = db.session.execute(select(func.max(UpdateTelegram.update_id))).scalar()
+    return ultimo + 1 if ultimo is not None else None
+
+
+def sondear(app, parar, hilos=2, timeout=25, cliente=None):
+    """
+    Bucle getUpdates hasta que se active el Event `parar`. Los updates se
+    registran como los del webhook y los comandos se ejecutan en un pool de
+    `hilos`; al salir se espera a que terminen los que estén en marcha.
+    """
+    from telegram_bot import _get_credenciales, cliente as cliente_compartido
+
+    cliente = cliente or cliente_compartido()
+    token, _ = _get_credenciales()
+    pool = ThreadPoolExecutor(max_workers=hilos, thread_name_prefix='telegram-poll')
+    try:
+        while not parar.is_set():
+            # La sesión se cierra antes del long poll: no retener la base de datos
+            with app.app_context():
+                offset = _offset()
+            datos = {'timeout': timeout}
+            if offset is not None:
+                datos['offset'] = offset
+            try:
+                status, respuesta = cliente.peticion(token, 'getUpdates', datos,
+                                                     timeout=timeout + 10)
+            except Exception as e:
+                logger.warning(f'getUpdates falló: {e}')
+                parar.wait(5)
+                continue
+            if not respuesta.get('ok'):
+                if status == 409:
+                    logger.error('Hay un webhook activo: usa --borrar-webhook '
+                                 'o deleteWebhook para poder usar getUpdates')
+                else:
+                    logger.warning(f'getUpdates HTTP {status}: {respuesta.get("description")}')
+                parar.wait(5)
+                continue
+            with app.app_context():
+                nuevos = sum(registrar_update(u) for u in respuesta.get('result', []))
+            if nuevos:
+                pool.submit(_tarea, app)
+    finally:
+        pool.shutdown(wait=True)
+
+
+@click.command('telegram-poll')
+@click.option('--hilos', default=2, show_default=True, help='Comandos en paralelo.')
+@click.option('--timeout', default=25, show_default=True, help='Segundos de cada long poll.')
+@click.option('--borrar-webhook', is_flag=True, help='Quita el webhook antes de empezar.')
+@with_appcontext
+def telegram_poll_command(hilos, timeout, borrar_webhook):
+    """Recibe los comandos del bot con getUpdates (sin webhook)."""
+    from telegram_bot import _get_credenciales, cliente
+
+    app = current_app._get_current_object()
+    token, _ = _get_credenciales()
+    if not token or 'PON_AQUI' in token:
+        raise click.ClickException('TELEGRAM_BOT_TOKEN no configurado en .env')
+    if borrar_webhook:
+        cliente().peticion(token, 'deleteWebhook')
+
+    # Pendientes de una ejecución anterior
+    procesar_pendientes(app)
+
+    parar = threading.Event()
+
+    def _detener(signum, frame):
+        click.echo('Deteniendo: se terminan los comandos en curso…')
+        parar.set()
+
+    signal.signal(signal.SIGINT, _detener)
+    signal.signal(signal.SIGTERM, _detener)
+
+    # El long poll va en otro hilo para que la señal no tenga que esperar a
+    # que termine la petición en curso: lo que esta traiga y no se haya
+    # guardado se vuelve a recibir la próxima vez (aún no tiene offset).
+    hilo = threading.Thread(target=sondear, args=(app, parar, hilos, timeout),
+                            name='telegram-poll', daemon=True)
+    hilo.start()
+    click.echo(f'Escuchando updates de Telegram ({hilos} hilos, Ctrl+C para salir)…')
+    while hilo.is_alive() and not parar.is_set():
+        parar.wait(1)
+    hilo.join(timeout=2)
+    procesar_pendientes(app)
+    click.echo('Detenido.')
@@ -0,0 +1,27 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config  # noqa: E402
+
+
+@pytest.fixture
+def app(tmp_path):
+    from app import create_app
+
+    class ConfigPruebas(Config):
+        TESTING = True
+        SQLALCHEMY_DATABASE_URI = 'sqlite:///' + str(tmp_path / 'pruebas.db')
+        UPLOAD_FOLDER = str(tmp_path / 'uploads')
+
+    return create_app(ConfigPruebas)
+
+
+@pytest.fixture
+def cliente(app):
+    cliente = app.test_client()
+    cliente.post('/login', data={'username': 'admin', 'password': 'admin123'})
+    return cliente
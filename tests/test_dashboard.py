@@ -0,0 +1,58 @@
+from contextlib import contextmanager
+from datetime import date, timedelta
+
+from sqlalchemy import event
+
+from extensions import db
+from models import Aviso, User
+
+
+@contextmanager
+def contar_consultas():
+    sentencias = []
+
+    def anotar(conn, cursor, sentencia, *args):
+        sentencias.append(sentencia)
+
+    event.listen(db.engine, 'before_cursor_execute', anotar)
+    try:
+        yield sentencias
+    finally:
+        event.remove(db.engine, 'before_cursor_execute', anotar)
+
+
+def _crear_avisos(n):
+    """Avisos de hoy y pendientes, cada uno con su técnico, para que se pinten en el panel."""
+    hoy = date.today()
+    inicio = Aviso.query.count()
+    for i in range(inicio, inicio + n):
+        tecnico = User(username=f'tecnico_prueba{i}', password='x', rol='tecnico')
+        db.session.add(Aviso(
+            nombre_cliente=f'Cliente {i}', telefono=f'600{i:06d}',
+            estado=('pendiente', 'segunda_visita', 'hoy')[i % 3],
+            fecha_cita=hoy if i % 2 else hoy + timedelta(days=i % 7),
+            tecnico=tecnico,
+        ))
+    db.session.commit()
+
+
+def _consultas_panel(app, cliente):
+    with app.app_context():
+        with contar_consultas() as sentencias:
+            respuesta = cliente.get('/')
+    assert respuesta.status_code == 200
+    return len(sentencias)
+
+
+def test_panel_no_crece_con_los_avisos(app, cliente):
+    with app.app_context():
+        _crear_avisos(3)
+    pocas = _consultas_panel(app, cliente)
+
+    with app.app_context():
+        _crear_avisos(40)
+    muchas = _consultas_panel(app, cliente)
+
+    assert muchas == pocas
+    # usuario de la sesión, contadores, avisos de hoy y pendientes
+    assert pocas <= 4
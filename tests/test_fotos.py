@@ -0,0 +1,58 @@
+import io
+import os
+import time
+
+from extensions import db
+from fotos import _bloquear_subida, _guardar_por_contenido, relativa, ruta_subida
+from limpieza import barrer
+from models import Aviso, BorradoPendiente
+
+
+def _envejecer(ruta, segundos):
+    viejo = time.time() - segundos
+    os.utime(ruta, (viejo, viejo))
+
+
+def test_foto_repetida_renueva_el_archivo_y_el_barrido_la_respeta(app):
+    carpeta = app.config['UPLOAD_FOLDER']
+    with app.app_context():
+        nombre = _guardar_por_contenido(io.BytesIO(b'foto'), carpeta, 'jpg')
+        ruta = os.path.join(carpeta, relativa(nombre))
+        _envejecer(ruta, 3600)
+        # La última Photo que lo usaba se borró: su archivo queda pendiente
+        db.session.add(BorradoPendiente(filename=nombre))
+        db.session.commit()
+
+        # Otra subida con el mismo contenido lo reutiliza antes del barrido
+        assert _guardar_por_contenido(io.BytesIO(b'foto'), carpeta, 'jpg') == nombre
+        assert time.time() - os.path.getmtime(ruta) < 60
+
+        assert barrer() == 0
+        assert os.path.exists(ruta)
+        assert BorradoPendiente.query.count() == 1
+
+        _envejecer(ruta, 3600)
+        assert barrer() == 1
+        assert not os.path.exists(ruta)
+        assert BorradoPendiente.query.count() == 0
+
+
+def test_trozo_de_una_subida_ocupada_devuelve_409(app, cliente):
+    with app.app_context():
+        aviso = Aviso(nombre_cliente='Cliente', telefono='600000000')
+        db.session.add(aviso)
+        db.session.commit()
+        url = f'/avisos/{aviso.id}/fotos/upload'
+        upload_id = 'a' * 32
+        ruta = ruta_subida(aviso.id, upload_id)
+
+    cabeceras = {'X-Upload-Id': upload_id, 'X-Filename': 'placa.jpg',
+                 'Content-Range': 'bytes 0-3/8'}
+    with _bloquear_subida(ruta):
+        respuesta = cliente.post(url, data=b'abcd', headers=cabeceras)
+    assert respuesta.status_code == 409
+    assert 'recibido' not in respuesta.get_json()
+    assert not os.path.exists(ruta)
+
+    respuesta = cliente.post(url, data=b'abcd', headers=cabeceras)
+    assert respuesta.get_json() == {'ok': True, 'recibido': 4}
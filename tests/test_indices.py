@@ -0,0 +1,84 @@
+"""
+Planes de las consultas del panel y de estadísticas (EXPLAIN QUERY PLAN):
+los filtros por técnico y por estado deben resolverse con los índices
+compuestos de Aviso, nunca recorriendo la tabla entera.
+"""
+import re
+
+import pytest
+from sqlalchemy import event
+
+from extensions import db
+
+RECORRIDO_TABLA = re.compile(r'^SCAN (TABLE )?aviso$')
+
+
+def _planes(app, cliente, url):
+    """Plan de cada sentencia sobre aviso que ejecuta la petición."""
+    sentencias = []
+
+    def anotar(conn, cursor, sentencia, parametros, *args):
+        if 'FROM aviso' in sentencia:
+            sentencias.append((sentencia, parametros))
+
+    with app.app_context():
+        event.listen(db.engine, 'before_cursor_execute', anotar)
+        try:
+            assert cliente.get(url).status_code == 200
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', anotar)
+
+        conexion = db.engine.raw_connection()
+        try:
+            return [[fila[3] for fila in conexion.execute('EXPLAIN QUERY PLAN ' + s, p)]
+                    for s, p in sentencias]
+        finally:
+            conexion.close()
+
+
+def _sin_recorrer_aviso(planes):
+    assert planes
+    for plan in planes:
+        assert not any(RECORRIDO_TABLA.match(paso) for paso in plan), plan
+
+
+def _usa(planes, indice):
+    return any(f'USING INDEX {indice} ' in paso for plan in planes for paso in plan)
+
+
+@pytest.fixture
+def cliente_tecnico(app):
+    cliente = app.test_client()
+    cliente.post('/login', data={'username': 'tecnico1', 'password': 'tecnico123'})
+    return cliente
+
+
+@pytest.mark.parametrize('url', ['/', '/stats/api/resumen', '/stats/api/aparatos'])
+def test_filtro_tecnico_usa_indices_compuestos(app, cliente_tecnico, url):
+    planes = _planes(app, cliente_tecnico, url)
+    _sin_recorrer_aviso(planes)
+    # asignado_a = ? OR created_by = ? se resuelve con un índice por rama
+    assert _usa(planes, 'ix_aviso_asignado_estado_cita')
+    assert _usa(planes, 'ix_aviso_creador_estado')
+
+
+def test_panel_admin_no_recorre_aviso(app, cliente):
+    planes = _planes(app, cliente, '/')
+    _sin_recorrer_aviso(planes)
+    assert _usa(planes, 'ix_aviso_cita_estado')
+
+
+@pytest.mark.parametrize('url, indice', [
+    ('/stats/api/morosos', 'ix_aviso_cobro_updated'),
+    ('/stats/api/tecnicos', 'ix_aviso_asignado_estado_cita'),
+])
+def test_estadisticas_admin_usan_indices(app, cliente, url, indice):
+    planes = _planes(app, cliente, url)
+    _sin_recorrer_aviso(planes)
+    assert _usa(planes, indice)
+
+
+def test_morosos_tecnico_usa_indice_cobro(app, cliente_tecnico):
+    planes = _planes(app, cliente_tecnico, '/stats/api/morosos')
+    _sin_recorrer_aviso(planes)
+    assert _usa(planes, 'ix_aviso_cobro_updated')
@@ -0,0 +1,52 @@
+import sqlite3
+from datetime import date
+
+import pytest
+
+import telegram_bot
+import telegram_commands
+from extensions import db
+from models import Aviso
+
+
+@pytest.fixture
+def enviados(monkeypatch):
+    textos = []
+    monkeypatch.setattr(telegram_bot, '_enviar_a_chat',
+                        lambda token, chat_id, texto, *args: (textos.append(texto), True)[1])
+    monkeypatch.setattr(telegram_bot, '_get_credenciales', lambda: ('token', '999'))
+    monkeypatch.setattr(telegram_commands, '_get_credenciales', lambda: ('token', '999'))
+    return textos
+
+
+def _pedir(app, texto):
+    with app.app_context():
+        telegram_commands.procesar_update({'update_id': 1, 'message': {'chat': {'id': 999}, 'text': texto}}, app)
+
+
+def test_cache_ve_los_cambios_de_otro_proceso(app, enviados):
+    with app.app_context():
+        for i in range(3):
+            db.session.add(Aviso(nombre_cliente=f'Cliente {i}', telefono='600000000',
+                                 fecha_aviso=date.today(), estado='pendiente'))
+        db.session.commit()
+        ruta_bd = db.engine.url.database
+
+    _pedir(app, '/pendientes')
+    assert '(3)' in enviados[-1].split('\n')[0]
+
+    # Otro proceso finaliza un aviso: no pasa por los eventos de este
+    with sqlite3.connect(ruta_bd) as otro:
+        otro.execute("UPDATE aviso SET estado = 'finalizado' WHERE id = 1")
+        otro.execute("UPDATE version_datos SET version = version + 1 WHERE nombre = 'aviso'")
+
+    _pedir(app, '/pendientes')
+    assert '(2)' in enviados[-1].split('\n')[0]
+
+
+def test_busqueda_larga_sin_botones_de_pagina():
+    corto = telegram_commands._teclado('/buscar', telegram_commands.Contexto(1), True, 'García')
+    assert corto[0][0]['callback_data'] == 'pag|/buscar|1|García'
+
+    largo = 'Avenida de la Constitución de 1812, Chiclana de la Frontera'
+    assert telegram_commands._teclado('/buscar', telegram_commands.Contexto(1), True, largo) is None
@@ -8,6 +8,10 @@ Configuración del archivo WSGI en PythonAnywhere:
   import sys
   sys.path.insert(0, '/home/TUUSUARIO/CadizTecnico')
   from wsgi import application
+
+uWSGI no ejecuta los hilos de la app: añade en Tasks > Always-on tasks
+  cd /home/TUUSUARIO/CadizTecnico && flask --app app telegram-worker
+para enviar los mensajes de Telegram y atender los comandos del bot.
 """
 import sys
 import os